@@ -0,0 +1,116 @@
+"""Worker CPU time per MB of attachment served.
+
+Starts ``bench.fake_provider:app`` with one gunicorn worker per mode, uploads
+one file and downloads it repeatedly, reading the worker's CPU time from
+/proc (Linux only):
+
+- ``sendfile``: the worker streams the body with sendfile() (gunicorn default)
+- ``no-sendfile``: the worker reads and writes the body in Python
+- ``x-accel-redirect``: the worker only sends headers; nginx would send the file
+
+    python bench/attachment_serving.py --size-mb 15 --downloads 40
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from stream_capacity import API_DIR, free_port, register
+
+MODES = ['sendfile', 'no-sendfile', 'x-accel-redirect']
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def start_server(mode, port, workdir):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        WEB_CONCURRENCY='1',
+        JOB_WORKER_PROCESSES='0',
+        ATTACHMENT_OFFLOAD='x-accel-redirect' if mode == 'x-accel-redirect' else '',
+        USER_STORAGE_QUOTA_BYTES=str(1 << 40),
+    )
+    args = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+            '--bind', f'127.0.0.1:{port}', 'bench.fake_provider:app']
+    if mode == 'no-sendfile':
+        args.insert(-1, '--no-sendfile')
+    proc = subprocess.Popen(args, cwd=API_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/models', timeout=1)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'gunicorn ({mode}) did not start')
+
+
+def worker_pid(master_pid):
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        return int(f.read().split()[0])
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def run(mode, size_mb, downloads):
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        proc = start_server(mode, port, workdir)
+        try:
+            base = f'http://127.0.0.1:{port}/api'
+            token = register(port)
+            body = b'%PDF-' + os.urandom(size_mb * 1024 * 1024 - 5)
+            req = urllib.request.Request(
+                f'{base}/attachments/upload/stream?filename=bench.pdf', data=body,
+                headers={'Authorization': f'Bearer {token}'},
+            )
+            with urllib.request.urlopen(req) as resp:
+                attachment_id = json.load(resp)['attachment']['id']
+
+            download = urllib.request.Request(
+                f'{base}/attachments/{attachment_id}', headers={'Authorization': f'Bearer {token}'}
+            )
+            pid = worker_pid(proc.pid)
+            cpu_before = cpu_seconds(pid)
+            started = time.perf_counter()
+            received = 0
+            for _ in range(downloads):
+                with urllib.request.urlopen(download) as resp:
+                    received += len(resp.read())
+            wall = time.perf_counter() - started
+            cpu = cpu_seconds(pid) - cpu_before
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    served_mb = size_mb * downloads
+    return {
+        'mode': mode,
+        'downloads': downloads,
+        'mb_served_by_worker': round(received / 1024 / 1024, 1),
+        'worker_cpu_ms_per_mb': round(cpu * 1000 / served_mb, 3),
+        'wall_ms_per_download': round(wall * 1000 / downloads, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=15, help='file size (the upload limit is 16MB)')
+    parser.add_argument('--downloads', type=int, default=40)
+    parser.add_argument('--mode', nargs='+', default=MODES, choices=MODES)
+    args = parser.parse_args()
+    print(json.dumps([run(mode, args.size_mb, args.downloads) for mode in args.mode], indent=2))
+
+
+if __name__ == '__main__':
+    main()
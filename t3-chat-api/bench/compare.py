@@ -0,0 +1,81 @@
+"""Compare two bench/load_test.py results and fail on regressions.
+
+For each scenario of the baseline:
+- latency and time to first token (p50, p95, p99) regress when they are
+  more than --tolerance slower and at least --min-ms slower
+- throughput regresses when it drops by more than --tolerance
+- the error rate regresses when it grows by more than --max-error-increase
+Exits with status 1 on any regression, or when a baseline scenario is
+missing from the current results.
+
+    python bench/compare.py bench/baselines/load_test.json results.json --tolerance 0.25
+"""
+import argparse
+import json
+import sys
+
+PERCENTILES = ('p50', 'p95', 'p99')
+
+
+def compare(baseline, current, args):
+    """Rows of (scenario, metric, baseline, current, change, regressed)"""
+    rows = []
+    for name, base in baseline['scenarios'].items():
+        now = current['scenarios'].get(name)
+        if now is None:
+            rows.append((name, 'missing', None, None, None, True))
+            continue
+        for group in ('latency_ms', 'ttft_ms'):
+            for p in PERCENTILES:
+                before = base.get(group, {}).get(p)
+                after = now.get(group, {}).get(p)
+                if before is None or after is None:
+                    continue
+                change = (after - before) / before if before else 0.0
+                regressed = change > args.tolerance and after - before >= args.min_ms
+                rows.append((name, f'{group[:-3]} {p} ms', before, after, change, regressed))
+        before, after = base['throughput_rps'], now['throughput_rps']
+        change = (after - before) / before if before else 0.0
+        rows.append((name, 'throughput rps', before, after, change, change < -args.tolerance))
+        before, after = base['error_rate'], now['error_rate']
+        rows.append((name, 'error rate', before, after, after - before, after - before > args.max_error_increase))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--min-ms', type=float, default=5, help='ignore slowdowns smaller than this')
+    parser.add_argument('--max-error-increase', type=float, default=0.01)
+    parser.add_argument('--only-regressions', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline['meta'].get('config') != current['meta'].get('config'):
+        print('Warning: the two runs used different settings, the comparison may not be meaningful')
+    if (baseline['meta'].get('cpus'), baseline['meta'].get('platform')) != \
+            (current['meta'].get('cpus'), current['meta'].get('platform')):
+        print('Warning: the two runs come from different machines')
+
+    rows = compare(baseline, current, args)
+    print(f"{'scenario':<28}{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, metric, before, after, change, regressed in rows:
+        if args.only_regressions and not regressed:
+            continue
+        if metric == 'missing':
+            print(f'{name:<28}{"missing from current results":<54}  REGRESSION')
+            continue
+        change = f'{change:+.1%}' if metric != 'error rate' else f'{change:+.3f}'
+        print(f"{name:<28}{metric:<20}{before:>12}{after:>12}{change:>10}{'  REGRESSION' if regressed else ''}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f'{regressions} regression(s)' if regressions else 'No regressions')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Cost per turn of building the conversation context on a long session.
+
+Fills a SQLite session with N messages and compares, per turn:
+- naive: load every ChatMessage of the session and estimate its tokens
+- build_context: cached window, only new messages read from the database
+
+    python bench/context_window.py --messages 10000 --turns 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.main import app  # noqa: E402
+from src.models.user import db, User, ChatSession, ChatMessage  # noqa: E402
+from src.services.context_builder import build_context, estimate_tokens  # noqa: E402
+
+TEXT = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8
+
+
+def seed(messages):
+    user = User(username='bench', email='bench@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    session = ChatSession(id=str(uuid.uuid4()), user_id=user.id, title='bench')
+    db.session.add(session)
+    start = datetime.utcnow() - timedelta(seconds=messages)
+    db.session.bulk_insert_mappings(ChatMessage, [
+        {
+            'id': str(uuid.uuid4()),
+            'session_id': session.id,
+            'text': TEXT,
+            'sender': 'user' if i % 2 == 0 else 'ai',
+            'created_at': start + timedelta(seconds=i),
+        }
+        for i in range(messages)
+    ])
+    db.session.commit()
+    return session.id
+
+
+def naive_context(session_id):
+    messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.created_at.asc()).all()
+    return [{'role': m.sender, 'content': m.text, 'tokens': estimate_tokens(m.text)} for m in messages]
+
+
+def add_turn(session_id):
+    db.session.add(ChatMessage(id=str(uuid.uuid4()), session_id=session_id, text=TEXT, sender='user'))
+    db.session.add(ChatMessage(id=str(uuid.uuid4()), session_id=session_id, text=TEXT, sender='ai'))
+    db.session.commit()
+
+
+def timed_turns(session_id, turns, build):
+    samples = []
+    for _ in range(turns):
+        add_turn(session_id)
+        db.session.expunge_all()
+        started = time.perf_counter()
+        build(session_id)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--turns', type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        session_id = seed(args.messages)
+
+        started = time.perf_counter()
+        history = build_context(session_id)
+        cold_ms = (time.perf_counter() - started) * 1000
+
+        result = {
+            'messages': args.messages,
+            'window_messages': len(history),
+            'build_context_cold_ms': round(cold_ms, 3),
+            'naive': timed_turns(session_id, args.turns, naive_context),
+            'build_context': timed_turns(session_id, args.turns, build_context),
+        }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
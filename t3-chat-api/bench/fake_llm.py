@@ -0,0 +1,182 @@
+"""Local fake LLM server speaking the OpenAI, Anthropic and Gemini APIs.
+
+Answers the streaming and non-streaming endpoints the provider SDKs call, so
+the app can be benchmarked end to end (SDK, provider_router, SSE) without
+network or API keys. Point the app at it with:
+
+    PROVIDER_BASE_URL_OPENAI=http://127.0.0.1:8090/v1
+    PROVIDER_BASE_URL_DEEPSEEK=http://127.0.0.1:8090/v1
+    PROVIDER_BASE_URL_ANTHROPIC=http://127.0.0.1:8090
+    PROVIDER_BASE_URL_GOOGLE=http://127.0.0.1:8090
+
+Every answer waits --first-token-latency seconds, then streams --tokens
+tokens at --tokens-per-second; --error-rate of the requests get a 500.
+
+    python bench/fake_llm.py --port 8090 --first-token-latency 0.3 --tokens-per-second 50
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_GEMINI_PATH = re.compile(r'/models/([^/:]+):(streamGenerateContent|generateContent)')
+
+
+class FakeLLM(BaseHTTPRequestHandler):
+    first_token_latency = 0.3
+    tokens_per_second = 50.0
+    tokens = 20
+    error_rate = 0.0
+    rng = random.Random(1)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.path.split('?', 1)[0]
+        with self.lock:
+            failed = self.rng.random() < self.error_rate
+        gemini = _GEMINI_PATH.search(path)
+        if path.endswith('/chat/completions'):
+            answer = self._openai
+            stream = body.get('stream', False)
+        elif path.endswith('/v1/messages'):
+            answer = self._anthropic
+            stream = body.get('stream', False)
+        elif gemini:
+            answer = self._gemini
+            stream = gemini.group(2) == 'streamGenerateContent'
+        else:
+            self._json(404, {'error': {'message': f'unknown endpoint {path}'}})
+            return
+        time.sleep(self.first_token_latency)
+        if failed:
+            self._json(500, {'error': {'message': 'injected failure', 'type': 'server_error', 'code': 500}})
+            return
+        try:
+            answer(body, stream)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client gone (cancelled stream)
+            pass
+
+    def _json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _words(self):
+        """Tokens of the answer, paced at tokens_per_second (the first one is immediate)"""
+        for i in range(self.tokens):
+            if i and self.tokens_per_second > 0:
+                time.sleep(1.0 / self.tokens_per_second)
+            yield f'token{i} '
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+
+    def _send(self, data):
+        self.wfile.write(data.encode())
+        self.wfile.flush()
+
+    def _openai(self, body, stream):
+        model = body.get('model', 'fake')
+        if not stream:
+            text = ''.join(self._words())
+            self._json(200, {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 1, 'completion_tokens': self.tokens, 'total_tokens': self.tokens + 1},
+            })
+            return
+        self._start_stream('text/event-stream')
+        for word in self._words():
+            chunk = {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}],
+            }
+            self._send(f'data: {json.dumps(chunk)}\n\n')
+        self._send('data: [DONE]\n\n')
+
+    def _anthropic(self, body, stream):
+        model = body.get('model', 'fake')
+        message = {
+            'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+            'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': 1, 'output_tokens': 0},
+        }
+        if not stream:
+            text = ''.join(self._words())
+            message.update(content=[{'type': 'text', 'text': text}], stop_reason='end_turn',
+                           usage={'input_tokens': 1, 'output_tokens': self.tokens})
+            self._json(200, message)
+            return
+        self._start_stream('text/event-stream')
+
+        def event(name, data):
+            self._send(f'event: {name}\ndata: {json.dumps(dict(data, type=name))}\n\n')
+
+        event('message_start', {'message': message})
+        event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+        for word in self._words():
+            event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': word}})
+        event('content_block_stop', {'index': 0})
+        event('message_delta', {'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                'usage': {'output_tokens': self.tokens}})
+        event('message_stop', {})
+
+    def _gemini(self, body, stream):
+        def response(text, last):
+            candidate = {'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}
+            if last:
+                candidate['finishReason'] = 'STOP'
+            return {'candidates': [candidate]}
+
+        if not stream:
+            self._json(200, response(''.join(self._words()), True))
+            return
+        # REST server streaming: one JSON array, written one element at a time
+        self._start_stream('application/json')
+        words = list(range(self.tokens))
+        for i, word in zip(words, self._words()):
+            self._send(('[' if i == 0 else ',') + json.dumps(response(word, i == len(words) - 1)) + '\n')
+        self._send(']')
+
+
+def serve(port=0, **settings):
+    """Start the server in a background thread; returns (server, base URL)"""
+    handler = type('FakeLLM', (FakeLLM,), dict(settings, rng=random.Random(1), lock=threading.Lock()))
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--first-token-latency', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--tokens', type=int, default=20, help='tokens per answer')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    args = parser.parse_args()
+
+    server, url = serve(args.port, first_token_latency=args.first_token_latency,
+                        tokens_per_second=args.tokens_per_second, tokens=args.tokens, error_rate=args.error_rate)
+    print(f'Fake LLM listening on {url}', flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""Flask app with AIService streaming replaced by a local fake provider.
+
+Used by the benchmarks as a gunicorn target (``bench.fake_provider:app``):
+every stream emits FAKE_TOKENS tokens, sleeping FAKE_TOKEN_DELAY seconds
+between them, like a remote LLM would while waiting on the network.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.main import app  # noqa: E402
+from src.models.user import db  # noqa: E402
+from src.services.ai_service import AIService  # noqa: E402
+
+FAKE_TOKENS = int(os.environ.get('FAKE_TOKENS', '20'))
+FAKE_TOKEN_DELAY = float(os.environ.get('FAKE_TOKEN_DELAY', '0.05'))
+
+
+def fake_streaming_response(*args, **kwargs):
+    for i in range(FAKE_TOKENS):
+        time.sleep(FAKE_TOKEN_DELAY)
+        yield f"token{i} "
+
+
+AIService.get_streaming_response = staticmethod(fake_streaming_response)
+
+with app.app_context():
+    db.create_all()
@@ -0,0 +1,374 @@
+"""End-to-end load test of the API against a local fake LLM provider.
+
+Starts bench/fake_llm.py and the real app (gunicorn, SQLite migrated with
+`flask db upgrade`, providers pointed at the fake server), then drives each
+scenario with --concurrency clients at once:
+- register, login
+- send: POST /api/chat/send
+- stream: POST /api/chat/stream, cycling over --models (one entry per model)
+- sessions: GET /api/chat/sessions
+- messages: GET /api/chat/messages/<id>
+- upload: POST /api/attachments/upload/stream (--upload-bytes per file)
+Reports throughput, p50/p95/p99 latency and, for streams, time to first
+token. --output writes the results as JSON, to compare with
+bench/compare.py against a baseline such as bench/baselines/load_test.json.
+Single runs are noisy on small or shared machines: use --repeat to keep the
+fastest of several runs, and compare only results from the same machine.
+
+    python bench/load_test.py --requests 200 --concurrency 20 --repeat 3 --output results.json
+    python bench/compare.py bench/baselines/load_test.json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(API_DIR, 'bench')
+
+SCENARIOS = ['register', 'login', 'send', 'stream', 'sessions', 'messages', 'upload']
+MODELS = ['GPT-4o', 'Claude 3.5 Sonnet', 'Gemini 2.5 Flash', 'DeepSeek V3']
+PROVIDERS = ['openai', 'anthropic', 'google', 'deepseek']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, proc, what):
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'{what} exited with code {proc.returncode}')
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{what} did not start')
+
+
+def start_fake_llm(args):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'fake_llm.py'), '--port', str(port),
+         '--first-token-latency', str(args.first_token_latency),
+         '--tokens-per-second', str(args.tokens_per_second),
+         '--tokens', str(args.tokens), '--error-rate', str(args.error_rate)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{port}'
+    wait_for(url, proc, 'fake LLM')
+    return proc, url
+
+
+def start_app(args, tmp, llm_url):
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+        UPLOAD_FOLDER=os.path.join(tmp, 'uploads'),
+        JWT_SECRET_KEY='load-test-secret-key-of-at-least-32-bytes',
+        WEB_CONCURRENCY=str(args.workers),
+        GUNICORN_WORKER_CLASS=args.worker_class,
+        PROVIDER_BASE_URL_OPENAI=f'{llm_url}/v1',
+        PROVIDER_BASE_URL_DEEPSEEK=f'{llm_url}/v1',
+        PROVIDER_BASE_URL_ANTHROPIC=llm_url,
+        PROVIDER_BASE_URL_GOOGLE=llm_url,
+        # The load driver is a handful of users sending far more than a person would
+        RATE_LIMIT_USER_STREAMS='0',
+        RATE_LIMIT_USER_RPM='0',
+        RATE_LIMIT_USER_TPM='0',
+        PYTHONWARNINGS='ignore',
+    )
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'src.main', 'db', 'upgrade'],
+                   cwd=API_DIR, env=env, check=True, capture_output=True)
+    log_path = os.path.join(tmp, 'gunicorn.log')
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', 'src.main:app'],
+            cwd=API_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    try:
+        wait_for(f'http://127.0.0.1:{port}/api/models', proc, 'gunicorn')
+    except RuntimeError:
+        with open(log_path) as log:
+            sys.stderr.write(log.read()[-4000:])
+        raise
+    return proc, port
+
+
+class Response:
+    def __init__(self, status, body, seconds, first_content):
+        self.status = status
+        self.body = body
+        self.seconds = seconds
+        self.first_content = first_content
+
+    def json(self):
+        return json.loads(self.body)
+
+
+async def http(port, method, path, token=None, body=None, content_type='application/json', timeout=120):
+    """One HTTP/1.0 request (the body ends when the server closes)"""
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode()
+    body = body or b''
+    headers = [f'{method} {path} HTTP/1.0', f'Host: 127.0.0.1:{port}', f'Content-Length: {len(body)}']
+    if body:
+        headers.append(f'Content-Type: {content_type}')
+    if token:
+        headers.append(f'Authorization: Bearer {token}')
+    started = time.perf_counter()
+    first_content = None
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+        data = b''
+        while True:
+            chunk = await asyncio.wait_for(reader.read(65536), timeout)
+            if not chunk:
+                break
+            data += chunk
+            if first_content is None and b'"content"' in data:
+                first_content = time.perf_counter() - started
+    finally:
+        writer.close()
+    head, _, payload = data.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    return Response(status, payload, time.perf_counter() - started, first_content)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(samples, wall):
+    """samples: (ok, seconds, first token seconds or None, status)"""
+    latencies = [seconds * 1000 for ok, seconds, _, _ in samples if ok]
+    ttfts = [ttft * 1000 for ok, _, ttft, _ in samples if ok and ttft is not None]
+    statuses = {}
+    for _, _, _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = len(latencies)
+    summary = {
+        'requests': len(samples),
+        'errors': len(samples) - ok,
+        'error_rate': round((len(samples) - ok) / len(samples), 4) if samples else 0,
+        'statuses': statuses,
+        'throughput_rps': round(ok / wall, 2) if wall else 0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / ok, 2) if ok else None,
+            **{f'p{p}': round(percentile(latencies, p), 2) if ok else None for p in (50, 95, 99)},
+            'max': round(max(latencies), 2) if ok else None,
+        },
+    }
+    if ttfts:
+        summary['ttft_ms'] = {f'p{p}': round(percentile(ttfts, p), 2) for p in (50, 95, 99)}
+    return summary
+
+
+async def run(count, concurrency, call, warmup=0, repeat=1):
+    """call(i) -> (ok, seconds, ttft, status) for i in range(count); returns (samples, wall seconds).
+
+    The `warmup` calls before (i >= count) are not measured: they pay for
+    the lazy imports and connections of each worker. With `repeat` > 1 the
+    scenario runs that many times and the fastest run is kept, which filters
+    out most of the noise of a shared machine. Samples are in call order.
+    """
+    async def batch(indexes, samples):
+        async def worker():
+            for i in indexes:
+                try:
+                    samples[i] = await call(i)
+                except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                    samples[i] = (False, 0.0, None, 'failed')
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    await batch(iter(range(count, count + warmup)), {})
+    best = None
+    for _ in range(repeat):
+        samples = {}
+        started = time.perf_counter()
+        await batch(iter(range(count)), samples)
+        wall = time.perf_counter() - started
+        if best is None or wall < best[1]:
+            best = ([samples[i] for i in range(count)], wall)
+    return best
+
+
+def outcome(response, ok=None):
+    if ok is None:
+        ok = 200 <= response.status < 300
+    return ok, response.seconds, response.first_content, response.status
+
+
+async def drive(port, args):
+    results = {}
+    users = [f'load{i}' for i in range(args.users)]
+    tokens = [None] * args.users
+    sessions = []
+
+    def record(name, samples, wall):
+        results[name] = summarize(samples, wall)
+        line = results[name]
+        latency = line['latency_ms']
+        ttft = f", ttft p50 {line['ttft_ms']['p50']}ms" if 'ttft_ms' in line else ''
+        print(f"{name:<28} {line['throughput_rps']:>8} req/s  p50 {latency['p50']}ms  p95 {latency['p95']}ms  "
+              f"p99 {latency['p99']}ms  errors {line['errors']}{ttft}", flush=True)
+
+    # Users and their provider keys are needed by every other scenario
+    async def register(i):
+        response = await http(port, 'POST', '/api/auth/register', body={
+            'username': users[i], 'email': f'{users[i]}@example.com', 'password': 'load-test-password'})
+        if response.status == 201:
+            tokens[i] = response.json()['access_token']
+        return outcome(response)
+
+    record('register', *await run(args.users, args.concurrency, register))
+    if not all(tokens):
+        raise RuntimeError('registration failed, see the statuses above')
+    for token in tokens:
+        for provider in PROVIDERS:
+            await http(port, 'POST', '/api/api-keys', token, {'provider': provider, 'api_key': f'sk-load-{provider}'})
+
+    def user(i):
+        return tokens[i % args.users]
+
+    if 'login' in args.scenarios:
+        async def login(i):
+            name = users[i % args.users]
+            return outcome(await http(port, 'POST', '/api/auth/login',
+                                      body={'username': name, 'password': 'load-test-password'}))
+
+        record('login', *await run(args.requests, args.concurrency, login, args.warmup, args.repeat))
+
+    if 'send' in args.scenarios or 'messages' in args.scenarios:
+        async def send(i):
+            response = await http(port, 'POST', '/api/chat/send', user(i),
+                                  {'message': f'load test message {i}', 'model': MODELS[0]})
+            if response.status == 200:
+                sessions.append((i % args.users, response.json()['session_id']))
+            return outcome(response)
+
+        samples, wall = await run(args.requests, args.concurrency, send, args.warmup, args.repeat)
+        if 'send' in args.scenarios:
+            record('send', samples, wall)
+
+    if 'stream' in args.scenarios:
+        async def stream(i):
+            response = await http(port, 'POST', '/api/chat/stream', user(i),
+                                  {'message': f'load test stream {i}', 'model': args.models[i % len(args.models)]})
+            return outcome(response, response.status == 200 and b'"done": true' in response.body)
+
+        samples, wall = await run(args.requests, args.stream_concurrency, stream, args.warmup, args.repeat)
+        record('stream', samples, wall)
+        for n, model in enumerate(args.models):
+            record(f'stream:{model}', samples[n::len(args.models)], wall)
+
+    if 'sessions' in args.scenarios:
+        async def list_sessions(i):
+            return outcome(await http(port, 'GET', '/api/chat/sessions', user(i)))
+
+        record('sessions', *await run(args.requests, args.concurrency, list_sessions, args.warmup, args.repeat))
+
+    if 'messages' in args.scenarios and sessions:
+        async def messages(i):
+            owner, session_id = sessions[i % len(sessions)]
+            return outcome(await http(port, 'GET', f'/api/chat/messages/{session_id}', tokens[owner]))
+
+        record('messages', *await run(args.requests, args.concurrency, messages, args.warmup, args.repeat))
+
+    if 'upload' in args.scenarios:
+        async def upload(i):
+            # Distinct contents, so every upload writes a new blob
+            line = f'load test upload {i}\n'.encode()
+            body = (line * (args.upload_bytes // len(line) + 1))[:args.upload_bytes]
+            return outcome(await http(port, 'POST', f'/api/attachments/upload/stream?filename=load{i}.txt', user(i),
+                                      body, content_type='application/octet-stream'))
+
+        record('upload', *await run(args.requests, args.concurrency, upload, args.warmup, args.repeat))
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=API_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--stream-concurrency', type=int, help='concurrent streams (default: --concurrency)')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests before each scenario')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest one is reported')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--upload-bytes', type=int, default=64 * 1024)
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+    args.stream_concurrency = args.stream_concurrency or args.concurrency
+
+    with tempfile.TemporaryDirectory() as tmp:
+        llm, llm_url = start_fake_llm(args)
+        try:
+            app, port = start_app(args, tmp, llm_url)
+            try:
+                results = asyncio.run(drive(port, args))
+            finally:
+                app.terminate()
+                app.wait()
+        finally:
+            llm.terminate()
+            llm.wait()
+
+    report = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        'scenarios': results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
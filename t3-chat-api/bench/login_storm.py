@@ -0,0 +1,126 @@
+"""Chat latency during a login storm.
+
+Starts the app and the fake LLM like bench/load_test.py, keeps --streams
+clients sending /api/chat/stream one after the other, and measures their
+latency and time to first token first alone, then while --logins clients
+hammer /api/auth/login for --duration seconds. Runs the whole thing in
+each mode and reports login throughput next to the chat latencies:
+- inline: hashes in the request thread (PASSWORD_HASH_THREADS=0, as before
+  src/services/passwords.py)
+- pool: hashing pool at normal priority (PASSWORD_HASH_NICE=0)
+- pool+nice: hashing pool at lower priority (the default)
+
+    python bench/login_storm.py --logins 20 --streams 5 --duration 20
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+from load_test import MODELS, PROVIDERS, http, outcome, start_app, start_fake_llm, summarize
+
+MODES = {
+    'inline': {'PASSWORD_HASH_THREADS': '0'},
+    'pool': {'PASSWORD_HASH_NICE': '0'},
+    'pool+nice': {},
+}
+
+
+async def loop(until, call, counter, samples):
+    while time.perf_counter() < until:
+        try:
+            samples.append(await call(next(counter)))
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            samples.append((False, 0.0, None, 'failed'))
+
+
+async def measure(clients, duration, call, start=0):
+    # Distinct indexes: the same prompt twice would come from the response cache
+    counter = itertools.count(start)
+    samples = []
+    started = time.perf_counter()
+    await asyncio.gather(*(loop(started + duration, call, counter, samples) for _ in range(clients)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+async def drive(port, args):
+    users = [f'storm{i}' for i in range(args.users)]
+    tokens = []
+    for name in users:
+        response = await http(port, 'POST', '/api/auth/register', body={
+            'username': name, 'email': f'{name}@example.com', 'password': 'login-storm-password'})
+        if response.status != 201:
+            raise RuntimeError(f'registration failed with status {response.status}')
+        tokens.append(response.json()['access_token'])
+        for provider in PROVIDERS:
+            await http(port, 'POST', '/api/api-keys', tokens[-1], {'provider': provider, 'api_key': f'sk-storm-{provider}'})
+
+    async def stream(i):
+        response = await http(port, 'POST', '/api/chat/stream', tokens[i % len(tokens)],
+                              {'message': f'login storm {i}', 'model': args.models[i % len(args.models)]})
+        return outcome(response, response.status == 200 and b'"done": true' in response.body)
+
+    async def login(i):
+        return outcome(await http(port, 'POST', '/api/auth/login',
+                                  body={'username': users[i % len(users)], 'password': 'login-storm-password'}))
+
+    # Warm up the workers (imports, provider clients)
+    await measure(args.streams, 2, stream)
+    alone = await measure(args.streams, args.duration, stream, 10 ** 6)
+    during, logins = await asyncio.gather(
+        measure(args.streams, args.duration, stream, 2 * 10 ** 6),
+        measure(args.logins, args.duration, login),
+    )
+    return {'chat alone': alone, 'chat during storm': during, 'logins': logins}
+
+
+def report(mode, results):
+    for name, line in results.items():
+        latency = line['latency_ms']
+        ttft = f", ttft p50 {line['ttft_ms']['p50']}ms p95 {line['ttft_ms']['p95']}ms" if 'ttft_ms' in line else ''
+        print(f"{mode:<11}{name:<20}{line['throughput_rps']:>8} req/s  p50 {latency['p50']}ms  "
+              f"p95 {latency['p95']}ms  errors {line['errors']} {line['statuses']}{ttft}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=20, help='concurrent login clients')
+    parser.add_argument('--streams', type=int, default=5, help='concurrent chat clients')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per measurement')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        saved = dict(os.environ)
+        os.environ.update(MODES[mode])
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                llm, llm_url = start_fake_llm(args)
+                try:
+                    app, port = start_app(args, tmp, llm_url)
+                    try:
+                        results = asyncio.run(drive(port, args))
+                    finally:
+                        app.terminate()
+                        app.wait()
+                finally:
+                    llm.terminate()
+                    llm.wait()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        report(mode, results)
+
+
+if __name__ == '__main__':
+    main()
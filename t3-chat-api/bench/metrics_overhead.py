@@ -0,0 +1,119 @@
+"""Per-request cost of the metrics instrumentation.
+
+Times the hooks that run on every request (metrics, and the slow request log
+of src/services/profiling.py with profiling off) and on every SQL query
+(SQLAlchemy cursor events) in isolation: comparing two end-to-end
+runs is dominated by noise at this scale. The cost is then compared with the
+latency of real requests through the Flask test client:
+- GET /api/models: no database
+- GET /api/chat/messages/<id>: JWT, 2 queries and 100 messages serialized
+Exits with status 1 when a request with --queries queries costs more than
+--budget-us of instrumentation, so CI can enforce it.
+
+    python bench/metrics_overhead.py --queries 10 --budget-us 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import uuid
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def per_call(function, number):
+    """Best of 5 runs, microseconds per call"""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def request_latency(call, requests):
+    for _ in range(100):
+        call()
+    # Median of batches: robust to GC pauses and to a noisy machine
+    batches = []
+    for _ in range(10):
+        started = time.perf_counter()
+        for _ in range(requests // 10):
+            call()
+        batches.append((time.perf_counter() - started) / (requests // 10))
+    return statistics.median(batches) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=10, help='SQL queries of a typical request')
+    parser.add_argument('--budget-us', type=float, default=50, help='maximum overhead per request, microseconds')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/bench.db'
+    os.environ['JOB_WORKER_PROCESSES'] = '0'
+    os.environ['JOBS_EMBEDDED_WORKERS'] = '0'
+    os.environ['METRICS_ENABLED'] = '1'
+    os.environ.pop('METRICS_DIR', None)
+    os.environ['PROFILE_SAMPLE_RATE'] = '0'
+    os.environ.pop('PROFILE_TOKEN', None)
+    sys.path.insert(0, API_DIR)
+
+    from flask import Response
+    from flask_jwt_extended import create_access_token
+    from src.main import app
+    from src.models.user import db, User, ChatSession, ChatMessage
+    from src.services import metrics, profiling
+
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        session_id = str(uuid.uuid4())
+        db.session.add(ChatSession(id=session_id, user_id=user.id, title='bench', message_count=100))
+        for i in range(100):
+            db.session.add(ChatMessage(id=str(uuid.uuid4()), session_id=session_id, text=f'message {i}', sender='user'))
+        db.session.commit()
+        token = create_access_token(identity=str(user.id))
+        with db.engine.connect() as connection:
+            raw = connection.connection.cursor()
+
+            class Connection:
+                info = {}
+
+            def query_hooks():
+                metrics._before_cursor_execute(Connection, raw, '', (), None, False)
+                metrics._after_cursor_execute(Connection, raw, '', (), None, False)
+
+            query_cost = per_call(query_hooks, 100000)
+
+    response = Response('')
+    with app.test_request_context(f'/api/chat/messages/{session_id}'):
+        def request_hooks():
+            metrics._before_request()
+            profiling._before_request()
+            profiling._after_request(response)
+            metrics._after_request(response)
+
+        request_cost = per_call(request_hooks, 100000)
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    latencies = {
+        'GET /api/models': request_latency(lambda: client.get('/api/models'), args.requests),
+        'GET /api/chat/messages': request_latency(
+            lambda: client.get(f'/api/chat/messages/{session_id}', headers=headers), args.requests),
+    }
+
+    overhead = request_cost + args.queries * query_cost
+    print(f'request hooks     {request_cost:6.1f}us per request')
+    print(f'query hooks       {query_cost:6.1f}us per SQL query')
+    print(f'typical request   {overhead:6.1f}us ({args.queries} queries)')
+    for name, latency in latencies.items():
+        print(f'{name:<24} {latency:8.1f}us, request hooks {request_cost / latency:.1%} of it')
+    print(f'budget {args.budget_us:.0f}us per request: {"FAIL" if overhead > args.budget_us else "ok"}')
+    sys.exit(1 if overhead > args.budget_us else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Time to first token when one AI provider degrades.
+
+Starts two local OpenAI-compatible streaming servers: "openai" answers
+slowly (--slow-delay) or with a 500 for a share of the requests, "deepseek"
+is healthy. N concurrent streams of GPT-4o (with DeepSeek V3 as fallback)
+go through AIService.get_streaming_response in three configurations:
+- direct: no fallback, the SDK timeouts only
+- fallback: first-token timeout, then the fallback model
+- hedged: the fallback also starts when the first token is late
+Exits with status 1, so CI can enforce it, when a fallback or hedged stream
+fails, or when its first token comes later than the first-token timeout
+(hedge delay when hedged) plus the fallback's own first token and --slack.
+
+    python bench/provider_failover.py --requests 200 --concurrency 20
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# First token delay of the healthy fallback provider
+FALLBACK_FIRST_TOKEN_DELAY = 0.4
+
+
+class FakeProvider(BaseHTTPRequestHandler):
+    """POST /chat/completions streamed as OpenAI chat.completion.chunk events."""
+    first_token_delay = 0.3
+    token_delay = 0.02
+    tokens = 10
+    slow_rate = 0.0
+    slow_delay = 0.0
+    error_rate = 0.0
+    rng = random.Random(1)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.error_rate:
+            time.sleep(0.05)
+            self.send_response(500)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{"error": {"message": "injected failure", "type": "server_error"}}')
+            return
+        delay = self.slow_delay if roll < self.error_rate + self.slow_rate else self.first_token_delay
+        time.sleep(delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            for i in range(self.tokens):
+                chunk = {
+                    'id': 'fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'fake',
+                    'choices': [{'index': 0, 'delta': {'content': f'token{i} '}, 'finish_reason': None}],
+                }
+                self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+                self.wfile.flush()
+                time.sleep(self.token_delay)
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Cancelled hedge
+            pass
+
+
+def start_provider(**settings):
+    handler = type('Provider', (FakeProvider,), dict(settings, rng=random.Random(1), lock=threading.Lock()))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--slow-rate', type=float, default=0.2, help='Share of slow answers of the degraded provider')
+    parser.add_argument('--slow-delay', type=float, default=8.0)
+    parser.add_argument('--error-rate', type=float, default=0.1, help='Share of 500s of the degraded provider')
+    parser.add_argument('--first-token-timeout', type=float, default=2.0)
+    parser.add_argument('--hedge-after', type=float, default=1.0)
+    parser.add_argument('--slack', type=float, default=0.5, help='allowed scheduling delay, seconds')
+    args = parser.parse_args()
+
+    os.environ['PROVIDER_BASE_URL_OPENAI'] = start_provider(
+        slow_rate=args.slow_rate, slow_delay=args.slow_delay, error_rate=args.error_rate
+    )
+    os.environ['PROVIDER_BASE_URL_DEEPSEEK'] = start_provider(first_token_delay=FALLBACK_FIRST_TOKEN_DELAY)
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/bench.db'
+    os.environ['JOB_WORKER_PROCESSES'] = '0'
+    sys.path.insert(0, API_DIR)
+
+    from src.main import app
+    from src.models.user import db, User, UserApiKey
+    from src.services import provider_router
+    from src.services.ai_service import AIService
+
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        for provider in ('openai', 'deepseek'):
+            db.session.add(UserApiKey(user_id=user.id, provider=provider,
+                                      api_key=base64.b64encode(b'sk-bench').decode()))
+        db.session.commit()
+        user_id = user.id
+
+    def one_stream(index):
+        with app.app_context():
+            user = db.session.get(User, user_id)
+            started = time.perf_counter()
+            first_token = None
+            text = ''
+            try:
+                for chunk in AIService.get_streaming_response(f'hello {index}', 'GPT-4o', user):
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    text += chunk
+            except Exception as e:
+                text = f'Errore: {e}'
+            finally:
+                db.session.remove()
+            return first_token, text.startswith(('Errore', '⚠️'))
+
+    configurations = [
+        ('direct', {'fallbacks': [], 'timeout': 300.0, 'hedge': 0}),
+        ('fallback', {'fallbacks': ['DeepSeek V3'], 'timeout': args.first_token_timeout, 'hedge': 0}),
+        ('hedged', {'fallbacks': ['DeepSeek V3'], 'timeout': args.first_token_timeout, 'hedge': args.hedge_after}),
+    ]
+    print(f'{args.requests} streams, {args.concurrency} at once; degraded provider: '
+          f'{args.slow_rate:.0%} answer after {args.slow_delay}s, {args.error_rate:.0%} fail')
+    failures = []
+    print(f"{'':<10}{'p50 ttft':>10}{'p90':>9}{'p99':>9}{'max':>9}{'errors':>8}  breaker")
+    for name, config in configurations:
+        provider_router.MODELS['GPT-4o'] = config['fallbacks']
+        provider_router.FIRST_TOKEN_TIMEOUTS['openai'] = config['timeout']
+        provider_router.HEDGE_AFTER_SECONDS = config['hedge']
+        provider_router.provider_router._breakers.clear()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(one_stream, range(args.requests)))
+        ttfts = [ttft for ttft, failed in results if not failed]
+        errors = sum(1 for _, failed in results if failed)
+        trips = provider_router.provider_router.stats().get('openai', {}).get('trips', 0)
+        print(f'{name:<10}{statistics.median(ttfts):>9.2f}s{percentile(ttfts, 90):>8.2f}s'
+              f'{percentile(ttfts, 99):>8.2f}s{max(ttfts):>8.2f}s{errors:>8}  {trips} trips')
+        if name != 'direct':
+            bound = (config['hedge'] or config['timeout']) + FALLBACK_FIRST_TOKEN_DELAY + args.slack
+            if errors:
+                failures.append(f'{name}: {errors} streams failed despite the fallback')
+            if max(ttfts) > bound:
+                failures.append(f'{name}: slowest first token {max(ttfts):.2f}s, expected at most {bound:.2f}s')
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Fairness of /api/chat/stream under a noisy neighbor.
+
+Starts ``bench.fake_provider:app`` with one gevent worker limited to
+--connections concurrent connections. One noisy user keeps --noisy streams
+open for --duration seconds, retrying 100 ms after a 429, while --polite users
+each send one stream at a time. Runs with the rate limits off and on, and
+reports the latency and completed streams of the polite users. Exits with
+status 1, so CI can enforce it, when with the limits on a polite stream
+fails, the polite p99 goes over --max-polite-p99, or the noisy user never
+gets a 429.
+
+    python bench/rate_limit_fairness.py --noisy 200 --polite 5 --duration 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, db_path, connections, limits):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f'sqlite:///{db_path}',
+        WEB_CONCURRENCY='1',
+        JOB_WORKER_PROCESSES='0',
+        GUNICORN_WORKER_CONNECTIONS=str(connections),
+        FAKE_TOKENS='20',
+        FAKE_TOKEN_DELAY='0.05',
+        RATE_LIMIT_BACKEND='memory',
+        **limits,
+    )
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', f'127.0.0.1:{port}', 'bench.fake_provider:app'],
+        cwd=API_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/models', timeout=1)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def register(port, name):
+    body = json.dumps({'username': name, 'email': f'{name}@example.com', 'password': 'benchmark'}).encode()
+    req = urllib.request.Request(
+        f'http://127.0.0.1:{port}/api/auth/register', data=body,
+        headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(req) as resp:
+        return json.load(resp)['access_token']
+
+
+async def open_stream(port, token, timeout):
+    """(HTTP status or None, seconds until the stream was done)"""
+    body = json.dumps({'message': 'benchmark', 'model': 'fake'}).encode()
+    request = (
+        f'POST /api/chat/stream HTTP/1.1\r\n'
+        f'Host: 127.0.0.1:{port}\r\n'
+        f'Authorization: Bearer {token}\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: close\r\n\r\n'
+    ).encode() + body
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        payload = await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None, time.perf_counter() - started
+    try:
+        status = int(payload.split(b' ', 2)[1])
+    except (IndexError, ValueError):
+        return None, time.perf_counter() - started
+    if status == 200 and b'"done": true' not in payload:
+        status = None
+    return status, time.perf_counter() - started
+
+
+async def noisy_loop(port, token, until, counts):
+    while time.perf_counter() < until:
+        status, _ = await open_stream(port, token, 30)
+        counts[status] = counts.get(status, 0) + 1
+        if status != 200:
+            await asyncio.sleep(0.1)
+
+
+async def polite_loop(port, token, until, latencies, failures):
+    while time.perf_counter() < until:
+        status, seconds = await open_stream(port, token, 30)
+        if status == 200:
+            latencies.append(seconds)
+        else:
+            failures.append(status)
+            await asyncio.sleep(1)
+
+
+async def run(port, noisy_token, polite_tokens, args):
+    until = time.perf_counter() + args.duration
+    noisy_counts = {}
+    latencies = []
+    failures = []
+    await asyncio.gather(
+        *(noisy_loop(port, noisy_token, until, noisy_counts) for _ in range(args.noisy)),
+        *(polite_loop(port, token, until, latencies, failures) for token in polite_tokens),
+    )
+    return noisy_counts, latencies, failures
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def bench(name, limits, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = start_server(port, os.path.join(tmp, 'bench.db'), args.connections, limits)
+        try:
+            noisy_token = register(port, 'noisy')
+            polite_tokens = [register(port, f'polite{i}') for i in range(args.polite)]
+            noisy_counts, latencies, failures = asyncio.run(run(port, noisy_token, polite_tokens, args))
+        finally:
+            proc.terminate()
+            proc.wait()
+    print(f"{name:<8} polite: {len(latencies):>4} streams, p50 {percentile(latencies, 50):6.2f}s, "
+          f"p99 {percentile(latencies, 99):6.2f}s, {len(failures)} failed | "
+          f"noisy: {noisy_counts.get(200, 0)} streams, {noisy_counts.get(429, 0)} x 429, "
+          f"{sum(v for k, v in noisy_counts.items() if k not in (200, 429))} failed")
+    return noisy_counts, latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--noisy', type=int, default=200, help='Concurrent streams of the noisy user')
+    parser.add_argument('--polite', type=int, default=5, help='Polite users, one stream at a time each')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--connections', type=int, default=100, help='gunicorn worker_connections')
+    parser.add_argument('--user-streams', type=int, default=4)
+    parser.add_argument('--max-polite-p99', type=float, default=5.0,
+                        help='Seconds allowed for a polite stream with the limits on')
+    args = parser.parse_args()
+
+    off = {'RATE_LIMIT_USER_STREAMS': '0', 'RATE_LIMIT_USER_RPM': '0', 'RATE_LIMIT_USER_TPM': '0'}
+    on = {'RATE_LIMIT_USER_STREAMS': str(args.user_streams)}
+    bench('off', off, args)
+    noisy_counts, latencies, failures = bench('on', on, args)
+
+    problems = []
+    if failures:
+        problems.append(f'{len(failures)} polite streams failed: {sorted(set(map(str, failures)))}')
+    if not latencies or percentile(latencies, 99) > args.max_polite_p99:
+        problems.append(f'polite p99 {percentile(latencies, 99):.2f}s over {args.max_polite_p99}s')
+    if not noisy_counts.get(429):
+        problems.append('the noisy user was never rate limited')
+    for problem in problems:
+        print(f'FAIL {problem}')
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Latency of /api/chat/search over a large message history (SQLite FTS5).
+
+Seeds a file database with U users x S sessions x M messages of synthetic
+text (Zipf-like vocabulary, so common and rare words both occur), the index
+being filled by the insert triggers, then times search_messages for one
+user's first page and for a follow-up page via the cursor:
+
+    python bench/search.py --users 200 --sessions 50 --messages 100   # 1M messages
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SYLLABLES = [c + v for c in 'bcdfglmnprstvz' for v in 'aeiou']
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(SYLLABLES, k=rng.randint(1, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    # Parole "reali" a frequenza media (rango 100-109)
+    words[100:100] = ['postgres', 'index', 'deploy', 'python', 'flask', 'stream', 'cache', 'upload', 'token', 'model']
+    return words
+
+
+WORDS = vocabulary(20000, random.Random(7))
+# Pesi ~1/rank: poche parole frequentissime (come "the"), molte rare
+CUM_WEIGHTS = []
+_total = 0.0
+for _rank in range(len(WORDS)):
+    _total += 1.0 / (_rank + 1)
+    CUM_WEIGHTS.append(_total)
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choices(WORDS, cum_weights=CUM_WEIGHTS, k=length))
+
+
+def seed(path, users, sessions, messages, seed_value):
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    for user_id in range(1, users + 1):
+        conn.execute(
+            'INSERT INTO user (id, username, email, password_hash, created_at) VALUES (?, ?, ?, ?, ?)',
+            (user_id, f'user{user_id}', f'user{user_id}@example.com', 'x', '2026-01-01 00:00:00')
+        )
+        session_rows = []
+        message_rows = []
+        for s in range(sessions):
+            session_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            session_rows.append((session_id, user_id, f'session {s}', '2026-01-01 00:00:00', '2026-01-01 00:00:00'))
+            for m in range(messages):
+                message_rows.append((
+                    str(uuid.UUID(int=rng.getrandbits(128))), session_id,
+                    sentence(rng, rng.randint(8, 60)), 'user' if m % 2 == 0 else 'ai',
+                    f'2026-01-01 00:{m // 60 % 60:02d}:{m % 60:02d}.{s:06d}'
+                ))
+        conn.executemany(
+            'INSERT INTO chat_session (id, user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            session_rows
+        )
+        conn.executemany(
+            'INSERT INTO chat_messages (id, session_id, text, sender, created_at) VALUES (?, ?, ?, ?, ?)',
+            message_rows
+        )
+        conn.commit()
+    conn.execute("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'p50_ms': round(statistics.median(samples), 2),
+        'p95_ms': round(samples[int(len(samples) * 0.95) - 1], 2),
+        'max_ms': round(samples[-1], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--db', help='reuse/create this database file instead of a temporary one')
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'search.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    from src.main import app
+    from src.models.user import db
+    from src.services.search import search_messages
+
+    total = args.users * args.sessions * args.messages
+    with app.app_context():
+        fresh = not db.session.execute(db.text('SELECT 1 FROM user LIMIT 1')).first() \
+            if db.inspect(db.engine).has_table('user') else True
+        db.create_all()
+    if fresh:
+        start = time.perf_counter()
+        seed(path, args.users, args.sessions, args.messages, 42)
+        print(f'seeded {total} messages in {time.perf_counter() - start:.1f}s '
+              f'({os.path.getsize(path) / 1e6:.0f} MB)', file=sys.stderr)
+
+    queries = {
+        'stopword-like (in ~all messages)': WORDS[0],
+        'common word': WORDS[50],
+        'rare word': WORDS[15000],
+        'two words': 'postgres index',
+        'no match': 'nonexistentword',
+    }
+    with app.app_context():
+        results = {'messages': db.session.execute(db.text('SELECT count(*) FROM chat_messages')).scalar()}
+        for label, query in queries.items():
+            user_id = random.Random(label).randint(1, args.users)
+            first, cursor = search_messages(user_id, query, 20)
+            results[label] = dict(timed(lambda: search_messages(user_id, query, 20), args.repeat), hits=len(first))
+            if cursor:
+                results[label + ' (next page)'] = timed(
+                    lambda: search_messages(user_id, query, 20, cursor), args.repeat
+                )
+            db.session.remove()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
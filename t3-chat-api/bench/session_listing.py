@@ -0,0 +1,90 @@
+"""Cost of listing a heavy user's chat sessions (/api/chat/sessions).
+
+Seeds SQLite with S sessions x M messages and compares:
+- count_via_relationship: len(session.messages) per session (the old to_dict)
+- denormalized: ChatSession.to_dict with the stored message_count
+
+    python bench/session_listing.py --sessions 1000 --messages 500
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from src.main import app  # noqa: E402
+from src.models.user import db, User, ChatSession, ChatMessage  # noqa: E402
+
+TEXT = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8
+
+
+def seed(sessions, messages):
+    user = User(username='bench', email='bench@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    now = datetime.utcnow()
+    for s in range(sessions):
+        session_id = str(uuid.uuid4())
+        db.session.add(ChatSession(
+            id=session_id, user_id=user.id, title=f'session {s}',
+            updated_at=now - timedelta(minutes=s),
+            message_count=messages, last_message_at=now, last_message_preview=TEXT[:200],
+        ))
+        db.session.bulk_insert_mappings(ChatMessage, [
+            {'id': str(uuid.uuid4()), 'session_id': session_id, 'text': TEXT,
+             'sender': 'user' if i % 2 == 0 else 'ai', 'created_at': now}
+            for i in range(messages)
+        ])
+    db.session.commit()
+    return user.id
+
+
+def count_via_relationship(user_id):
+    sessions = ChatSession.query.filter_by(user_id=user_id).order_by(ChatSession.updated_at.desc()).all()
+    return [dict(session.to_dict(), message_count=len(session.messages)) for session in sessions]
+
+
+def denormalized(user_id):
+    sessions = ChatSession.query.filter_by(user_id=user_id).order_by(ChatSession.updated_at.desc()).all()
+    return [session.to_dict() for session in sessions]
+
+
+def measure(listing, user_id):
+    queries = []
+    listener = lambda *args: queries.append(1)  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    db.session.expunge_all()
+    started = time.perf_counter()
+    payload = json.dumps(listing(user_id))
+    elapsed = time.perf_counter() - started
+    event.remove(db.engine, 'before_cursor_execute', listener)
+    return {'ms': round(elapsed * 1000, 1), 'queries': len(queries), 'response_bytes': len(payload)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=500)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        user_id = seed(args.sessions, args.messages)
+        result = {
+            'sessions': args.sessions,
+            'messages_per_session': args.messages,
+            'count_via_relationship': measure(count_via_relationship, user_id),
+            'denormalized': measure(denormalized, user_id),
+        }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Cold start of the API: import time and time to first request.
+
+Each sample runs in a fresh interpreter, like a new gunicorn worker. Exits
+with status 1 when the median exceeds the budget or when a provider SDK is
+imported at startup, so CI can enforce it.
+
+    python bench/startup.py --samples 5 --budget-ms 1500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy modules that must only be imported on first use
+LAZY_MODULES = ['openai', 'anthropic', 'google.generativeai', 'grpc', 'PIL', 'alembic']
+
+PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+from src.main import app
+imported = time.perf_counter()
+with app.app_context():
+    from src.models.user import db
+    db.create_all()
+ready = time.perf_counter()
+response = app.test_client().get('/api/models')
+assert response.status_code == 200, response.status_code
+first_request = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (first_request - ready) * 1000,
+    # schema creation is only needed by this in-memory database, not by a worker
+    'time_to_first_request_ms': ((first_request - started) - (ready - imported)) * 1000,
+    'eager_modules': [m for m in {LAZY_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+def sample():
+    env = dict(os.environ, DATABASE_URL='sqlite://', PYTHONWARNINGS='ignore')
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=API_DIR, env=env,
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=1500,
+                        help='maximum median time from interpreter start of the import to the first response')
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.samples)]
+    eager = sorted({module for s in samples for module in s['eager_modules']})
+    result = {
+        key: round(statistics.median(s[key] for s in samples), 1)
+        for key in ('import_ms', 'first_request_ms', 'time_to_first_request_ms')
+    }
+    result['budget_ms'] = args.budget_ms
+    result['eager_modules'] = eager
+    print(json.dumps(result, indent=2))
+
+    if eager or result['time_to_first_request_ms'] > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
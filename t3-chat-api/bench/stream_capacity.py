@@ -0,0 +1,132 @@
+"""Concurrent /api/chat/stream capacity of a single gunicorn worker.
+
+Starts ``bench.fake_provider:app`` with one worker for each worker class,
+opens N streams at once and reports how many of them the worker really
+served in parallel (effective concurrency = N * stream duration / wall time).
+
+    python bench/stream_capacity.py --streams 500 --worker-class sync gevent
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(worker_class, port, db_path, tokens, token_delay):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f'sqlite:///{db_path}',
+        PORT=str(port),
+        WEB_CONCURRENCY='1',
+        JOB_WORKER_PROCESSES='0',
+        GUNICORN_WORKER_CLASS=worker_class,
+        FAKE_TOKENS=str(tokens),
+        FAKE_TOKEN_DELAY=str(token_delay),
+    )
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', f'127.0.0.1:{port}', 'bench.fake_provider:app'],
+        cwd=API_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/models', timeout=1)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'gunicorn ({worker_class}) did not start')
+
+
+def register(port):
+    body = json.dumps({'username': 'bench', 'email': 'bench@example.com', 'password': 'benchmark'}).encode()
+    req = urllib.request.Request(
+        f'http://127.0.0.1:{port}/api/auth/register', data=body,
+        headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(req) as resp:
+        return json.load(resp)['access_token']
+
+
+async def open_stream(port, token, timeout):
+    body = json.dumps({'message': 'benchmark', 'model': 'fake'}).encode()
+    request = (
+        f'POST /api/chat/stream HTTP/1.1\r\n'
+        f'Host: 127.0.0.1:{port}\r\n'
+        f'Authorization: Bearer {token}\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: close\r\n\r\n'
+    ).encode() + body
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        payload = await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if b'"done": true' not in payload:
+        return None
+    return time.perf_counter() - started
+
+
+async def run_streams(port, token, streams, timeout):
+    started = time.perf_counter()
+    durations = await asyncio.gather(*(open_stream(port, token, timeout) for _ in range(streams)))
+    return time.perf_counter() - started, [d for d in durations if d is not None]
+
+
+def bench(worker_class, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = start_server(worker_class, port, os.path.join(tmp, 'bench.db'), args.tokens, args.token_delay)
+        try:
+            token = register(port)
+            wall, durations = asyncio.run(run_streams(port, token, args.streams, args.timeout))
+        finally:
+            proc.terminate()
+            proc.wait()
+    stream_time = args.tokens * args.token_delay
+    completed = len(durations)
+    return {
+        'worker_class': worker_class,
+        'streams': args.streams,
+        'completed': completed,
+        'wall_seconds': round(wall, 2),
+        'effective_concurrency': round(completed * stream_time / wall, 1) if wall else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=100)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--token-delay', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--worker-class', nargs='+', default=['sync', 'gevent'])
+    args = parser.parse_args()
+
+    for worker_class in args.worker_class:
+        print(json.dumps(bench(worker_class, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Gunicorn configuration for the API.
+#
+# The default worker class is gevent: every request runs in a greenlet and the
+# provider SDKs (httpx for OpenAI/Anthropic/DeepSeek, gRPC for Google) yield to
+# the event loop while waiting for tokens, so a single worker can keep
+# thousands of /api/chat/stream responses open at the same time. Set
+# GUNICORN_WORKER_CLASS=sync to go back to one request per worker.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+
+# Streams can stay open for a long time; with async workers the timeout only
+# guards the worker heartbeat, not the single request.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+
+def post_worker_init(worker):
+    """Make gRPC (used by google-generativeai) cooperate with gevent."""
+    if worker_class != 'gevent':
+        return
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+    except ImportError:
+        pass
+
+
+# Background jobs (src/services/jobs.py) run in a `flask jobs worker` process
+# started and supervised by the gunicorn master, on the same machine as the
+# web workers so they share UPLOAD_FOLDER. With JOB_WORKER_PROCESSES=0 jobs
+# run in threads inside the web workers instead (JOBS_EMBEDDED_WORKERS), or in
+# a worker started separately.
+job_worker_processes = int(os.environ.get('JOB_WORKER_PROCESSES', '1'))
+job_worker_threads = os.environ.get('JOB_WORKER_THREADS', '4')
+if job_worker_processes > 0:
+    os.environ.setdefault('JOBS_EMBEDDED_WORKERS', '0')
+
+_job_worker = {'process': None, 'stopping': False}
+
+
+def _supervise_job_worker(server):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    while not _job_worker['stopping']:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'flask', '--app', 'src.main', 'jobs', 'worker',
+             '--processes', str(job_worker_processes), '--threads', job_worker_threads],
+            cwd=app_dir
+        )
+        _job_worker['process'] = process
+        process.wait()
+        if not _job_worker['stopping']:
+            server.log.warning('Job worker exited with code %s, restarting', process.returncode)
+            time.sleep(1)
+
+
+def when_ready(server):
+    if job_worker_processes <= 0:
+        return
+    # The supervisor thread runs while the master forks the web workers: it
+    # must not import anything, or a worker forked mid-import inherits a
+    # half-initialized module (subprocess, which gevent then fails to patch)
+    threading.Thread(target=_supervise_job_worker, args=(server,), name='job-worker-supervisor', daemon=True).start()
+
+
+def on_exit(server):
+    _job_worker['stopping'] = True
+    process = _job_worker['process']
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except Exception:
+            process.kill()
@@ -0,0 +1,61 @@
+"""session counters and hot path indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_session') as batch_op:
+        batch_op.add_column(sa.Column('message_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('last_message_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('last_message_preview', sa.String(length=200), nullable=True))
+
+    op.create_index('ix_chat_messages_session_created', 'chat_messages', ['session_id', 'created_at', 'id'])
+    op.create_index('ix_chat_session_user_updated', 'chat_session', ['user_id', 'updated_at', 'id'])
+    op.create_index('ix_user_api_key_user_provider_active', 'user_api_key', ['user_id', 'provider', 'is_active'])
+    op.create_index('ix_attachments_user_created', 'attachments', ['user_id', 'created_at'])
+    op.create_index('ix_attachments_message_id', 'attachments', ['message_id'])
+
+    # Backfill the denormalized counters from the existing messages
+    op.execute("""
+        UPDATE chat_session SET
+            message_count = (
+                SELECT COUNT(*) FROM chat_messages WHERE chat_messages.session_id = chat_session.id
+            ),
+            last_message_at = (
+                SELECT MAX(created_at) FROM chat_messages WHERE chat_messages.session_id = chat_session.id
+            )
+    """)
+    op.execute("""
+        UPDATE chat_session SET last_message_preview = (
+            SELECT SUBSTR(text, 1, 200) FROM chat_messages
+            WHERE chat_messages.session_id = chat_session.id
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        )
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_attachments_message_id', table_name='attachments')
+    op.drop_index('ix_attachments_user_created', table_name='attachments')
+    op.drop_index('ix_user_api_key_user_provider_active', table_name='user_api_key')
+    op.drop_index('ix_chat_session_user_updated', table_name='chat_session')
+    op.drop_index('ix_chat_messages_session_created', table_name='chat_messages')
+
+    with op.batch_alter_table('chat_session') as batch_op:
+        batch_op.drop_column('last_message_preview')
+        batch_op.drop_column('last_message_at')
+        batch_op.drop_column('message_count')
@@ -0,0 +1,40 @@
+"""content-addressed attachment blobs
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 09:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blobs',
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('mime_type', sa.String(length=100), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('sha256')
+    )
+    # Existing uploads keep their own file and a NULL blob_hash
+    with op.batch_alter_table('attachments') as batch_op:
+        batch_op.add_column(sa.Column('blob_hash', sa.String(length=64), nullable=True))
+        batch_op.create_foreign_key('fk_attachments_blob_hash', 'blobs', ['blob_hash'], ['sha256'])
+        batch_op.create_index('ix_attachments_blob_hash', ['blob_hash'])
+
+
+def downgrade():
+    with op.batch_alter_table('attachments') as batch_op:
+        batch_op.drop_index('ix_attachments_blob_hash')
+        batch_op.drop_constraint('fk_attachments_blob_hash', type_='foreignkey')
+        batch_op.drop_column('blob_hash')
+    op.drop_table('blobs')
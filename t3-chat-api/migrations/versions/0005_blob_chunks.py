@@ -0,0 +1,41 @@
+"""document text chunks
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 09:40:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.add_column(sa.Column('text_status', sa.String(length=20), nullable=True))
+
+    op.create_table('blob_chunks',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('blob_hash', sa.String(length=64), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('terms', sa.Text(), nullable=False),
+        sa.Column('length', sa.Integer(), nullable=False),
+        sa.Column('tokens', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['blob_hash'], ['blobs.sha256'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_blob_chunks_blob_position', 'blob_chunks', ['blob_hash', 'position'])
+
+
+def downgrade():
+    op.drop_index('ix_blob_chunks_blob_position', table_name='blob_chunks')
+    op.drop_table('blob_chunks')
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.drop_column('text_status')
@@ -0,0 +1,82 @@
+"""chat message full-text search
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 11:20:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+# A copy of the DDL at the time of this revision: src/services/search.py
+# keeps its own for create_all, and may change
+SQLITE_DDL = [
+    """CREATE TABLE chat_messages_fts_ids (
+        id INTEGER PRIMARY KEY,
+        message_id VARCHAR(36) NOT NULL UNIQUE
+    )""",
+    """CREATE VIRTUAL TABLE chat_messages_fts USING fts5(
+        text, owner, tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts_ids (message_id) VALUES (new.id);
+        INSERT INTO chat_messages_fts (rowid, text, owner) VALUES (
+            (SELECT id FROM chat_messages_fts_ids WHERE message_id = new.id),
+            new.text,
+            (SELECT 'u' || user_id FROM chat_session WHERE id = new.session_id)
+        );
+    END""",
+    """CREATE TRIGGER chat_messages_fts_update AFTER UPDATE OF text ON chat_messages BEGIN
+        UPDATE chat_messages_fts SET text = new.text
+        WHERE rowid = (SELECT id FROM chat_messages_fts_ids WHERE message_id = new.id);
+    END""",
+    """CREATE TRIGGER chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+        DELETE FROM chat_messages_fts
+        WHERE rowid = (SELECT id FROM chat_messages_fts_ids WHERE message_id = old.id);
+        DELETE FROM chat_messages_fts_ids WHERE message_id = old.id;
+    END""",
+]
+
+POSTGRES_DDL = [
+    """ALTER TABLE chat_messages ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED""",
+    "CREATE INDEX ix_chat_messages_search_vector ON chat_messages USING gin (search_vector)",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for statement in SQLITE_DDL:
+            op.execute(statement)
+        # Backfill the index with the existing messages
+        op.execute("INSERT INTO chat_messages_fts_ids (message_id) SELECT id FROM chat_messages")
+        op.execute(
+            "INSERT INTO chat_messages_fts (rowid, text, owner) "
+            "SELECT ids.id, m.text, 'u' || s.user_id FROM chat_messages m "
+            "JOIN chat_messages_fts_ids ids ON ids.message_id = m.id "
+            "JOIN chat_session s ON s.id = m.session_id"
+        )
+    elif dialect == 'postgresql':
+        # The generated column is computed for existing rows by ALTER TABLE
+        for statement in POSTGRES_DDL:
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_delete")
+        op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_update")
+        op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_insert")
+        op.execute("DROP TABLE IF EXISTS chat_messages_fts")
+        op.execute("DROP TABLE IF EXISTS chat_messages_fts_ids")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_chat_messages_search_vector")
+        op.execute("ALTER TABLE chat_messages DROP COLUMN IF EXISTS search_vector")
@@ -0,0 +1,25 @@
+"""unlinked attachments have a NULL message_id
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 14:00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Uploads used to store message_id=0 until the attachment was sent, which
+    # is not a valid chat_messages id
+    op.execute("UPDATE attachments SET message_id = NULL WHERE message_id = '0'")
+
+
+def downgrade():
+    pass
@@ -0,0 +1,30 @@
+"""chat message last checkpoint time
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 16:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+    # Only rows still streaming are looked up by updated_at: older rows can keep NULL
+    op.execute("UPDATE chat_messages SET updated_at = created_at WHERE status = 'streaming'")
+    op.create_index('ix_chat_messages_status_updated', 'chat_messages', ['status', 'updated_at'])
+
+
+def downgrade():
+    op.drop_index('ix_chat_messages_status_updated', table_name='chat_messages')
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.drop_column('updated_at')
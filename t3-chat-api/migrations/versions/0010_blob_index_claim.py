@@ -0,0 +1,29 @@
+"""document indexing claim time
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 17:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.add_column(sa.Column('text_claimed_at', sa.DateTime(), nullable=True))
+    # Rows left 'indexing' so far have no claim time: the next sweep requeues them
+    op.create_index('ix_blobs_text_status_claimed', 'blobs', ['text_status', 'text_claimed_at'])
+
+
+def downgrade():
+    op.drop_index('ix_blobs_text_status_claimed', table_name='blobs')
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.drop_column('text_claimed_at')
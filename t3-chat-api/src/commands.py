@@ -0,0 +1,147 @@
+import click
+import multiprocessing
+import signal
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, or_, text
+from src.models.user import db, ChatSession, ChatMessage, UserApiKey, Attachment, Blob, BlobChunk
+from src.routes.chat import before_position, encode_cursor
+from src.services import garbage, jobs
+
+
+def hot_queries():
+    """The queries run on every request of the hot routes, with sample values"""
+    now = datetime.utcnow()
+    session_id = '00000000-0000-0000-0000-000000000000'
+    cursor = encode_cursor(now, session_id)
+    return [
+        ('chat sessions page', ChatSession.query.filter_by(user_id=1)
+            .order_by(ChatSession.updated_at.desc(), ChatSession.id.desc()).limit(51)),
+        ('chat sessions page (before cursor)', ChatSession.query.filter_by(user_id=1)
+            .filter(before_position(ChatSession.updated_at, ChatSession.id, cursor))
+            .order_by(ChatSession.updated_at.desc(), ChatSession.id.desc()).limit(51)),
+        ('chat session lookup', ChatSession.query.filter_by(id=session_id, user_id=1)),
+        ('chat messages page', ChatMessage.query.filter_by(session_id=session_id)
+            .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(101)),
+        ('chat messages page (before cursor)', ChatMessage.query.filter_by(session_id=session_id)
+            .filter(before_position(ChatMessage.created_at, ChatMessage.id, cursor))
+            .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(101)),
+        ('context window new messages', ChatMessage.query.filter(ChatMessage.session_id == session_id)
+            .filter(or_(ChatMessage.created_at > now,
+                        and_(ChatMessage.created_at == now, ChatMessage.id > session_id)))
+            .order_by(ChatMessage.created_at.asc(), ChatMessage.id.asc())),
+        ('stale streaming messages', ChatMessage.query.filter(ChatMessage.status == 'streaming', ChatMessage.updated_at < now)),
+        ('stale document indexing', Blob.query.filter(Blob.text_status == 'indexing', or_(
+            Blob.text_claimed_at.is_(None), Blob.text_claimed_at < now))),
+        ('user api key lookup', UserApiKey.query.filter_by(user_id=1, provider='openai', is_active=True).limit(1)),
+        ('user attachments', Attachment.query.filter_by(user_id=1).order_by(Attachment.created_at.desc())),
+        ('message attachments', Attachment.query.filter(Attachment.id.in_([1, 2]), Attachment.user_id == 1)),
+        ('document chunks', BlobChunk.query.filter(BlobChunk.blob_hash.in_(['0' * 64, '1' * 64]))
+            .order_by(BlobChunk.blob_hash, BlobChunk.position)),
+        ('document index', db.session.query(BlobChunk.position, BlobChunk.length, BlobChunk.tokens, BlobChunk.terms)
+            .filter(BlobChunk.blob_hash == '0' * 64).order_by(BlobChunk.position)),
+        ('selected document chunks', BlobChunk.query
+            .filter(or_(and_(BlobChunk.blob_hash == '0' * 64, BlobChunk.position.in_([1, 2])),
+                        and_(BlobChunk.blob_hash == '1' * 64, BlobChunk.position.in_([3]))))),
+    ]
+
+
+def explain(query):
+    """Return (plan lines, lines showing a full scan or an extra sort)"""
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        plan = [row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+        problems = [line for line in plan if line.startswith('SCAN') or 'TEMP B-TREE' in line]
+    else:
+        # On tiny tables PostgreSQL prefers sequential scans: disable them to see
+        # whether an index *can* serve the query
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+        plan = [row[0] for row in db.session.execute(text('EXPLAIN ' + sql))]
+        problems = [line for line in plan if 'Seq Scan' in line or line.lstrip(' ->').startswith('Sort ')]
+    db.session.rollback()
+    return plan, problems
+
+
+@click.command('check-indexes')
+@with_appcontext
+def check_indexes_command():
+    """Check with EXPLAIN that every hot route query is served by an index."""
+    failures = 0
+    for name, query in hot_queries():
+        plan, problems = explain(query)
+        click.echo(f"[{'ok' if not problems else 'NO INDEX'}] {name}")
+        for line in plan:
+            click.echo(f'    {line}')
+        failures += bool(problems)
+    if failures:
+        raise click.ClickException(f'{failures} hot queries are not served by an index')
+
+
+@click.group('jobs')
+def jobs_command():
+    """Background job queue."""
+
+
+def run_worker_process(app, threads):
+    # Connections inherited from the parent process must not be shared
+    with app.app_context():
+        db.engine.dispose()
+    jobs.Worker(app, threads).run()
+
+
+@jobs_command.command('worker')
+@click.option('--processes', default=1, show_default=True, help='Worker processes (for CPU-bound jobs).')
+@click.option('--threads', default=jobs.JOB_WORKER_THREADS, show_default=True, help='Threads per process.')
+@with_appcontext
+def jobs_worker_command(processes, threads):
+    """Run queued and periodic jobs until SIGTERM/SIGINT."""
+    app = current_app._get_current_object()
+    click.echo(f'Job worker: {processes} process(es) x {threads} thread(s), broker {type(jobs.broker).__name__}')
+    if processes <= 1:
+        jobs.Worker(app, threads).run()
+        return
+
+    context = multiprocessing.get_context('fork')
+    children = [context.Process(target=run_worker_process, args=(app, threads)) for _ in range(processes)]
+    for child in children:
+        child.start()
+
+    def stop(*args):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.join()
+
+
+@jobs_command.command('stats')
+@with_appcontext
+def jobs_stats_command():
+    """Number of jobs by name and status."""
+    for row in jobs.stats():
+        click.echo(f"{row['name']:<30} {row['status']:<8} {row['count']}")
+
+
+@click.command('gc')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+@click.option('--older-than', default=garbage.ATTACHMENT_ORPHAN_TTL, show_default=True,
+              help='Delete attachments never sent in a message after this many seconds.')
+@click.option('--batch-size', default=garbage.GC_BATCH_SIZE, show_default=True, help='Rows per transaction.')
+@click.option('--grace', default=garbage.GC_FILE_GRACE_SECONDS, show_default=True,
+              help='Never delete files modified in the last N seconds.')
+@with_appcontext
+def gc_command(dry_run, older_than, batch_size, grace):
+    """Delete unused attachments, files and blobs from the upload storage."""
+    report = garbage.collect_garbage(
+        current_app.config['UPLOAD_FOLDER'], dry_run=dry_run, older_than=older_than,
+        batch_size=batch_size, grace=grace
+    )
+    result = report.to_dict()
+    for category, totals in sorted(result['categories'].items()):
+        click.echo(f"{category:<28} {totals['count']:>8} {totals['bytes']:>14} bytes")
+    verb = 'would be freed' if dry_run else 'freed'
+    click.echo(f"{result['bytes']} bytes {verb} in {result['seconds']}s")
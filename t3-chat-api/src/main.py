@@ -4,66 +4,99 @@ import os
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+import click
 from flask import Flask, send_from_directory
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from src.models.user import db
+from src.commands import check_indexes_command, gc_command, jobs_command
 from src.routes.user import user_bp
 from src.routes.chat import chat_bp
 from src.routes.api_keys import api_keys_bp
 from src.routes.attachments import attachments_bp
+from src.routes.metrics import metrics_bp
+from src.services import metrics, profiling
+import src.services.tasks  # registers the background job handlers
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-
-# Configuration for production
-app.config['SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'uploads')
-
-# Create upload directory if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# Enable CORS for all routes
-CORS(app, origins="*")
-
-# Initialize JWT
-jwt = JWTManager(app)
-
-app.register_blueprint(user_bp, url_prefix='/api')
-app.register_blueprint(chat_bp, url_prefix='/api')
-app.register_blueprint(api_keys_bp, url_prefix='/api')
-app.register_blueprint(attachments_bp, url_prefix='/api/attachments')
-
-# Database configuration - use PostgreSQL in production, SQLite in development
-database_url = os.environ.get('DATABASE_URL')
-if database_url:
-    # Production: PostgreSQL
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-else:
-    # Development: SQLite
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///t3chat.db'
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'jwt-secret-string')
-db.init_app(app)
-with app.app_context():
-    db.create_all()
-
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-def serve(path):
-    static_folder_path = app.static_folder
-    if static_folder_path is None:
-            return "Static folder not configured", 404
-
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'migrations')
+
+def create_app():
+    """Application factory: configuration, extensions and blueprints.
+
+    Nothing here touches the database schema or imports a provider SDK; the
+    SDKs are loaded on the first request that uses them (see client_pool).
+    """
+    app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+
+    # Configuration for production
+    app.config['SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(__file__), 'uploads'))
+
+    # Create upload directory if it doesn't exist
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Enable CORS for all routes
+    CORS(app, origins="*")
+
+    # Initialize JWT
+    JWTManager(app)
+
+    app.register_blueprint(user_bp, url_prefix='/api')
+    app.register_blueprint(chat_bp, url_prefix='/api')
+    app.register_blueprint(api_keys_bp, url_prefix='/api')
+    app.register_blueprint(attachments_bp, url_prefix='/api/attachments')
+    # Prometheus scrapes /metrics at the root, outside of /api
+    app.register_blueprint(metrics_bp)
+
+    # Request latency, status and SQL queries of every request, then the
+    # opt-in profiler and the slow request log
+    metrics.instrument_app(app)
+    profiling.instrument_app(app)
+
+    # Database configuration - use PostgreSQL in production, SQLite in development
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        # Production: PostgreSQL
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
+        # Development: SQLite
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///t3chat.db'
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'jwt-secret-string')
+    db.init_app(app)
+
+    # Schema changes are applied by `flask --app src.main db upgrade`, run once
+    # per deploy. Alembic is only imported when the app is loaded by the flask
+    # CLI, so web workers don't pay for it at boot.
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=MIGRATIONS_DIR, render_as_batch=True)
+    app.cli.add_command(check_indexes_command)
+    app.cli.add_command(jobs_command)
+    app.cli.add_command(gc_command)
+
+    @app.route('/', defaults={'path': ''})
+    @app.route('/<path:path>')
+    def serve(path):
+        static_folder_path = app.static_folder
+        if static_folder_path is None:
+                return "Static folder not configured", 404
+
+        if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
+            return send_from_directory(static_folder_path, path)
         else:
-            return "index.html not found", 404
+            index_path = os.path.join(static_folder_path, 'index.html')
+            if os.path.exists(index_path):
+                return send_from_directory(static_folder_path, 'index.html')
+            else:
+                return "index.html not found", 404
+
+    return app
+
+
+app = create_app()
 
 
 if __name__ == '__main__':
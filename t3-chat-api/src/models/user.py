@@ -1,6 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-import bcrypt
+from src.services import passwords
 
 db = SQLAlchemy()
 
@@ -18,12 +18,16 @@ class User(db.Model):
         return f'<User {self.username}>'
 
     def set_password(self, password):
-        """Hash and set the password"""
-        self.password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        """Hash and set the password (in the password hashing pool)"""
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
         """Check if the provided password matches the hash"""
-        return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
+        return passwords.check_password(password, self.password_hash)
+
+    def password_needs_rehash(self):
+        """True when the hash was made with a different BCRYPT_ROUNDS"""
+        return passwords.needs_rehash(self.password_hash)
 
     def to_dict(self):
         return {
@@ -34,12 +38,23 @@ class User(db.Model):
         }
 
 class ChatSession(db.Model):
+    __table_args__ = (
+        # Session sidebar: filter by user, keyset on (updated_at, id)
+        db.Index('ix_chat_session_user_updated', 'user_id', 'updated_at', 'id'),
+    )
+    
     id = db.Column(db.String(36), primary_key=True)  # UUID
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(200), nullable=False, default='New Chat')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Denormalized from chat_messages, updated on every write so listing
+    # sessions never has to load their messages
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_message_preview = db.Column(db.String(200), nullable=True)
+    
     # Relationships
     messages = db.relationship('ChatMessage', backref='session', lazy=True, cascade='all, delete-orphan')
 
@@ -52,18 +67,28 @@ class ChatSession(db.Model):
             'title': self.title,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
-            'message_count': len(self.messages)
+            'message_count': self.message_count or 0,
+            'last_message_at': self.last_message_at.isoformat() if self.last_message_at else None,
+            'last_message_preview': self.last_message_preview
         }
 
 class ChatMessage(db.Model):
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        # Messages of a session in order, keyset on (created_at, id)
+        db.Index('ix_chat_messages_session_created', 'session_id', 'created_at', 'id'),
+        # Streams left 'streaming' by a dead worker, by last checkpoint
+        db.Index('ix_chat_messages_status_updated', 'status', 'updated_at'),
+    )
     
     id = db.Column(db.String(36), primary_key=True)  # UUID
     session_id = db.Column(db.String(36), db.ForeignKey('chat_session.id'), nullable=False)
     text = db.Column(db.Text, nullable=False)
     sender = db.Column(db.String(10), nullable=False)  # 'user' or 'ai'
     model = db.Column(db.String(50), nullable=True)  # AI model used
+    status = db.Column(db.String(20), nullable=False, default='complete', server_default='complete')  # 'streaming', 'complete' or 'aborted'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)  # last checkpoint
 
     def __repr__(self):
         return f'<ChatMessage {self.id}>'
@@ -74,11 +99,17 @@ class ChatMessage(db.Model):
             'text': self.text,
             'sender': self.sender,
             'model': self.model,
+            'status': self.status,
             'timestamp': self.created_at.isoformat() if self.created_at else None
         }
 
 
 class UserApiKey(db.Model):
+    __table_args__ = (
+        # get_user_api_key runs on every chat message
+        db.Index('ix_user_api_key_user_provider_active', 'user_id', 'provider', 'is_active'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     provider = db.Column(db.String(50), nullable=False)  # 'openai', 'anthropic', 'google', etc.
@@ -104,9 +135,52 @@ class UserApiKey(db.Model):
 
 
 
+class Blob(db.Model):
+    """Content-addressed file stored once and shared by identical attachments"""
+    __tablename__ = 'blobs'
+    __table_args__ = (
+        # Documents left 'indexing' by a dead worker, by claim time
+        db.Index('ix_blobs_text_status_claimed', 'text_status', 'text_claimed_at'),
+    )
+    
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    mime_type = db.Column(db.String(100), nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Text extraction of documents: 'pending', 'ready', 'failed' or 'unsupported'; NULL for images
+    text_status = db.Column(db.String(20), nullable=True)
+    text_claimed_at = db.Column(db.DateTime, nullable=True)  # when the indexing job claimed it
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Blob {self.sha256}>'
+
+class BlobChunk(db.Model):
+    """A passage of the text extracted from a document blob, with its term counts for BM25"""
+    __tablename__ = 'blob_chunks'
+    __table_args__ = (
+        db.Index('ix_blob_chunks_blob_position', 'blob_hash', 'position'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blobs.sha256', ondelete='CASCADE'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    terms = db.Column(db.Text, nullable=False)  # JSON {term: count}
+    length = db.Column(db.Integer, nullable=False)  # number of terms
+    tokens = db.Column(db.Integer, nullable=False)  # estimated prompt tokens
+
+    def __repr__(self):
+        return f'<BlobChunk {self.blob_hash}:{self.position}>'
+
 class Attachment(db.Model):
     """Model for file attachments in chat messages"""
     __tablename__ = 'attachments'
+    __table_args__ = (
+        db.Index('ix_attachments_user_created', 'user_id', 'created_at'),
+        db.Index('ix_attachments_message_id', 'message_id'),
+        db.Index('ix_attachments_blob_hash', 'blob_hash'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
@@ -114,6 +188,8 @@ class Attachment(db.Model):
     file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.Integer, nullable=False)
     mime_type = db.Column(db.String(100), nullable=False)
+    # Stored content; NULL for files uploaded before content addressing
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blobs.sha256'), nullable=True)
     message_id = db.Column(db.String(36), db.ForeignKey('chat_messages.id'), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -136,3 +212,27 @@ class Attachment(db.Model):
             'url': f'/api/attachments/{self.id}'
         }
 
+class Job(db.Model):
+    """Background task in the database-backed queue (see src/services/jobs.py)"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'done' or 'failed'
+    # Optional deduplication key: a second job with the same key is not enqueued
+    key = db.Column(db.String(200), nullable=True, unique=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name}>'
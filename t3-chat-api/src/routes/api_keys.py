@@ -1,10 +1,32 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from src.models.user import db, User, UserApiKey
+from src.services.cache import LRUCache
+from src.services import metrics, redis_client
 import base64
+import os
+import threading
 
 api_keys_bp = Blueprint('api_keys', __name__)
 
+# Cache in-process delle chiavi decodificate per (user_id, provider): evita una
+# query e un decode base64 a ogni messaggio. Il TTL limita quanto a lungo un
+# altro worker può vedere una chiave vecchia se l'invalidazione non gli arriva.
+API_KEY_CACHE_SIZE = int(os.environ.get('API_KEY_CACHE_SIZE', '10000'))
+API_KEY_CACHE_TTL = float(os.environ.get('API_KEY_CACHE_TTL', '300'))
+API_KEY_INVALIDATION_CHANNEL = 't3chat:api-keys:invalidate'
+
+_api_key_cache = LRUCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)
+_NO_KEY = ''  # segnaposto per ricordare anche l'assenza di una chiave
+metrics.register_cache('api_keys', _api_key_cache)
+
+# Generazione di ogni (user_id, provider), incrementata a ogni invalidazione:
+# una lettura dal database iniziata prima di un'invalidazione non rimette in
+# cache la chiave vecchia. _epoch fa lo stesso per lo svuotamento completo.
+_generations = {}
+_epoch = [0]
+_generations_lock = threading.Lock()
+
 @api_keys_bp.route('/api-keys', methods=['GET'])
 @jwt_required()
 def get_user_api_keys():
@@ -56,6 +78,7 @@ def add_api_key():
             db.session.add(new_key)
         
         db.session.commit()
+        invalidate_user_api_key(user_id, provider)
         
         return jsonify({
             'success': True,
@@ -83,6 +106,7 @@ def delete_api_key(key_id):
         
         api_key.is_active = False
         db.session.commit()
+        invalidate_user_api_key(user_id, api_key.provider)
         
         return jsonify({
             'success': True,
@@ -95,13 +119,47 @@ def delete_api_key(key_id):
 
 def get_user_api_key(user_id, provider):
     """Funzione helper per ottenere la chiave API di un utente per un provider specifico"""
+    cache_key = (int(user_id), provider)
+    api_key = _api_key_cache.get(cache_key)
+    if api_key is not None:
+        return api_key or None
+    
+    _subscribe_invalidations()
+    generation = (_epoch[0], _generations.get(cache_key, 0))
     api_key_record = UserApiKey.query.filter_by(
         user_id=user_id, 
         provider=provider, 
         is_active=True
     ).first()
     
+    api_key = _NO_KEY
     if api_key_record:
-        return base64.b64decode(api_key_record.api_key.encode()).decode()
-    return None
+        api_key = base64.b64decode(api_key_record.api_key.encode()).decode()
+    with _generations_lock:
+        if (_epoch[0], _generations.get(cache_key, 0)) == generation:
+            _api_key_cache.set(cache_key, api_key)
+    return api_key or None
+
+def invalidate_user_api_key(user_id, provider, broadcast=True):
+    """Rimuove dalla cache la chiave di un utente e avvisa gli altri worker"""
+    cache_key = (int(user_id), provider)
+    with _generations_lock:
+        _generations[cache_key] = _generations.get(cache_key, 0) + 1
+        _api_key_cache.pop(cache_key)
+    if broadcast:
+        message = {'user_id': int(user_id), 'provider': provider}
+        redis_client.publish(API_KEY_INVALIDATION_CHANNEL, message)
+
+def _invalidate_all():
+    with _generations_lock:
+        _epoch[0] += 1
+        _api_key_cache.clear()
 
+def _subscribe_invalidations():
+    # Le invalidazioni perse mentre Redis era irraggiungibile non arrivano più:
+    # alla riconnessione si svuota la cache
+    redis_client.subscribe(
+        API_KEY_INVALIDATION_CHANNEL,
+        lambda message: invalidate_user_api_key(message['user_id'], message['provider'], broadcast=False),
+        on_reconnect=_invalidate_all
+    )
@@ -1,19 +1,91 @@
-from flask import Blueprint, request, jsonify, send_file, current_app
+from flask import Blueprint, request, jsonify, send_file, current_app, Response
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from werkzeug.utils import secure_filename
 from src.models.user import db, User, Attachment, ChatMessage
+from src.services import blob_store, documents, garbage, jobs, metrics, upload_ingest
 import os
-import uuid
 from datetime import datetime
 
 attachments_bp = Blueprint('attachments', __name__)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'pdf', 'txt', 'md', 'doc', 'docx'}
 
+# How attachment bodies are sent: '' by the worker (sendfile under gunicorn),
+# 'x-accel-redirect' by nginx or 'x-sendfile' by Apache/lighttpd
+ATTACHMENT_OFFLOAD = os.environ.get('ATTACHMENT_OFFLOAD', '').lower()
+# Internal nginx location aliased to UPLOAD_FOLDER
+ATTACHMENT_ACCEL_PREFIX = os.environ.get('ATTACHMENT_ACCEL_PREFIX', '/protected-uploads/')
+# Attachment contents are immutable, but only visible to their owner
+ATTACHMENT_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_attachment(user_id, original_filename, sha256, file_size, tmp_path, mime_type):
+    """Store an uploaded file under its SHA-256 and create its Attachment row"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    file_extension = original_filename.rsplit('.', 1)[1].lower()
+    file_path = blob_store.store_temp(upload_folder, sha256, tmp_path)
+    blob_store.acquire(sha256, file_size, mime_type)
+    
+    # Create attachment record; unlinked ones are deleted by the GC after
+    # ATTACHMENT_ORPHAN_TTL
+    attachment = Attachment(
+        filename=f"{sha256}.{file_extension}",
+        original_filename=original_filename,
+        file_path=file_path,
+        file_size=file_size,
+        mime_type=mime_type,
+        blob_hash=sha256,
+        message_id=None,  # Set when a message is sent with it
+        user_id=user_id
+    )
+    
+    db.session.add(attachment)
+    if mime_type in documents.DOCUMENT_TYPES:
+        documents.mark_pending(sha256)
+    db.session.commit()
+    
+    if mime_type in documents.DOCUMENT_TYPES:
+        kind = 'document'
+    elif mime_type.startswith('image/'):
+        kind = 'image'
+    else:
+        kind = 'other'
+    metrics.upload_bytes.inc(kind, amount=file_size)
+    metrics.upload_size.observe(file_size)
+    
+    # Text extraction and image resizing run in background jobs, so the
+    # upload returns as soon as the file is stored (both skip content that
+    # was already processed)
+    if mime_type in documents.DOCUMENT_TYPES:
+        jobs.enqueue('index_document', {'sha256': sha256, 'path': file_path, 'mime_type': mime_type})
+    elif mime_type.startswith('image/'):
+        # Resized and encoded for every provider, so sending a message with
+        # the image does no image decoding
+        jobs.enqueue('precompute_image_payloads', {'sha256': sha256, 'path': file_path})
+    
+    return attachment
+
+def ingest_upload(user_id, filename, stream):
+    """Stream an upload to disk in fixed-size chunks, validating it on the way.
+
+    The type is sniffed from the first chunk and the quota checked after each
+    one, so a rejected file is dropped before the rest of it is read.
+    """
+    if not filename or not allowed_file(filename):
+        raise upload_ingest.UploadError('File type not allowed', 400)
+    original_filename = secure_filename(filename)
+    file_extension = original_filename.rsplit('.', 1)[1].lower()
+    
+    guard = upload_ingest.guard_for(user_id, file_extension, current_app.config['MAX_CONTENT_LENGTH'])
+    sha256, file_size, tmp_path = blob_store.write_temp(stream, current_app.config['UPLOAD_FOLDER'], on_chunk=guard)
+    if guard.mime_type is None:
+        blob_store.discard_temp(tmp_path)
+        raise upload_ingest.UploadError('Empty file', 400)
+    return save_attachment(user_id, original_filename, sha256, file_size, tmp_path, guard.mime_type)
+
 @attachments_bp.route('/upload', methods=['POST'])
 @jwt_required()
 def upload_file():
@@ -31,45 +103,125 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'File type not allowed'}), 400
+        attachment = ingest_upload(int(user_id), file.filename, file.stream)
+        
+        return jsonify({
+            'success': True,
+            'attachment': attachment.to_dict()
+        })
+        
+    except upload_ingest.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Upload error: {e}")
+        return jsonify({'error': 'Upload failed'}), 500
 
-        # Generate unique filename
-        original_filename = secure_filename(file.filename)
-        file_extension = original_filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        
-        # Save file
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
-        
-        # Get file info
-        file_size = os.path.getsize(file_path)
-        mime_type = file.content_type or 'application/octet-stream'
-        
-        # Create attachment record (without message_id for now)
-        attachment = Attachment(
-            filename=unique_filename,
-            original_filename=original_filename,
-            file_path=file_path,
-            file_size=file_size,
-            mime_type=mime_type,
-            message_id=0,  # Will be updated when message is created
-            user_id=int(user_id)
+@attachments_bp.route('/upload/stream', methods=['POST', 'PUT'])
+@jwt_required()
+def upload_stream():
+    """Upload the raw request body (?filename=...), without multipart buffering"""
+    try:
+        user_id = get_jwt_identity()
+        attachment = ingest_upload(int(user_id), request.args.get('filename', ''), request.stream)
+        
+        return jsonify({
+            'success': True,
+            'attachment': attachment.to_dict()
+        })
+        
+    except upload_ingest.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Upload error: {e}")
+        return jsonify({'error': 'Upload failed'}), 500
+
+@attachments_bp.route('/uploads', methods=['POST'])
+@jwt_required()
+def create_resumable_upload():
+    """Start a resumable upload: {filename, size}"""
+    try:
+        user_id = int(get_jwt_identity())
+        data = request.get_json() or {}
+        filename = data.get('filename', '')
+        if not allowed_file(filename):
+            return jsonify({'error': 'File type not allowed'}), 400
+        
+        filename = secure_filename(filename)
+        meta = upload_ingest.create_resumable(
+            current_app.config['UPLOAD_FOLDER'], user_id, filename,
+            filename.rsplit('.', 1)[1].lower(), int(data.get('size') or 0)
         )
         
-        db.session.add(attachment)
-        db.session.commit()
+        return jsonify({
+            'success': True,
+            'upload_id': meta['id'],
+            'offset': 0,
+            'size': meta['size']
+        }), 201
+        
+    except upload_ingest.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Upload error: {e}")
+        return jsonify({'error': 'Upload failed'}), 500
+
+@attachments_bp.route('/uploads/<upload_id>', methods=['GET', 'HEAD'])
+@jwt_required()
+def get_resumable_upload(upload_id):
+    """Current offset of a resumable upload, to resume after a failure"""
+    meta = upload_ingest.load_resumable(current_app.config['UPLOAD_FOLDER'], upload_id, int(get_jwt_identity()))
+    if not meta:
+        return jsonify({'error': 'Upload not found'}), 404
+    response = jsonify({'upload_id': upload_id, 'offset': meta['offset'], 'size': meta['size']})
+    response.headers['Upload-Offset'] = str(meta['offset'])
+    return response
+
+@attachments_bp.route('/uploads/<upload_id>', methods=['PATCH'])
+@jwt_required()
+def append_resumable_upload(upload_id):
+    """Append the request body at the Upload-Offset header; completes the upload at the last byte"""
+    try:
+        user_id = int(get_jwt_identity())
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        meta = upload_ingest.load_resumable(upload_folder, upload_id, user_id)
+        if not meta:
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'error': 'Upload-Offset header is required'}), 400
+        
+        offset = upload_ingest.append_resumable(upload_folder, meta, offset, request.stream)
+        if offset < meta['size']:
+            response = jsonify({'upload_id': upload_id, 'offset': offset, 'size': meta['size']})
+            response.headers['Upload-Offset'] = str(offset)
+            return response
+        
+        sha256, file_size, data_path = upload_ingest.finish_resumable(upload_folder, meta)
+        attachment = save_attachment(user_id, meta['filename'], sha256, file_size, data_path, meta['mime_type'])
         
         return jsonify({
             'success': True,
             'attachment': attachment.to_dict()
         })
         
+    except upload_ingest.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         print(f"Upload error: {e}")
         return jsonify({'error': 'Upload failed'}), 500
 
+@attachments_bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_resumable_upload(upload_id):
+    """Cancel a resumable upload and drop the received bytes"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    if not upload_ingest.load_resumable(upload_folder, upload_id, int(get_jwt_identity())):
+        return jsonify({'error': 'Upload not found'}), 404
+    upload_ingest.discard_resumable(upload_folder, upload_id)
+    return jsonify({'success': True})
+
 @attachments_bp.route('/<int:attachment_id>', methods=['GET'])
 @jwt_required()
 def get_attachment(attachment_id):
@@ -85,15 +237,43 @@ def get_attachment(attachment_id):
         if not attachment:
             return jsonify({'error': 'Attachment not found'}), 404
             
+        # Content-addressed files never change: the hash is a strong ETag and
+        # a revalidation costs no disk access
+        etag = attachment.blob_hash
+        if etag and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = ATTACHMENT_CACHE_CONTROL
+            return response
+            
         if not os.path.exists(attachment.file_path):
             return jsonify({'error': 'File not found on disk'}), 404
-            
-        return send_file(
-            attachment.file_path,
-            as_attachment=False,
-            download_name=attachment.original_filename,
-            mimetype=attachment.mime_type
-        )
+        
+        if ATTACHMENT_OFFLOAD in ('x-accel-redirect', 'x-sendfile'):
+            # The fronting proxy reads the file (with ranges) and the worker
+            # only sends the headers
+            response = Response(mimetype=attachment.mime_type)
+            if ATTACHMENT_OFFLOAD == 'x-accel-redirect':
+                relative_path = os.path.relpath(attachment.file_path, current_app.config['UPLOAD_FOLDER'])
+                response.headers['X-Accel-Redirect'] = ATTACHMENT_ACCEL_PREFIX + relative_path.replace(os.sep, '/')
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(attachment.file_path)
+            response.headers['Content-Disposition'] = f'inline; filename="{attachment.original_filename}"'
+        else:
+            # Range and If-None-Match are handled by send_file; full bodies
+            # go through wsgi.file_wrapper, i.e. sendfile() under gunicorn
+            response = send_file(
+                attachment.file_path,
+                as_attachment=False,
+                download_name=attachment.original_filename,
+                mimetype=attachment.mime_type,
+                etag=etag or True,
+                conditional=True
+            )
+        if etag:
+            response.set_etag(etag)
+        response.headers['Cache-Control'] = ATTACHMENT_CACHE_CONTROL
+        return response
         
     except Exception as e:
         print(f"Download error: {e}")
@@ -114,13 +294,8 @@ def delete_attachment(attachment_id):
         if not attachment:
             return jsonify({'error': 'Attachment not found'}), 404
             
-        # Delete file from disk
-        if os.path.exists(attachment.file_path):
-            os.remove(attachment.file_path)
-            
-        # Delete from database
-        db.session.delete(attachment)
-        db.session.commit()
+        # Shared content is only removed with its last attachment
+        garbage.delete_attachments(current_app.config['UPLOAD_FOLDER'], [attachment])
         
         return jsonify({'success': True})
         
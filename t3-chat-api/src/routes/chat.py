@@ -1,23 +1,100 @@
-from flask import Blueprint, request, jsonify, Response
+from flask import Blueprint, request, jsonify, Response, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
 import uuid
+import threading
+import time
 import json
+import base64
 from datetime import datetime
+from sqlalchemy import and_, or_
 from src.models.user import db, User, ChatSession, ChatMessage, Attachment
+from src.routes.api_keys import get_user_api_key
 from src.services.ai_service import AIService
+from src.services.provider_router import provider_router, MODELS
+from src.services.context_builder import build_context, forget_session, estimate_tokens
+from src.services.stream_checkpoint import StreamCheckpointer, abort_stale_streams, STATUS_STREAMING, STATUS_COMPLETE, STATUS_ABORTED
+from src.services.stream_buffer import stream_registry, STREAM_RESUME_GRACE_SECONDS
+from src.services.response_cache import response_cache, replay
+from src.services.documents import with_document_context
+from src.services.search import search_messages
+from src.services.rate_limit import rate_limiter, RateLimited
+from src.services import jobs, metrics
+from src.services.tasks import placeholder_title, title_tokens
 
 chat_bp = Blueprint('chat', __name__)
 
+PREVIEW_LENGTH = 200
+DEFAULT_SESSIONS_PAGE_SIZE = 50
+DEFAULT_MESSAGES_PAGE_SIZE = 100
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 500
+
+def record_session_messages(session_id, last_text, count):
+    """Update the denormalized message counters of a session in one statement"""
+    now = datetime.utcnow()
+    ChatSession.query.filter_by(id=session_id).update({
+        ChatSession.message_count: ChatSession.message_count + count,
+        ChatSession.last_message_at: now,
+        ChatSession.last_message_preview: last_text[:PREVIEW_LENGTH],
+        ChatSession.updated_at: now
+    }, synchronize_session=False)
+
+def encode_cursor(timestamp, row_id):
+    """Opaque keyset cursor for a (timestamp, id) position"""
+    raw = json.dumps([timestamp.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on malformed cursors"""
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.fromisoformat(timestamp), row_id
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def enqueue_title(session_id, user_id, model, message, placeholder):
+    """Generate the title of a new session in the background; it replaces
+    the placeholder unless the title was changed in the meantime"""
+    provider = AIService.provider_for(model)
+    if provider is None or not get_user_api_key(int(user_id), provider):
+        # The job could only fail: the placeholder stays
+        return
+    # Charged here rather than in the job: without Redis the rate limits are
+    # per process, and the job worker has its own
+    rate_limiter.charge_user(user_id, provider, title_tokens(message))
+    jobs.enqueue('generate_title', {
+        'session_id': session_id,
+        'user_id': int(user_id),
+        'model': model,
+        'message': message,
+        'placeholder': placeholder
+    })
+
+def page_size(default):
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def before_position(timestamp_column, id_column, cursor):
+    """Keyset condition selecting rows strictly older than the cursor position"""
+    timestamp, row_id = decode_cursor(cursor)
+    return or_(
+        timestamp_column < timestamp,
+        and_(timestamp_column == timestamp, id_column < row_id)
+    )
+
+def rate_limited_response(error):
+    """429 with Retry-After for a request rejected by the rate limiter"""
+    response = jsonify({'error': 'Too many requests', 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @chat_bp.route('/chat/send', methods=['POST'])
 @jwt_required()
 def send_message():
+    admission = None
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(int(user_id))
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
         data = request.get_json()
         message = data.get('message', '').strip()
         model = data.get('model', 'Gemini 2.5 Flash')
@@ -27,6 +104,13 @@ def send_message():
         if not message:
             return jsonify({'error': 'Message is required'}), 400
         
+        # Admission control before any query: a rejected request costs nothing
+        admission = rate_limiter.admit(user_id, AIService.provider_for(model), estimate_tokens(message))
+        
+        user = User.query.get(int(user_id))
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        
         # Get attachments if provided
         attachments = []
         if attachment_ids:
@@ -36,19 +120,28 @@ def send_message():
             ).all()
         
         # Create or get session
+        history = []
+        new_session = not session_id
         if session_id:
             session = ChatSession.query.filter_by(id=session_id, user_id=user_id).first()
             if not session:
                 return jsonify({'error': 'Session not found'}), 404
+            # An empty session from /chat/new is titled after its first message
+            new_session = session.message_count == 0
+            # Answers left 'streaming' by a dead worker would stay so forever
+            abort_stale_streams(session_id)
+            # Load history within the token budget, before the new message is added
+            history = build_context(session_id)
         else:
             # Create new session
             session_id = str(uuid.uuid4())
             session = ChatSession(
                 id=session_id,
                 user_id=user_id,
-                title=message[:50] + '...' if len(message) > 50 else message
+                title=placeholder_title(message)
             )
             db.session.add(session)
+        title = session.title
         
         # Add user message
         user_message = ChatMessage(
@@ -60,8 +153,20 @@ def send_message():
         )
         db.session.add(user_message)
         
-        # Generate AI response using real APIs with attachments
-        ai_response_text = AIService.get_ai_response(int(user_id), model, message, attachments)
+        # Link attachments to message
+        for attachment in attachments:
+            attachment.message_id = user_message.id
+        
+        # Serve repeated prompts from the response cache (opt-in), otherwise
+        # generate the AI response using real APIs with attachments
+        cache_scope = response_cache.scope(user_id, model, attachments, history)
+        ai_response_text = response_cache.lookup(cache_scope, message)
+        if ai_response_text is None:
+            # Documents contribute only their passages relevant to the message
+            prompt = with_document_context(message, attachments)
+            ai_response_text = AIService.get_ai_response(int(user_id), model, prompt, attachments, history)
+            response_cache.store(cache_scope, message, ai_response_text)
+            rate_limiter.charge(admission, estimate_tokens(ai_response_text))
         
         ai_message = ChatMessage(
             id=str(uuid.uuid4()),
@@ -72,11 +177,14 @@ def send_message():
         )
         db.session.add(ai_message)
         
-        # Update session timestamp
-        session.updated_at = datetime.utcnow()
+        # Update session timestamp and counters
+        record_session_messages(session_id, ai_message.text, 2)
         
         db.session.commit()
         
+        if new_session:
+            enqueue_title(session_id, user_id, model, message, title)
+        
         return jsonify({
             'success': True,
             'session_id': session_id,
@@ -84,21 +192,43 @@ def send_message():
             'ai_message': ai_message.to_dict()
         })
         
+    except RateLimited as e:
+        return rate_limited_response(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    finally:
+        if admission is not None:
+            rate_limiter.release(admission)
 
 @chat_bp.route('/chat/sessions', methods=['GET'])
 @jwt_required()
 def get_chat_sessions():
     try:
         user_id = get_jwt_identity()
-        sessions = ChatSession.query.filter_by(user_id=int(user_id)).order_by(ChatSession.updated_at.desc()).all()
+        limit = page_size(DEFAULT_SESSIONS_PAGE_SIZE)
+        
+        # Keyset pagination on (updated_at, id), newest first
+        query = ChatSession.query.filter_by(user_id=int(user_id))
+        before = request.args.get('before')
+        if before:
+            query = query.filter(before_position(ChatSession.updated_at, ChatSession.id, before))
+        sessions = query.order_by(ChatSession.updated_at.desc(), ChatSession.id.desc()).limit(limit + 1).all()
+        
+        has_more = len(sessions) > limit
+        sessions = sessions[:limit]
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor(sessions[-1].updated_at, sessions[-1].id)
         
         return jsonify({
             'success': True,
-            'sessions': [session.to_dict() for session in sessions]
+            'sessions': [session.to_dict() for session in sessions],
+            'has_more': has_more,
+            'next_cursor': next_cursor
         })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -113,12 +243,56 @@ def get_messages(session_id):
         if not session:
             return jsonify({'error': 'Session not found'}), 404
         
-        messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.created_at.asc()).all()
+        limit = page_size(DEFAULT_MESSAGES_PAGE_SIZE)
+        
+        # Keyset pagination on (created_at, id): the latest page first, then
+        # "load older" pages through the `before` cursor
+        query = ChatMessage.query.filter_by(session_id=session_id)
+        before = request.args.get('before')
+        if before:
+            query = query.filter(before_position(ChatMessage.created_at, ChatMessage.id, before))
+        messages = query.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit + 1).all()
+        
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        messages.reverse()
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor(messages[0].created_at, messages[0].id)
+        
+        return jsonify({
+            'success': True,
+            'messages': [message.to_dict() for message in messages],
+            'has_more': has_more,
+            'next_cursor': next_cursor
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_bp.route('/chat/search', methods=['GET'])
+@jwt_required()
+def search_chat_messages():
+    try:
+        user_id = get_jwt_identity()
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'Query is required'}), 400
+        
+        # Ranked by relevance; `cursor` continues from the previous page
+        results, next_cursor = search_messages(
+            int(user_id), query, page_size(DEFAULT_SEARCH_PAGE_SIZE), request.args.get('cursor')
+        )
         
         return jsonify({
             'success': True,
-            'messages': [message.to_dict() for message in messages]
+            'results': results,
+            'has_more': next_cursor is not None,
+            'next_cursor': next_cursor
         })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -158,6 +332,7 @@ def delete_session(session_id):
         
         db.session.delete(session)
         db.session.commit()
+        forget_session(session_id)
         
         return jsonify({
             'success': True,
@@ -167,33 +342,118 @@ def delete_session(session_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@chat_bp.route('/chat/cache/stats', methods=['GET'])
+@jwt_required()
+def get_response_cache_stats():
+    """Hit rate and size of the AI response cache"""
+    return jsonify({'success': True, 'stats': response_cache.stats()})
+
+@chat_bp.route('/providers/stats', methods=['GET'])
+@jwt_required()
+def get_provider_stats():
+    """Circuit breaker state of each AI provider in this worker"""
+    return jsonify({'success': True, 'providers': provider_router.stats()})
+
 @chat_bp.route('/models', methods=['GET'])
 def get_models():
     try:
-        models = [
-            'Gemini 2.5 Flash',
-            'GPT-4o',
-            'Claude 3.5 Sonnet',
-            'DeepSeek V3'
-        ]
+        # Each model lists the models tried, in order, when its provider fails
         return jsonify({
             'success': True,
-            'models': models
+            'models': list(MODELS),
+            'fallbacks': MODELS
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def produce_stream(app, ai_message_id, session_id, message, model, user, attachments, history, admission):
+    """Pull the AI response and publish it as numbered events in the stream buffer.
+
+    Runs apart from the HTTP response, so a client that drops can reconnect
+    with Last-Event-ID and keep reading the same generation. The provider is
+    only cancelled when no client has read the stream for the grace period.
+    """
+    started = time.perf_counter()
+    with app.app_context():
+        checkpointer = StreamCheckpointer(
+            ai_message_id,
+            on_flush=lambda event_id, text: stream_registry.snapshot(ai_message_id, event_id, text)
+        )
+        cached = None
+        upstream = None
+        status = STATUS_ABORTED
+        metrics.active_streams.inc()
+        # Setup errors too must release the admission and close the message
+        try:
+            # A cached answer is replayed as a fast stream instead of calling the provider
+            cache_scope = response_cache.scope(user.id, model, attachments, history)
+            cached = response_cache.lookup(cache_scope, message)
+            if cached is not None:
+                upstream = replay(cached)
+            else:
+                # Documents contribute only their passages relevant to the message
+                prompt = with_document_context(message, attachments)
+                upstream = AIService.get_streaming_response(prompt, model, user, attachments, history)
+            for chunk in upstream:
+                event_id = stream_registry.publish(ai_message_id, {'content': chunk})
+                checkpointer.append(chunk, event_id)
+                if stream_registry.idle_seconds(ai_message_id) > STREAM_RESUME_GRACE_SECONDS:
+                    # Nobody came back for this answer: stop pulling tokens
+                    break
+            else:
+                status = STATUS_COMPLETE
+                if cached is None:
+                    response_cache.store(cache_scope, message, checkpointer.text)
+        except Exception as e:
+            stream_registry.publish(ai_message_id, {'error': str(e)})
+        finally:
+            if upstream is not None:
+                upstream.close()
+                if cached is None:
+                    rate_limiter.charge(admission, estimate_tokens(checkpointer.text))
+            rate_limiter.release(admission)
+            metrics.active_streams.dec()
+            metrics.stream_duration.observe(time.perf_counter() - started, status)
+            # Save the final (or partial) AI message
+            try:
+                record_session_messages(session_id, checkpointer.text, 1)
+                checkpointer.finish(status)
+            except Exception:
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+            # Send completion signal
+            if status == STATUS_COMPLETE:
+                stream_registry.finish(ai_message_id, {'done': True, 'message_id': ai_message_id, 'session_id': session_id})
+            else:
+                stream_registry.finish(ai_message_id, {'status': status, 'message_id': ai_message_id})
+
+def sse_response(ai_message_id, last_event_id):
+    """Stream the buffered events after last_event_id, then follow the live ones"""
+    def generate_stream():
+        for event_id, payload in stream_registry.subscribe(ai_message_id, last_event_id):
+            yield f"id: {event_id}\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(
+        generate_stream(),
+        mimetype='text/plain',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive',
+            'Content-Type': 'text/event-stream',
+            'X-Accel-Buffering': 'no',
+            'X-Message-Id': ai_message_id
+        }
+    )
+
 @chat_bp.route('/chat/stream', methods=['POST'])
 @jwt_required()
 def stream_message():
+    admission = None
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(int(user_id))
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
         data = request.get_json()
         message = data.get('message', '').strip()
         model = data.get('model', 'Gemini 2.5 Flash')
@@ -203,6 +463,14 @@ def stream_message():
         if not message:
             return jsonify({'error': 'Message is required'}), 400
         
+        # Admission control before any query: a client over its limits gets a
+        # 429 without touching the database or holding a stream open
+        admission = rate_limiter.admit(user_id, AIService.provider_for(model), estimate_tokens(message))
+        
+        user = User.query.get(int(user_id))
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        
         # Get attachments if provided
         attachments = []
         if attachment_ids:
@@ -212,69 +480,118 @@ def stream_message():
             ).all()
         
         # Create or get session
+        history = []
+        new_session = not session_id
         if session_id:
             session = ChatSession.query.filter_by(id=session_id, user_id=user_id).first()
             if not session:
                 return jsonify({'error': 'Session not found'}), 404
+            # An empty session from /chat/new is titled after its first message
+            new_session = session.message_count == 0
+            # Answers left 'streaming' by a dead worker would stay so forever
+            abort_stale_streams(session_id)
+            # Load history within the token budget, before the new message is added
+            history = build_context(session_id)
         else:
             # Create new session
             session_id = str(uuid.uuid4())
             session = ChatSession(
                 id=session_id,
                 user_id=user_id,
-                title=message[:50] + '...' if len(message) > 50 else message
+                title=placeholder_title(message)
             )
             db.session.add(session)
+        title = session.title
         
         # Save user message
         user_message = ChatMessage(
+            id=str(uuid.uuid4()),
             session_id=session_id,
             text=message,
             sender='user'
         )
         db.session.add(user_message)
+        record_session_messages(session_id, message, 1)
         
         # Link attachments to message
         for attachment in attachments:
             attachment.message_id = user_message.id
         
+        # Create the AI message up front: its text is checkpointed while
+        # streaming, so a disconnect or a crash keeps the partial answer
+        ai_message_id = str(uuid.uuid4())
+        db.session.add(ChatMessage(
+            id=ai_message_id,
+            session_id=session_id,
+            text='',
+            sender='ai',
+            model=model,
+            status=STATUS_STREAMING
+        ))
+        
         db.session.commit()
         
-        def generate_stream():
-            try:
-                ai_service = AIService()
-                
-                # Get AI response with streaming
-                full_response = ""
-                for chunk in ai_service.get_streaming_response(message, model, user, attachments):
-                    full_response += chunk
-                    yield f"data: {json.dumps({'content': chunk})}\n\n"
-                
-                # Save AI message
-                ai_message = ChatMessage(
-                    session_id=session_id,
-                    text=full_response,
-                    sender='ai'
-                )
-                db.session.add(ai_message)
-                db.session.commit()
-                
-                # Send completion signal
-                yield f"data: {json.dumps({'done': True, 'message_id': ai_message.id, 'session_id': session_id})}\n\n"
-                
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        
-        return Response(
-            generate_stream(),
-            mimetype='text/plain',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Content-Type': 'text/event-stream'
-            }
-        )
+        if new_session:
+            enqueue_title(session_id, user_id, model, message, title)
         
+        # A stream can last minutes: load what it needs now and give the
+        # connection back to the pool, so thousands of open streams don't
+        # exhaust the database connections.
+        db.session.refresh(user)
+        for attachment in attachments:
+            db.session.refresh(attachment)
+        db.session.close()
+        
+        stream_registry.open(ai_message_id)
+        threading.Thread(
+            target=produce_stream,
+            args=(current_app._get_current_object(), ai_message_id, session_id, message, model, user, attachments, history, admission),
+            daemon=True
+        ).start()
+        # Released by produce_stream when the generation ends
+        admission = None
+        
+        return sse_response(ai_message_id, 0)
+        
+    except RateLimited as e:
+        return rate_limited_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if admission is not None:
+            rate_limiter.release(admission)
+
 
+@chat_bp.route('/chat/stream/<message_id>', methods=['GET'])
+@jwt_required()
+def resume_stream(message_id):
+    """Reconnect to a streamed answer, replaying the events after Last-Event-ID"""
+    try:
+        user_id = get_jwt_identity()
+        ai_message = ChatMessage.query.join(ChatSession).filter(
+            ChatMessage.id == message_id,
+            ChatSession.user_id == int(user_id)
+        ).first()
+        
+        if not ai_message:
+            return jsonify({'error': 'Message not found'}), 404
+        
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+        
+        if stream_registry.exists(message_id):
+            db.session.close()
+            return sse_response(message_id, last_event_id)
+        
+        # The buffer is gone (expired, or kept by another worker without Redis):
+        # fall back to the text checkpointed in the database
+        return jsonify({
+            'message': ai_message.to_dict(),
+            'resumable': False
+        }), 200 if ai_message.status != STATUS_STREAMING else 409
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
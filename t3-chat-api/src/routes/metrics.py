@@ -0,0 +1,18 @@
+import hmac
+from flask import Blueprint, Response, request, jsonify
+from src.services import metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of the metrics in src/services/metrics.py"""
+    try:
+        if metrics.METRICS_TOKEN:
+            expected = f'Bearer {metrics.METRICS_TOKEN}'
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+                return jsonify({'error': 'Unauthorized'}), 401
+
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
@@ -1,10 +1,18 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 from src.models.user import User, db
+from src.services.passwords import PasswordHasherBusy
 import uuid
 
 user_bp = Blueprint('user', __name__)
 
+def hasher_busy_response(error):
+    """503 with Retry-After when too many password hashes are queued"""
+    response = jsonify({'error': 'Server busy, please retry', 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @user_bp.route('/auth/register', methods=['POST'])
 def register():
     try:
@@ -44,6 +52,9 @@ def register():
             'user': user.to_dict()
         }), 201
         
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return hasher_busy_response(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -66,6 +77,15 @@ def login():
         if not user or not user.check_password(password):
             return jsonify({'error': 'Invalid username or password'}), 401
         
+        # BCRYPT_ROUNDS changed since the password was set: store a new hash
+        if user.password_needs_rehash():
+            try:
+                user.set_password(password)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Password rehash error for user {user.id}: {e}")
+        
         # Create access token
         access_token = create_access_token(identity=str(user.id))
         
@@ -76,6 +96,8 @@ def login():
             'user': user.to_dict()
         })
         
+    except PasswordHasherBusy as e:
+        return hasher_busy_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
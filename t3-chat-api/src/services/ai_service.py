@@ -1,13 +1,35 @@
-import openai
-import anthropic
-import google.generativeai as genai
+import base64
+from flask import current_app
 from src.routes.api_keys import get_user_api_key
+from src.services.client_pool import client_pool, PROVIDER_READ_TIMEOUT
+from src.services.context_builder import to_anthropic_messages, to_google_contents
+from src.services.image_payloads import image_payload
+from src.services.provider_router import provider_router, upstream, MODELS, PROVIDER_NAMES
+from src.services.response_cache import attachment_digest
 
 class AIService:
     """Servizio per gestire le chiamate alle API AI reali"""
     
     @staticmethod
-    def get_ai_response(user_id, model, message, attachments=None):
+    def _image_payloads(attachments, provider):
+        """(mime_type, base64) delle immagini allegate, già ridimensionate per il provider.
+
+        I payload sono calcolati al caricamento e letti dalla cache su disco:
+        qui non si decodifica nessuna immagine.
+        """
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        for attachment in attachments or []:
+            if attachment.mime_type.startswith('image/'):
+                try:
+                    digest = attachment_digest(attachment)
+                    if digest is None:
+                        raise FileNotFoundError(attachment.file_path)
+                    yield image_payload(upload_folder, digest, attachment.file_path, provider)
+                except Exception as e:
+                    print(f"Error processing image {attachment.filename}: {e}")
+    
+    @staticmethod
+    def get_ai_response(user_id, model, message, attachments=None, history=None):
         """Ottieni risposta AI utilizzando le chiavi API dell'utente - VERSIONE TEST"""
         try:
             # Per demo purposes, return a mock response with code examples
@@ -37,16 +59,14 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             return f"Errore nell'ottenere risposta da {model}: {str(e)}"
     
     @staticmethod
-    def _get_openai_response(user_id, model, message, attachments=None):
+    def _get_openai_response(user_id, model, message, attachments=None, history=None):
         """Chiamata API OpenAI con supporto per immagini"""
         api_key = get_user_api_key(user_id, 'openai')
         if not api_key:
             return "⚠️ Chiave API OpenAI non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
         
         try:
-            import openai
-            import base64
-            client = openai.OpenAI(api_key=api_key)
+            client = client_pool.get('openai', api_key)
             
             # Mappa i nomi dei modelli
             model_map = {
@@ -63,23 +83,17 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             
             # Aggiungi immagini se presenti e il modello le supporta
             if attachments and model_name in ['gpt-4o', 'gpt-4-vision-preview']:
-                for attachment in attachments:
-                    if attachment.mime_type.startswith('image/'):
-                        try:
-                            with open(attachment.file_path, 'rb') as img_file:
-                                img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                                content.append({
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:{attachment.mime_type};base64,{img_data}"
-                                    }
-                                })
-                        except Exception as e:
-                            print(f"Error processing image {attachment.filename}: {e}")
+                for mime_type, img_data in AIService._image_payloads(attachments, 'openai'):
+                    content.append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{img_data}"
+                        }
+                    })
             
             response = client.chat.completions.create(
                 model=model_name,
-                messages=[
+                messages=list(history or []) + [
                     {"role": "user", "content": content if len(content) > 1 else message}
                 ],
                 max_tokens=1000
@@ -91,14 +105,14 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             return f"Errore OpenAI: {str(e)}"
     
     @staticmethod
-    def _get_anthropic_response(user_id, model, message, attachments=None):
+    def _get_anthropic_response(user_id, model, message, attachments=None, history=None):
         """Chiamata API Anthropic (Claude)"""
         api_key = get_user_api_key(user_id, 'anthropic')
         if not api_key:
             return "⚠️ Chiave API Anthropic non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
         
         try:
-            client = anthropic.Anthropic(api_key=api_key)
+            client = client_pool.get('anthropic', api_key)
             
             # Mappa i nomi dei modelli
             model_map = {
@@ -113,7 +127,7 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             response = client.messages.create(
                 model=model_name,
                 max_tokens=1000,
-                messages=[
+                messages=to_anthropic_messages(history or []) + [
                     {"role": "user", "content": message}
                 ]
             )
@@ -124,15 +138,13 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             return f"Errore Anthropic: {str(e)}"
     
     @staticmethod
-    def _get_google_response(user_id, model, message, attachments=None):
+    def _get_google_response(user_id, model, message, attachments=None, history=None):
         """Chiamata API Google (Gemini)"""
         api_key = get_user_api_key(user_id, 'google')
         if not api_key:
             return "⚠️ Chiave API Google non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
         
         try:
-            genai.configure(api_key=api_key)
-            
             # Mappa i nomi dei modelli
             model_map = {
                 'Gemini 2.5 Flash': 'gemini-2.0-flash-exp',
@@ -143,8 +155,10 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             
             model_name = model_map.get(model, 'gemini-2.0-flash-exp')
             
-            model_instance = genai.GenerativeModel(model_name)
-            response = model_instance.generate_content(message)
+            model_instance = client_pool.google_model(api_key, model_name)
+            response = model_instance.generate_content(
+                to_google_contents(history or []) + [{'role': 'user', 'parts': [message]}]
+            )
             
             return response.text
             
@@ -152,21 +166,18 @@ This demonstrates both code blocks and inline code formatting with proper syntax
             return f"Errore Google: {str(e)}"
     
     @staticmethod
-    def _get_deepseek_response(user_id, model, message, attachments=None):
+    def _get_deepseek_response(user_id, model, message, attachments=None, history=None):
         """Chiamata API DeepSeek (compatibile OpenAI)"""
         api_key = get_user_api_key(user_id, 'deepseek')
         if not api_key:
             return "⚠️ Chiave API DeepSeek non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
         
         try:
-            client = openai.OpenAI(
-                api_key=api_key,
-                base_url="https://api.deepseek.com"
-            )
+            client = client_pool.get('deepseek', api_key)
             
             response = client.chat.completions.create(
                 model="deepseek-chat",
-                messages=[
+                messages=list(history or []) + [
                     {"role": "user", "content": message}
                 ],
                 max_tokens=1000,
@@ -181,178 +192,163 @@ This demonstrates both code blocks and inline code formatting with proper syntax
 
     
     @staticmethod
-    def get_streaming_response(message, model, user, attachments=None):
-        """Ottieni risposta AI in streaming utilizzando le chiavi API dell'utente"""
-        try:
-            if model.startswith('gpt') or model.startswith('GPT'):
-                yield from AIService._get_openai_streaming_response(user.id, model, message, attachments)
-            elif model.startswith('claude') or model.startswith('Claude'):
-                yield from AIService._get_anthropic_streaming_response(user.id, model, message, attachments)
-            elif model.startswith('gemini') or model.startswith('Gemini'):
-                yield from AIService._get_google_streaming_response(user.id, model, message, attachments)
-            elif model.startswith('deepseek') or model.startswith('DeepSeek'):
-                yield from AIService._get_deepseek_streaming_response(user.id, model, message, attachments)
-            else:
-                # Simulated streaming for unsupported models
-                response = f"Risposta simulata da {model}: {message}"
-                for word in response.split():
-                    yield word + " "
-                    
-        except Exception as e:
-            yield f"Errore nell'ottenere risposta da {model}: {str(e)}"
+    def provider_for(model):
+        """Provider che serve il modello, oppure None (risposta simulata)"""
+        for prefixes, provider in ((('gpt', 'GPT'), 'openai'),
+                                   (('claude', 'Claude'), 'anthropic'),
+                                   (('gemini', 'Gemini'), 'google'),
+                                   (('deepseek', 'DeepSeek'), 'deepseek')):
+            if model.startswith(prefixes):
+                return provider
+        return None
     
     @staticmethod
-    def _get_openai_streaming_response(user_id, model, message, attachments=None):
-        """Chiamata API OpenAI con streaming"""
-        api_key = get_user_api_key(user_id, 'openai')
+    def get_streaming_response(message, model, user, attachments=None, history=None):
+        """Ottieni risposta AI in streaming utilizzando le chiavi API dell'utente.
+
+        Se il provider del modello non risponde, la richiesta passa ai modelli
+        di fallback per cui l'utente ha una chiave (vedi provider_router).
+        """
+        provider = AIService.provider_for(model)
+        if provider is None:
+            # Simulated streaming for unsupported models
+            response = f"Risposta simulata da {model}: {message}"
+            for word in response.split():
+                yield word + " "
+            return
+        
+        api_key = get_user_api_key(user.id, provider)
         if not api_key:
-            yield "⚠️ Chiave API OpenAI non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
+            yield f"⚠️ Chiave API {PROVIDER_NAMES[provider]} non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
             return
         
-        try:
-            import openai
-            client = openai.OpenAI(api_key=api_key)
-            
-            model_map = {
-                'GPT-4o': 'gpt-4o',
-                'gpt-4o': 'gpt-4o',
-                'GPT-4': 'gpt-4',
-                'gpt-4': 'gpt-4'
-            }
-            
-            model_name = model_map.get(model, 'gpt-3.5-turbo')
-            
-            # Prepara il contenuto del messaggio
-            content = [{"type": "text", "text": message}]
-            
-            # Aggiungi immagini se presenti
-            if attachments:
-                for attachment in attachments:
-                    if attachment.file_type.startswith('image/'):
-                        import base64
-                        with open(attachment.file_path, 'rb') as f:
-                            image_data = base64.b64encode(f.read()).decode()
-                        content.append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{attachment.file_type};base64,{image_data}"
-                            }
-                        })
-            
-            stream = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": content}],
-                stream=True
-            )
-            
+        routes = [(model, provider, api_key)]
+        for fallback in MODELS.get(model, []):
+            fallback_provider = AIService.provider_for(fallback)
+            fallback_key = fallback_provider and get_user_api_key(user.id, fallback_provider)
+            if fallback_key:
+                routes.append((fallback, fallback_provider, fallback_key))
+        
+        def open_stream(model, provider, api_key):
+            return AIService._STREAMING_RESPONSES[provider](api_key, model, message, attachments, history)
+        
+        yield from provider_router.stream(routes, open_stream)
+    
+    @staticmethod
+    def _get_openai_streaming_response(api_key, model, message, attachments=None, history=None):
+        """Chiamata API OpenAI con streaming"""
+        client = client_pool.get('openai', api_key)
+        
+        model_map = {
+            'GPT-4o': 'gpt-4o',
+            'gpt-4o': 'gpt-4o',
+            'GPT-4': 'gpt-4',
+            'gpt-4': 'gpt-4'
+        }
+        
+        model_name = model_map.get(model, 'gpt-3.5-turbo')
+        
+        # Prepara il contenuto del messaggio
+        content = [{"type": "text", "text": message}]
+        
+        # Aggiungi immagini se presenti
+        for mime_type, image_data in AIService._image_payloads(attachments, 'openai'):
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime_type};base64,{image_data}"
+                }
+            })
+        
+        stream = upstream(client.chat.completions.create(
+            model=model_name,
+            messages=list(history or []) + [{"role": "user", "content": content}],
+            stream=True
+        ))
+        
+        # Il with chiude la connessione HTTP anche se lo stream viene
+        # interrotto (client disconnesso)
+        with stream:
             for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
                     yield chunk.choices[0].delta.content
-                    
-        except Exception as e:
-            yield f"Errore OpenAI: {str(e)}"
     
     @staticmethod
-    def _get_anthropic_streaming_response(user_id, model, message, attachments=None):
+    def _get_anthropic_streaming_response(api_key, model, message, attachments=None, history=None):
         """Chiamata API Anthropic con streaming"""
-        api_key = get_user_api_key(user_id, 'anthropic')
-        if not api_key:
-            yield "⚠️ Chiave API Anthropic non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
-            return
+        client = client_pool.get('anthropic', api_key)
         
-        try:
-            import anthropic
-            client = anthropic.Anthropic(api_key=api_key)
-            
-            # Prepara il contenuto del messaggio
-            content = [{"type": "text", "text": message}]
-            
-            # Aggiungi immagini se presenti
-            if attachments:
-                for attachment in attachments:
-                    if attachment.file_type.startswith('image/'):
-                        import base64
-                        with open(attachment.file_path, 'rb') as f:
-                            image_data = base64.b64encode(f.read()).decode()
-                        content.append({
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": attachment.file_type,
-                                "data": image_data
-                            }
-                        })
-            
-            with client.messages.stream(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=4000,
-                messages=[{"role": "user", "content": content}]
-            ) as stream:
-                for text in stream.text_stream:
-                    yield text
-                    
-        except Exception as e:
-            yield f"Errore Anthropic: {str(e)}"
+        # Prepara il contenuto del messaggio
+        content = [{"type": "text", "text": message}]
+        
+        # Aggiungi immagini se presenti
+        for mime_type, image_data in AIService._image_payloads(attachments, 'anthropic'):
+            content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": mime_type,
+                    "data": image_data
+                }
+            })
+        
+        with client.messages.stream(
+            model="claude-3-5-sonnet-20241022",
+            max_tokens=4000,
+            messages=to_anthropic_messages(history or []) + [{"role": "user", "content": content}]
+        ) as stream:
+            upstream(stream)
+            for text in stream.text_stream:
+                yield text
     
     @staticmethod
-    def _get_google_streaming_response(user_id, model, message, attachments=None):
+    def _get_google_streaming_response(api_key, model, message, attachments=None, history=None):
         """Chiamata API Google con streaming"""
-        api_key = get_user_api_key(user_id, 'google')
-        if not api_key:
-            yield "⚠️ Chiave API Google non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
-            return
+        model_obj = client_pool.google_model(api_key, 'gemini-2.0-flash-exp')
         
-        try:
-            import google.generativeai as genai
-            genai.configure(api_key=api_key)
-            
-            model_obj = genai.GenerativeModel('gemini-2.0-flash-exp')
-            
-            # Prepara il contenuto
-            content = [message]
-            
-            # Aggiungi immagini se presenti
-            if attachments:
-                for attachment in attachments:
-                    if attachment.file_type.startswith('image/'):
-                        import PIL.Image
-                        img = PIL.Image.open(attachment.file_path)
-                        content.append(img)
-            
-            response = model_obj.generate_content(content, stream=True)
-            
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
-                    
-        except Exception as e:
-            yield f"Errore Google: {str(e)}"
+        # Prepara il contenuto
+        content = [message]
+        
+        # Aggiungi immagini se presenti
+        for mime_type, image_data in AIService._image_payloads(attachments, 'google'):
+            content.append({'mime_type': mime_type, 'data': base64.b64decode(image_data)})
+        
+        response = model_obj.generate_content(
+            to_google_contents(history or []) + [{'role': 'user', 'parts': content}],
+            stream=True,
+            request_options={'timeout': PROVIDER_READ_TIMEOUT}
+        )
+        
+        # La risposta di Gemini non si può chiudere: un tentativo annullato
+        # si ferma al prossimo chunk
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
     
     @staticmethod
-    def _get_deepseek_streaming_response(user_id, model, message, attachments=None):
+    def _get_deepseek_streaming_response(api_key, model, message, attachments=None, history=None):
         """Chiamata API DeepSeek con streaming"""
-        api_key = get_user_api_key(user_id, 'deepseek')
-        if not api_key:
-            yield "⚠️ Chiave API DeepSeek non configurata. Vai nelle impostazioni per aggiungere la tua chiave API."
-            return
+        client = client_pool.get('deepseek', api_key)
         
-        try:
-            import openai
-            client = openai.OpenAI(
-                api_key=api_key,
-                base_url="https://api.deepseek.com"
-            )
-            
-            stream = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": "user", "content": message}],
-                stream=True
-            )
-            
+        stream = upstream(client.chat.completions.create(
+            model="deepseek-chat",
+            messages=list(history or []) + [{"role": "user", "content": message}],
+            stream=True
+        ))
+        
+        # Il with chiude la connessione HTTP anche se lo stream viene
+        # interrotto (client disconnesso)
+        with stream:
             for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
                     yield chunk.choices[0].delta.content
-                    
-        except Exception as e:
-            yield f"Errore DeepSeek: {str(e)}"
 
+
+# Le funzioni di streaming sollevano un'eccezione se la chiamata fallisce: il
+# router decide se passare a un altro modello
+AIService._STREAMING_RESPONSES = {
+    'openai': AIService._get_openai_streaming_response,
+    'anthropic': AIService._get_anthropic_streaming_response,
+    'google': AIService._get_google_streaming_response,
+    'deepseek': AIService._get_deepseek_streaming_response,
+}
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import time
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from src.models.user import db, Blob, BlobChunk
+
+# Blocchi letti e scritti per volta: la memoria usata non dipende dalla dimensione del file
+CHUNK_SIZE = 64 * 1024
+# Il file di un blob rilasciato resta se è stato toccato da meno di così: può
+# essere riusato da un upload dello stesso contenuto non ancora committato
+BLOB_REUSE_GRACE_SECONDS = float(os.environ.get('BLOB_REUSE_GRACE_SECONDS', '300'))
+
+
+def blobs_root(upload_folder):
+    return os.path.join(upload_folder, 'blobs')
+
+
+def blob_path(upload_folder, sha256):
+    """Percorso a directory annidate (ab/cd/abcd...) per non avere milioni di file in una cartella."""
+    return os.path.join(blobs_root(upload_folder), sha256[:2], sha256[2:4], sha256)
+
+
+def copy_stream(stream, out, sha=None, on_chunk=None, written=0, chunk_size=CHUNK_SIZE):
+    """Copia lo stream in `out` a blocchi; restituisce il totale dei byte scritti.
+
+    on_chunk(blocco, totale) viene chiamata prima di scrivere ogni blocco e può
+    interrompere la copia sollevando un'eccezione (tipo non ammesso, quota).
+    """
+    for block in iter(lambda: stream.read(chunk_size), b''):
+        written += len(block)
+        if on_chunk is not None:
+            on_chunk(block, written)
+        if sha is not None:
+            sha.update(block)
+        out.write(block)
+    return written
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_temp(stream, upload_folder, on_chunk=None, chunk_size=CHUNK_SIZE):
+    """Copia lo stream in un file temporaneo calcolando lo SHA-256 durante la scrittura.
+
+    Restituisce (sha256, dimensione, percorso temporaneo).
+    """
+    tmp_dir = os.path.join(blobs_root(upload_folder), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    sha = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as out:
+            size = copy_stream(stream, out, sha, on_chunk, chunk_size=chunk_size)
+    except Exception:
+        discard_temp(tmp_path)
+        raise
+    return sha.hexdigest(), size, tmp_path
+
+
+def discard_temp(tmp_path):
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+def store_temp(upload_folder, sha256, tmp_path):
+    """Sposta il file temporaneo al suo indirizzo; se il contenuto esiste già lo scarta."""
+    path = blob_path(upload_folder, sha256)
+    try:
+        # Il GC e remove_file() non eliminano file modificati di recente: il
+        # blob resta al sicuro finché la sua riga non è di nuovo nel database
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    else:
+        discard_temp(tmp_path)
+    return path
+
+
+def acquire(sha256, size, mime_type):
+    """Aggiunge un riferimento al blob, creandolo se è la prima copia (senza commit)."""
+    updated = Blob.query.filter_by(sha256=sha256).update(
+        {Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False
+    )
+    if updated:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Blob(sha256=sha256, size=size, mime_type=mime_type, ref_count=1))
+    except IntegrityError:
+        # Un upload concorrente dello stesso contenuto ha creato la riga
+        Blob.query.filter_by(sha256=sha256).update(
+            {Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False
+        )
+
+
+def release(sha256):
+    """Toglie un riferimento al blob (senza commit).
+
+    Restituisce True se era l'ultimo: la riga viene eliminata e il file va
+    rimosso con remove_file() dopo il commit.
+    """
+    Blob.query.filter_by(sha256=sha256).update(
+        {Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False
+    )
+    deleted = Blob.query.filter(Blob.sha256 == sha256, Blob.ref_count <= 0).delete(synchronize_session=False)
+    if deleted:
+        # Su PostgreSQL ci pensa ON DELETE CASCADE; SQLite non applica le foreign key
+        BlobChunk.query.filter_by(blob_hash=sha256).delete(synchronize_session=False)
+    return bool(deleted)
+
+
+def remove_file(upload_folder, sha256, grace=BLOB_REUSE_GRACE_SECONDS):
+    """Elimina il file di un blob rilasciato, se nessun upload lo sta riusando.
+
+    Un upload dello stesso contenuto tocca il file in store_temp() prima del
+    commit della sua riga: un file toccato negli ultimi `grace` secondi resta
+    (se l'upload fallisce lo elimina il GC).
+    """
+    path = blob_path(upload_folder, sha256)
+    # Nel frattempo lo stesso contenuto può essere stato caricato di nuovo
+    if db.session.get(Blob, sha256) is not None:
+        return
+    # Spostato prima di controllarne la data: un utime() successivo non lo
+    # trova e store_temp() rimette al suo posto il file dell'upload
+    trash = os.path.join(blobs_root(upload_folder), 'tmp', uuid.uuid4().hex)
+    try:
+        os.makedirs(os.path.dirname(trash), exist_ok=True)
+        os.replace(path, trash)
+    except FileNotFoundError:
+        return
+    if os.stat(trash).st_mtime >= time.time() - grace:
+        os.replace(trash, path)
+    else:
+        os.remove(trash)
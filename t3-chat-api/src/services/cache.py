@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Cache thread-safe con limite LRU e scadenza opzionale delle voci.
+
+    - ``maxsize``: numero massimo di voci, oltre il quale si elimina la meno usata
+    - ``ttl``: secondi di vita di una voce (None = nessuna scadenza)
+    - ``sliding``: se True il ttl riparte a ogni accesso (scadenza per inattività)
+    - ``on_evict``: callback ``(key, value)`` chiamata quando una voce viene rimossa
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, sliding=False, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sliding = sliding
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _count=False) is not None
+
+    def get(self, key, default=None, _count=True):
+        evicted = None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                now = time.monotonic()
+                if expires_at is not None and expires_at <= now:
+                    del self._data[key]
+                    self.evictions += 1
+                    evicted = (key, value)
+                    entry = None
+                else:
+                    self._data.move_to_end(key)
+                    if self.sliding and self.ttl is not None:
+                        self._data[key] = (value, now + self.ttl)
+            if _count:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        if evicted:
+            self._evicted(*evicted)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+            previous = self._data.pop(key, None)
+            if previous is not None and previous[0] is not value:
+                evicted.append((key, previous[0]))
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.maxsize:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+            self.evictions += len(evicted)
+        for item in evicted:
+            self._evicted(*item)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is not None:
+            self._evicted(key, entry[0])
+            return entry[0]
+        return None
+
+    def clear(self):
+        with self._lock:
+            items = [(key, entry[0]) for key, entry in self._data.items()]
+            self._data.clear()
+        for item in items:
+            self._evicted(*item)
+
+    def expire(self):
+        """Rimuove le voci scadute; utile per liberare risorse inattive."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._data.items()
+                       if expires_at is not None and expires_at <= now]
+            items = [(key, self._data.pop(key)[0]) for key in expired]
+            self.evictions += len(items)
+        for item in items:
+            self._evicted(*item)
+        return len(items)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _evicted(self, key, value):
+        if self.on_evict is not None:
+            try:
+                self.on_evict(key, value)
+            except Exception:
+                pass
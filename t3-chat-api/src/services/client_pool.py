@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+
+from src.services.cache import LRUCache
+
+# Numero massimo di client SDK tenuti in memoria e secondi di inattività dopo
+# i quali un client viene scartato.
+CLIENT_POOL_SIZE = int(os.environ.get('PROVIDER_CLIENT_POOL_SIZE', '256'))
+CLIENT_IDLE_TTL = float(os.environ.get('PROVIDER_CLIENT_IDLE_TTL', '600'))
+
+# Endpoint di default per provider (None = quello dell'SDK), sovrascrivibili
+# con PROVIDER_BASE_URL_<PROVIDER> (proxy, gateway, server finti nei benchmark)
+BASE_URLS = {
+    'openai': None,
+    'anthropic': None,
+    'google': None,
+    'deepseek': 'https://api.deepseek.com',
+}
+for _provider in BASE_URLS:
+    BASE_URLS[_provider] = os.environ.get(f'PROVIDER_BASE_URL_{_provider.upper()}', BASE_URLS[_provider])
+
+# Timeout HTTP dei client: connessione e lettura (per gli stream, tra due
+# chunk). L'attesa del primo token ha un limite più breve nel provider_router,
+# che in caso di errore passa al modello di fallback invece di ritentare.
+PROVIDER_CONNECT_TIMEOUT = float(os.environ.get('PROVIDER_CONNECT_TIMEOUT', '5'))
+PROVIDER_READ_TIMEOUT = float(os.environ.get('PROVIDER_READ_TIMEOUT', '60'))
+PROVIDER_MAX_RETRIES = int(os.environ.get('PROVIDER_MAX_RETRIES', '1'))
+
+# SDK usato da ciascun provider: DeepSeek è compatibile OpenAI
+SDKS = {
+    'openai': 'openai',
+    'deepseek': 'openai',
+    'anthropic': 'anthropic',
+    'google': 'google',
+}
+
+
+def _hash_key(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+class ProviderClientPool:
+    """Registro dei client SDK dei provider AI, riusati tra richieste e thread.
+
+    I client sono indicizzati per (provider, hash della chiave API, base_url):
+    ogni chiave ha il proprio client, quindi nessuno stato globale è condiviso
+    tra utenti. I client OpenAI/Anthropic dello stesso SDK condividono un unico
+    pool di connessioni HTTP keep-alive, così TLS e TCP non vengono rinegoziati
+    a ogni messaggio anche quando cambia la chiave.
+    """
+
+    def __init__(self, maxsize=CLIENT_POOL_SIZE, idle_ttl=CLIENT_IDLE_TTL):
+        # Nessuna chiusura esplicita allo sfratto: un client scartato può essere
+        # ancora in uso da uno stream in corso; il canale gRPC di Google viene
+        # rilasciato dal garbage collector quando cade l'ultimo riferimento,
+        # mentre il pool HTTP di OpenAI/Anthropic è condiviso e resta aperto.
+        self._clients = LRUCache(maxsize=maxsize, ttl=idle_ttl, sliding=True)
+        self._http_clients = {}
+        self._lock = threading.Lock()
+        self._http_lock = threading.Lock()
+
+    def get(self, provider, api_key):
+        """Restituisce il client SDK per ``provider`` e ``api_key``, creandolo se serve."""
+        base_url = BASE_URLS.get(provider)
+        key = (provider, _hash_key(api_key), base_url)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key, _count=False)
+                if client is None:
+                    # Creazione rara: è il momento giusto per scartare i client inattivi
+                    self._clients.expire()
+                    client = self._clients.set(key, self._build(provider, api_key, base_url))
+        return client
+
+    def google_model(self, api_key, model_name):
+        """GenerativeModel Gemini legato al client della chiave, senza ``genai.configure``."""
+        import google.generativeai as genai
+
+        model = genai.GenerativeModel(model_name)
+        # GenerativeModel usa il client globale solo se _client non è impostato
+        model._client = self.get('google', api_key)
+        return model
+
+    def stats(self):
+        return self._clients.stats()
+
+    def clear(self):
+        self._clients.clear()
+
+    def _build(self, provider, api_key, base_url):
+        sdk = SDKS[provider]
+        if sdk == 'openai':
+            import openai
+            return openai.OpenAI(
+                api_key=api_key, base_url=base_url, http_client=self._http_client(sdk),
+                timeout=openai.Timeout(PROVIDER_READ_TIMEOUT, connect=PROVIDER_CONNECT_TIMEOUT),
+                max_retries=PROVIDER_MAX_RETRIES
+            )
+        if sdk == 'anthropic':
+            import anthropic
+            return anthropic.Anthropic(
+                api_key=api_key, base_url=base_url, http_client=self._http_client(sdk),
+                timeout=anthropic.Timeout(PROVIDER_READ_TIMEOUT, connect=PROVIDER_CONNECT_TIMEOUT),
+                max_retries=PROVIDER_MAX_RETRIES
+            )
+        if sdk == 'google':
+            from google.ai import generativelanguage as glm
+            client_options = {'api_key': api_key}
+            if base_url:
+                client_options['api_endpoint'] = base_url
+            # Un URL http(s):// è un endpoint REST (gateway, server finto dei
+            # benchmark); altrimenti host:porta gRPC come l'API di Google
+            transport = 'rest' if base_url and base_url.startswith(('http://', 'https://')) else None
+            return glm.GenerativeServiceClient(client_options=client_options, transport=transport)
+        raise ValueError(f'Provider non supportato: {provider}')
+
+    def _http_client(self, sdk):
+        """Client HTTP condiviso (e thread-safe) per tutti i client di uno stesso SDK."""
+        with self._http_lock:
+            http_client = self._http_clients.get(sdk)
+            if http_client is None:
+                if sdk == 'openai':
+                    import openai
+                    http_client = openai.DefaultHttpxClient()
+                else:
+                    import anthropic
+                    http_client = anthropic.DefaultHttpxClient()
+                self._http_clients[sdk] = http_client
+            return http_client
+
+
+client_pool = ProviderClientPool()
@@ -0,0 +1,173 @@
+import os
+import threading
+from collections import deque
+
+from sqlalchemy import and_, or_
+
+from src.models.user import db, ChatMessage
+from src.services.cache import LRUCache
+from src.services.stream_checkpoint import STATUS_STREAMING, is_stale
+
+# Budget di token per la cronologia inviata al modello (escluso il messaggio corrente)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '8000'))
+CONTEXT_CACHE_SIZE = int(os.environ.get('CONTEXT_CACHE_SIZE', '2000'))
+CONTEXT_CACHE_TTL = float(os.environ.get('CONTEXT_CACHE_TTL', '3600'))
+
+# Token aggiuntivi per messaggio (ruolo e separatori nel formato dei provider)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Righe lette per volta quando si ricostruisce la finestra a ritroso
+_LOAD_BATCH = 200
+
+
+def estimate_tokens(text):
+    """Stima veloce dei token di un testo (~4 caratteri per token, come i BPE dei provider).
+
+    I caratteri non ASCII pesano di più: nei tokenizer BPE occupano spesso un
+    token intero o più.
+    """
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars) + MESSAGE_OVERHEAD_TOKENS
+
+
+class _SessionWindow:
+    """Coda dei messaggi più recenti di una sessione entro il budget massimo."""
+
+    def __init__(self):
+        self.entries = deque()  # (role, text, tokens), dal più vecchio
+        self.total_tokens = 0
+        self.last_created_at = None
+        self.last_id = None
+        self.lock = threading.Lock()
+
+    def append(self, role, text, tokens):
+        self.entries.append((role, text, tokens))
+        self.total_tokens += tokens
+        while self.entries and self.total_tokens > CONTEXT_TOKEN_BUDGET:
+            self.total_tokens -= self.entries.popleft()[2]
+
+    def appendleft(self, role, text, tokens):
+        self.entries.appendleft((role, text, tokens))
+        self.total_tokens += tokens
+
+
+_windows = LRUCache(maxsize=CONTEXT_CACHE_SIZE, ttl=CONTEXT_CACHE_TTL, sliding=True)
+
+
+def _role(sender):
+    return 'user' if sender == 'user' else 'assistant'
+
+
+def _message_columns():
+    return db.session.query(
+        ChatMessage.id, ChatMessage.sender, ChatMessage.text, ChatMessage.status,
+        ChatMessage.created_at, ChatMessage.updated_at
+    )
+
+
+def _in_progress(row):
+    # Una risposta abbandonata da un worker morto non verrà mai completata:
+    # conta come interrotta, con il testo salvato all'ultimo checkpoint
+    return row.status == STATUS_STREAMING and not is_stale(row.status, row.updated_at, row.created_at)
+
+
+def _load_tail(window, session_id):
+    """Primo caricamento: legge i messaggi a ritroso finché il budget è pieno."""
+    query = _message_columns().filter(ChatMessage.session_id == session_id).order_by(
+        ChatMessage.created_at.desc(), ChatMessage.id.desc()
+    )
+    offset = 0
+    while True:
+        rows = query.offset(offset).limit(_LOAD_BATCH).all()
+        for row in rows:
+            if _in_progress(row):
+                # Risposta ancora in scrittura: la finestra riparte da prima di
+                # questo messaggio, che verrà letto quando sarà completo
+                window.entries.clear()
+                window.total_tokens = 0
+                window.last_created_at = window.last_id = None
+                continue
+            if window.last_id is None:
+                window.last_created_at, window.last_id = row.created_at, row.id
+            tokens = estimate_tokens(row.text)
+            if window.total_tokens + tokens > CONTEXT_TOKEN_BUDGET:
+                return
+            window.appendleft(_role(row.sender), row.text, tokens)
+        if len(rows) < _LOAD_BATCH:
+            return
+        offset += _LOAD_BATCH
+
+
+def _load_new(window, session_id):
+    """Aggiornamento incrementale: legge solo i messaggi successivi all'ultimo visto."""
+    query = _message_columns().filter(ChatMessage.session_id == session_id)
+    if window.last_id is not None:
+        query = query.filter(or_(
+            ChatMessage.created_at > window.last_created_at,
+            and_(ChatMessage.created_at == window.last_created_at, ChatMessage.id > window.last_id)
+        ))
+    for row in query.order_by(ChatMessage.created_at.asc(), ChatMessage.id.asc()).all():
+        if _in_progress(row):
+            break
+        window.append(_role(row.sender), row.text, estimate_tokens(row.text))
+        window.last_created_at, window.last_id = row.created_at, row.id
+
+
+def build_context(session_id, token_budget=None):
+    """Cronologia della sessione come lista di {'role', 'content'} (dal più vecchio).
+
+    La finestra di ogni sessione resta in cache con il conteggio dei token, quindi
+    a ogni turno si leggono dal database solo i messaggi nuovi. Va chiamata prima
+    di aggiungere il messaggio corrente dell'utente.
+    """
+    budget = min(token_budget or CONTEXT_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET)
+    window = _windows.get(session_id)
+    if window is None:
+        window = _SessionWindow()
+        with window.lock:
+            # Pubblicata già bloccata: chi la trova attende il caricamento iniziale
+            _windows.set(session_id, window)
+            _load_tail(window, session_id)
+    else:
+        with window.lock:
+            _load_new(window, session_id)
+
+    with window.lock:
+        history = []
+        used = 0
+        for role, text, tokens in reversed(window.entries):
+            if used + tokens > budget:
+                break
+            used += tokens
+            if text:
+                history.append({'role': role, 'content': text})
+    history.reverse()
+    return history
+
+
+def forget_session(session_id):
+    """Scarta la finestra in cache di una sessione (es. dopo l'eliminazione)."""
+    _windows.pop(session_id)
+
+
+def to_anthropic_messages(history):
+    """Anthropic vuole una conversazione che inizia da 'user' e ruoli alternati."""
+    messages = []
+    for item in history:
+        if not messages and item['role'] != 'user':
+            continue
+        if messages and messages[-1]['role'] == item['role']:
+            messages[-1] = {'role': item['role'], 'content': messages[-1]['content'] + '\n\n' + item['content']}
+        else:
+            messages.append(dict(item))
+    return messages
+
+
+def to_google_contents(history):
+    """Formato Gemini: ruoli 'user' / 'model' con una lista di parts."""
+    return [
+        {'role': 'user' if item['role'] == 'user' else 'model', 'parts': [item['content']]}
+        for item in history
+    ]
@@ -0,0 +1,364 @@
+import json
+import math
+import os
+import re
+import zipfile
+from collections import Counter
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+
+from sqlalchemy import and_, or_
+
+from src.models.user import db, Blob, BlobChunk
+from src.services import blob_store, jobs
+from src.services.cache import LRUCache
+from src.services.context_builder import estimate_tokens
+
+# Dimensione dei passaggi in cui viene diviso il testo di un documento
+CHUNK_TOKENS = int(os.environ.get('DOCUMENT_CHUNK_TOKENS', '300'))
+# Passaggi e token massimi iniettati nel prompt per messaggio
+DOCUMENT_TOP_K = int(os.environ.get('DOCUMENT_TOP_K', '5'))
+DOCUMENT_CONTEXT_TOKENS = int(os.environ.get('DOCUMENT_CONTEXT_TOKENS', '2000'))
+# Oltre questo numero di caratteri il resto del documento non viene indicizzato
+MAX_EXTRACT_CHARS = int(os.environ.get('DOCUMENT_MAX_EXTRACT_CHARS', str(2_000_000)))
+# Un documento 'indexing' da più di così è di un worker morto (o di un job
+# fallito prima di salvare l'esito): un altro job può riprenderlo. Come il
+# lease dei job, così il nuovo tentativo di un job ripreso trova la
+# prenotazione già scaduta.
+INDEX_CLAIM_SECONDS = float(os.environ.get('DOCUMENT_INDEX_CLAIM_SECONDS', str(jobs.JOB_LEASE_SECONDS)))
+# Indici invertiti dei documenti tenuti in memoria per processo
+DOCUMENT_INDEX_CACHE_SIZE = int(os.environ.get('DOCUMENT_INDEX_CACHE_SIZE', '256'))
+
+TEXT_STATUS_PENDING = 'pending'
+TEXT_STATUS_INDEXING = 'indexing'
+TEXT_STATUS_READY = 'ready'
+TEXT_STATUS_FAILED = 'failed'
+TEXT_STATUS_UNSUPPORTED = 'unsupported'
+
+DOCUMENT_TYPES = {
+    'text/plain',
+    'text/markdown',
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/msword',
+}
+
+# Parametri BM25 standard
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TERM_RE = re.compile(r'\w{2,}')
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+class UnsupportedDocument(Exception):
+    pass
+
+
+def terms(text):
+    return _TERM_RE.findall(text.casefold())
+
+
+def _pdf_text(path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedDocument('pypdf is not installed')
+    parts = []
+    size = 0
+    for page in PdfReader(path).pages:
+        text = page.extract_text() or ''
+        parts.append(text)
+        size += len(text)
+        if size >= MAX_EXTRACT_CHARS:
+            break
+    return '\n\n'.join(parts)
+
+
+def _docx_text(path):
+    """Testo di un .docx leggendo word/document.xml a stream (niente dipendenze)."""
+    paragraphs = []
+    current = []
+    size = 0
+    with zipfile.ZipFile(path) as archive, archive.open('word/document.xml') as xml:
+        for _, element in ElementTree.iterparse(xml, events=('end',)):
+            if element.tag == _WORD_NS + 't' and element.text:
+                current.append(element.text)
+            elif element.tag == _WORD_NS + 'tab':
+                current.append('\t')
+            elif element.tag == _WORD_NS + 'p':
+                paragraph = ''.join(current)
+                paragraphs.append(paragraph)
+                size += len(paragraph)
+                current = []
+                element.clear()
+                if size >= MAX_EXTRACT_CHARS:
+                    break
+    return '\n\n'.join(paragraphs)
+
+
+def extract_text(path, mime_type):
+    if mime_type in ('text/plain', 'text/markdown'):
+        with open(path, encoding='utf-8', errors='replace') as f:
+            return f.read(MAX_EXTRACT_CHARS)
+    if mime_type == 'application/pdf':
+        return _pdf_text(path)
+    if mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        return _docx_text(path)
+    raise UnsupportedDocument(mime_type)
+
+
+def _pieces(paragraph, max_tokens):
+    """Divide un paragrafo troppo lungo per frasi e, se serve, per parole."""
+    if estimate_tokens(paragraph) <= max_tokens:
+        yield paragraph
+        return
+    for sentence in _SENTENCE_RE.split(paragraph):
+        if estimate_tokens(sentence) <= max_tokens:
+            yield sentence
+            continue
+        words = sentence.split()
+        step = max(1, max_tokens * 3 // 4)  # ~1.3 token per parola
+        for start in range(0, len(words), step):
+            yield ' '.join(words[start:start + step])
+
+
+def split_chunks(text, max_tokens=CHUNK_TOKENS):
+    """Passaggi di circa max_tokens token, senza spezzare paragrafi e frasi se possibile."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in re.split(r'\n\s*\n', text[:MAX_EXTRACT_CHARS]):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        for piece in _pieces(paragraph, max_tokens):
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append('\n\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+
+def mark_pending(sha256):
+    """Segna un documento appena caricato come da indicizzare (senza commit)."""
+    Blob.query.filter(Blob.sha256 == sha256, Blob.text_status.is_(None)).update(
+        {Blob.text_status: TEXT_STATUS_PENDING}, synchronize_session=False
+    )
+
+
+def _claim_expired():
+    cutoff = datetime.utcnow() - timedelta(seconds=INDEX_CLAIM_SECONDS)
+    return and_(Blob.text_status == TEXT_STATUS_INDEXING,
+                or_(Blob.text_claimed_at.is_(None), Blob.text_claimed_at < cutoff))
+
+
+def index_blob(sha256, path, mime_type):
+    """Estrae il testo di un documento e ne salva i passaggi (con commit).
+
+    Il documento viene prima "prenotato" (pending -> indexing) con un UPDATE
+    condizionale: con upload concorrenti dello stesso contenuto lo indicizza
+    uno solo, e un contenuto già indicizzato non viene rielaborato. Una
+    prenotazione più vecchia di INDEX_CLAIM_SECONDS viene ripresa.
+    """
+    claimed = Blob.query.filter(
+        Blob.sha256 == sha256, or_(Blob.text_status == TEXT_STATUS_PENDING, _claim_expired())
+    ).update({Blob.text_status: TEXT_STATUS_INDEXING, Blob.text_claimed_at: datetime.utcnow()},
+             synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return
+
+    status = TEXT_STATUS_READY
+    try:
+        text = extract_text(path, mime_type)
+        BlobChunk.query.filter_by(blob_hash=sha256).delete(synchronize_session=False)
+        for position, chunk in enumerate(split_chunks(text)):
+            counts = Counter(terms(chunk))
+            db.session.add(BlobChunk(
+                blob_hash=sha256,
+                position=position,
+                text=chunk,
+                terms=json.dumps(counts),
+                length=sum(counts.values()),
+                tokens=estimate_tokens(chunk)
+            ))
+    except UnsupportedDocument:
+        status = TEXT_STATUS_UNSUPPORTED
+    except Exception as e:
+        print(f"Text extraction error for {sha256}: {e}")
+        db.session.rollback()
+        status = TEXT_STATUS_FAILED
+    try:
+        Blob.query.filter_by(sha256=sha256).update({Blob.text_status: status}, synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        # Il documento torna da indicizzare: il nuovo tentativo del job lo trova libero
+        db.session.rollback()
+        Blob.query.filter_by(sha256=sha256, text_status=TEXT_STATUS_INDEXING).update(
+            {Blob.text_status: TEXT_STATUS_PENDING}, synchronize_session=False
+        )
+        db.session.commit()
+        raise
+
+
+def requeue_stale_indexing(upload_folder):
+    """Rimette in coda i documenti rimasti 'indexing' oltre INDEX_CLAIM_SECONDS.
+
+    Servono quando i tentativi del job sono finiti prima che la prenotazione
+    scadesse. Restituisce quanti ne ha rimessi in coda.
+    """
+    rows = db.session.query(Blob.sha256, Blob.mime_type).filter(_claim_expired()).all()
+    count = 0
+    for row in rows:
+        requeued = Blob.query.filter(Blob.sha256 == row.sha256, _claim_expired()).update(
+            {Blob.text_status: TEXT_STATUS_PENDING}, synchronize_session=False
+        )
+        db.session.commit()
+        if requeued:
+            count += 1
+            jobs.enqueue('index_document', {
+                'sha256': row.sha256,
+                'path': blob_store.blob_path(upload_folder, row.sha256),
+                'mime_type': row.mime_type,
+            })
+    return count
+
+
+class DocumentIndex:
+    """Indice invertito dei passaggi di un documento: termine -> [(passaggio, frequenza)].
+
+    I termini dei passaggi sono decodificati una volta sola: a ogni messaggio
+    si leggono solo le liste dei termini della domanda, non tutti i passaggi.
+    Il contenuto di un blob non cambia (l'indirizzo è il suo SHA-256) e
+    rielaborarlo produce gli stessi passaggi, quindi l'indice non scade.
+    """
+
+    def __init__(self, rows):
+        self.positions = []
+        self.lengths = []
+        self.tokens = []
+        self.postings = {}
+        for index, row in enumerate(rows):
+            self.positions.append(row.position)
+            self.lengths.append(row.length)
+            self.tokens.append(row.tokens)
+            for term, count in json.loads(row.terms).items():
+                self.postings.setdefault(term, []).append((index, count))
+
+
+_indexes = LRUCache(maxsize=DOCUMENT_INDEX_CACHE_SIZE)
+
+
+def document_index(sha256):
+    """L'indice di un documento già indicizzato (ready), dalla cache o dal database."""
+    index = _indexes.get(sha256)
+    if index is None:
+        rows = db.session.query(
+            BlobChunk.position, BlobChunk.length, BlobChunk.tokens, BlobChunk.terms
+        ).filter(BlobChunk.blob_hash == sha256).order_by(BlobChunk.position).all()
+        index = _indexes.set(sha256, DocumentIndex(rows))
+    return index
+
+
+def bm25_scores(query_terms, indexes):
+    """Punteggio BM25 di ogni passaggio dei documenti rispetto ai termini della domanda.
+
+    I passaggi di tutti i documenti formano una sola collezione, nell'ordine
+    degli indici e delle posizioni.
+    """
+    offsets = []
+    total = 0
+    for index in indexes:
+        offsets.append(total)
+        total += len(index.positions)
+    if not total:
+        return []
+    average_length = sum(sum(index.lengths) for index in indexes) / total or 1
+    scores = [0.0] * total
+    for term in set(query_terms):
+        postings = [(index, offset, index.postings.get(term, ())) for index, offset in zip(indexes, offsets)]
+        df = sum(len(entries) for _, _, entries in postings)
+        if not df:
+            continue
+        idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+        for index, offset, entries in postings:
+            for position, tf in entries:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * index.lengths[position] / average_length)
+                scores[offset + position] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores
+
+
+def select_chunks(blob_hashes, query, top_k=DOCUMENT_TOP_K, token_budget=DOCUMENT_CONTEXT_TOKENS):
+    """I passaggi più pertinenti alla domanda, entro top_k e il budget di token.
+
+    Un documento che sta tutto nel budget viene incluso per intero. I passaggi
+    scelti tornano nell'ordine del documento. Il testo è letto dal database
+    solo per i passaggi scelti.
+    """
+    blob_hashes = sorted(set(blob_hashes))
+    indexes = [document_index(sha256) for sha256 in blob_hashes]
+    chunks = [
+        (sha256, position, tokens)
+        for sha256, index in zip(blob_hashes, indexes)
+        for position, tokens in zip(index.positions, index.tokens)
+    ]
+    if sum(tokens for _, _, tokens in chunks) <= token_budget:
+        return BlobChunk.query.filter(BlobChunk.blob_hash.in_(blob_hashes)).order_by(
+            BlobChunk.blob_hash, BlobChunk.position
+        ).all()
+
+    scores = bm25_scores(terms(query), indexes)
+    ranked = sorted(zip(scores, range(len(chunks))), key=lambda item: (-item[0], item[1]))
+    selected = []
+    used = 0
+    for score, index in ranked:
+        if len(selected) >= top_k:
+            break
+        if used + chunks[index][2] > token_budget:
+            continue
+        selected.append(index)
+        used += chunks[index][2]
+    if not selected:
+        return []
+    positions = {}
+    for index in selected:
+        positions.setdefault(chunks[index][0], []).append(chunks[index][1])
+    # Al più top_k righe: si ordinano qui, un ORDER BY richiederebbe un sort
+    rows = BlobChunk.query.filter(or_(*(
+        and_(BlobChunk.blob_hash == sha256, BlobChunk.position.in_(values)) for sha256, values in positions.items()
+    ))).all()
+    return sorted(rows, key=lambda chunk: (chunk.blob_hash, chunk.position))
+
+
+def with_document_context(message, attachments):
+    """Il messaggio seguito dai passaggi pertinenti dei documenti allegati.
+
+    Le immagini sono inviate a parte dai provider; qui contano solo i documenti
+    con il testo già indicizzato.
+    """
+    documents = [a for a in attachments or [] if a.blob_hash and a.mime_type in DOCUMENT_TYPES]
+    if not documents:
+        return message
+
+    statuses = dict(db.session.query(Blob.sha256, Blob.text_status).filter(
+        Blob.sha256.in_([a.blob_hash for a in documents])
+    ).all())
+    names = {}
+    for attachment in documents:
+        names.setdefault(attachment.blob_hash, attachment.original_filename)
+
+    sections = []
+    ready = [sha for sha, status in statuses.items() if status == TEXT_STATUS_READY]
+    for chunk in select_chunks(ready, message) if ready else []:
+        sections.append(f"[{names[chunk.blob_hash]}, parte {chunk.position + 1}]\n{chunk.text}")
+    for sha, status in statuses.items():
+        if status != TEXT_STATUS_READY:
+            sections.append(f"[{names[sha]}: testo non disponibile ({status})]")
+
+    return message + '\n\n---\nEstratti dai documenti allegati:\n\n' + '\n\n'.join(sections)
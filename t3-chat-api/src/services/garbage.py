@@ -0,0 +1,340 @@
+import os
+import re
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from src.models.user import db, Attachment, Blob, BlobChunk
+from src.services import blob_store, image_payloads, upload_ingest
+
+# Garbage collector dello storage. Ogni passata:
+# 1. elimina gli allegati mai collegati a un messaggio entro ATTACHMENT_ORPHAN_TTL
+# 2. elimina gli allegati il cui file non esiste più
+# 3. riallinea il ref_count dei blob agli allegati reali ed elimina i blob
+#    senza allegati
+# 4. elimina i file senza riga: blob, payload delle immagini, file caricati
+#    prima dei blob (nella radice di UPLOAD_FOLDER)
+# 5. elimina i file temporanei di upload interrotti e gli upload riprendibili
+#    abbandonati da più di RESUMABLE_UPLOAD_TTL
+# 6. rimuove le directory rimaste vuote
+# Le righe sono lette e cancellate a lotti di GC_BATCH_SIZE, con un commit per
+# lotto. Con dry_run non elimina nulla e riporta cosa eliminerebbe.
+
+# Gli allegati caricati ma mai collegati a un messaggio vengono eliminati dopo
+# questo tempo (il client può ancora usarli finché non scade)
+ATTACHMENT_ORPHAN_TTL = float(os.environ.get('ATTACHMENT_ORPHAN_TTL', str(24 * 3600)))
+GC_BATCH_SIZE = int(os.environ.get('GC_BATCH_SIZE', '200'))
+# File e directory più recenti di così non vengono mai toccati: possono essere
+# di un upload in corso, il cui file è scritto prima del commit della riga
+GC_FILE_GRACE_SECONDS = float(os.environ.get('GC_FILE_GRACE_SECONDS', '3600'))
+
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+# Nome dei file caricati prima dei blob: <uuid4>.<estensione>
+_LEGACY_NAME_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.\w+$')
+
+
+class Report:
+    """Numero di elementi e byte eliminati (o da eliminare, con dry_run) per categoria."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.counts = {}
+        self.bytes = {}
+        self.seconds = None
+
+    def add(self, category, count=1, size=0):
+        self.counts[category] = self.counts.get(category, 0) + count
+        self.bytes[category] = self.bytes.get(category, 0) + size
+
+    def to_dict(self):
+        return {
+            'dry_run': self.dry_run,
+            'categories': {
+                category: {'count': count, 'bytes': self.bytes[category]}
+                for category, count in self.counts.items()
+            },
+            'bytes': sum(self.bytes.values()),
+            'seconds': self.seconds,
+        }
+
+
+def delete_attachments(upload_folder, attachments):
+    """Elimina gli allegati (con commit) e i file non più usati; restituisce i byte liberati."""
+    released = []
+    freed = 0
+    for attachment in attachments:
+        # La riga va eliminata prima del blob, a cui fa riferimento con una foreign key
+        db.session.delete(attachment)
+        db.session.flush()
+        if attachment.blob_hash:
+            # Un contenuto condiviso è rimosso solo con il suo ultimo allegato
+            if blob_store.release(attachment.blob_hash):
+                released.append(attachment.blob_hash)
+                freed += attachment.file_size
+        elif os.path.exists(attachment.file_path):
+            os.remove(attachment.file_path)
+            freed += attachment.file_size
+    db.session.commit()
+
+    for sha256 in released:
+        blob_store.remove_file(upload_folder, sha256)
+        image_payloads.forget(upload_folder, sha256)
+    return freed
+
+
+def unlinked_attachments(older_than):
+    """Allegati senza messaggio caricati prima di `older_than` secondi fa."""
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    return Attachment.query.filter(Attachment.message_id.is_(None), Attachment.created_at < cutoff)
+
+
+def collect_orphan_attachments(upload_folder, report, older_than=ATTACHMENT_ORPHAN_TTL, batch_size=GC_BATCH_SIZE):
+    """Elimina a lotti gli allegati mai collegati a un messaggio."""
+    last_id = 0
+    while True:
+        batch = unlinked_attachments(older_than).filter(Attachment.id > last_id).order_by(
+            Attachment.id
+        ).limit(batch_size).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        if report.dry_run:
+            # Limite superiore: un contenuto condiviso resta su disco
+            report.add('unlinked_attachments', len(batch), sum(a.file_size for a in batch))
+            db.session.rollback()
+        else:
+            report.add('unlinked_attachments', len(batch), delete_attachments(upload_folder, batch))
+
+
+def stored_file(upload_folder, blob_hash, filename, file_path):
+    """Dove si trova il contenuto di un allegato: il blob, o il file originale."""
+    if blob_hash:
+        return blob_store.blob_path(upload_folder, blob_hash)
+    if os.path.exists(file_path):
+        return file_path
+    return os.path.join(upload_folder, filename)
+
+
+def collect_missing_files(upload_folder, report, batch_size=GC_BATCH_SIZE):
+    """Elimina gli allegati il cui file non c'è più (il download darebbe 404)."""
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Attachment.id, Attachment.blob_hash, Attachment.filename, Attachment.file_path
+        ).filter(Attachment.id > last_id).order_by(Attachment.id).limit(batch_size).all()
+        db.session.rollback()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        missing = [
+            row.id for row in rows
+            if not os.path.exists(stored_file(upload_folder, row.blob_hash, row.filename, row.file_path))
+        ]
+        if not missing:
+            continue
+        report.add('missing_file_attachments', len(missing))
+        if not report.dry_run:
+            delete_attachments(upload_folder, Attachment.query.filter(Attachment.id.in_(missing)).all())
+
+
+def reconcile_blobs(upload_folder, report, batch_size=GC_BATCH_SIZE):
+    """Riallinea ref_count al numero di allegati di ogni blob ed elimina i blob senza allegati.
+
+    Gli aggiornamenti sono condizionati al ref_count letto: se nel frattempo un
+    upload o una cancellazione l'ha cambiato, il blob viene lasciato com'è.
+    """
+    last_hash = ''
+    while True:
+        rows = db.session.query(Blob.sha256, Blob.ref_count, Blob.size).filter(
+            Blob.sha256 > last_hash
+        ).order_by(Blob.sha256).limit(batch_size).all()
+        if not rows:
+            db.session.rollback()
+            break
+        last_hash = rows[-1].sha256
+        references = dict(db.session.query(Attachment.blob_hash, func.count(Attachment.id)).filter(
+            Attachment.blob_hash.in_([row.sha256 for row in rows])
+        ).group_by(Attachment.blob_hash).all())
+
+        released = []
+        for row in rows:
+            actual = references.get(row.sha256, 0)
+            if actual == row.ref_count and actual > 0:
+                continue
+            if actual == 0:
+                report.add('unreferenced_blobs', 1, row.size)
+                if report.dry_run:
+                    continue
+                deleted = Blob.query.filter(
+                    Blob.sha256 == row.sha256,
+                    Blob.ref_count == row.ref_count,
+                    ~Attachment.query.filter(Attachment.blob_hash == row.sha256).exists()
+                ).delete(synchronize_session=False)
+                if deleted:
+                    BlobChunk.query.filter_by(blob_hash=row.sha256).delete(synchronize_session=False)
+                    released.append(row.sha256)
+            else:
+                report.add('blob_ref_counts')
+                if not report.dry_run:
+                    Blob.query.filter(Blob.sha256 == row.sha256, Blob.ref_count == row.ref_count).update(
+                        {Blob.ref_count: actual}, synchronize_session=False
+                    )
+        if report.dry_run:
+            db.session.rollback()
+            continue
+        db.session.commit()
+        for sha256 in released:
+            blob_store.remove_file(upload_folder, sha256)
+            image_payloads.forget(upload_folder, sha256)
+
+
+def _old_files(directory, cutoff, skip=()):
+    """(percorso, nome, dimensione) dei file sotto `directory` modificati prima di `cutoff`."""
+    for root, dirs, names in os.walk(directory):
+        if root == directory:
+            dirs[:] = [d for d in dirs if d not in skip]
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < cutoff:
+                yield path, name, stat.st_size
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _remove(report, category, path, size, cutoff):
+    """Elimina un file non più referenziato, se non è stato toccato nel frattempo."""
+    if report.dry_run:
+        report.add(category, 1, size)
+        return
+    try:
+        # store_temp aggiorna la data di un blob riusato da un nuovo upload
+        if os.stat(path).st_mtime >= cutoff:
+            return
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    report.add(category, 1, size)
+
+
+def _existing_blobs(hashes):
+    rows = db.session.query(Blob.sha256).filter(Blob.sha256.in_(hashes)).all()
+    db.session.rollback()
+    return {row.sha256 for row in rows}
+
+
+def collect_unreferenced_files(upload_folder, report, grace=GC_FILE_GRACE_SECONDS, batch_size=GC_BATCH_SIZE):
+    """Elimina i file su disco a cui non corrisponde nessuna riga."""
+    cutoff = time.time() - grace
+
+    # Blob: blobs/ab/cd/<sha256>
+    blob_files = (
+        (path, name, size)
+        for path, name, size in _old_files(blob_store.blobs_root(upload_folder), cutoff, skip=('tmp',))
+        if _SHA256_RE.match(name)
+    )
+    for batch in _batches(blob_files, batch_size):
+        existing = _existing_blobs([name for _, name, _ in batch])
+        for path, name, size in batch:
+            if name not in existing:
+                _remove(report, 'orphan_blob_files', path, size, cutoff)
+
+    # Payload delle immagini: derived/images/<provider>/ab/<sha256>.b64. Anche
+    # quelli degli allegati caricati prima dei blob non hanno una riga, ma la
+    # lettura ne aggiorna la data: se non sono usati da `grace` secondi sono
+    # solo una cache, ricalcolata alla prossima richiesta.
+    payloads = []
+    for path, name, size in _old_files(image_payloads.cache_root(upload_folder), cutoff):
+        if name.endswith('.tmp'):
+            _remove(report, 'stale_temp_files', path, size, cutoff)
+        elif name.endswith('.b64'):
+            payloads.append((path, name[:-4], size))
+    for batch in _batches(payloads, batch_size):
+        existing = _existing_blobs([digest for _, digest, _ in batch])
+        for path, digest, size in batch:
+            if digest not in existing:
+                _remove(report, 'orphan_image_payloads', path, size, cutoff)
+
+    # File caricati prima dei blob, nella radice di UPLOAD_FOLDER
+    legacy = [
+        (entry.path, entry.name, entry.stat().st_size) for entry in os.scandir(upload_folder)
+        if entry.is_file() and _LEGACY_NAME_RE.match(entry.name) and entry.stat().st_mtime < cutoff
+    ]
+    for batch in _batches(legacy, batch_size):
+        rows = db.session.query(Attachment.filename).filter(
+            Attachment.blob_hash.is_(None), Attachment.filename.in_([name for _, name, _ in batch])
+        ).all()
+        db.session.rollback()
+        referenced = {row.filename for row in rows}
+        for path, name, size in batch:
+            if name not in referenced:
+                _remove(report, 'orphan_legacy_files', path, size, cutoff)
+
+
+def collect_abandoned_uploads(upload_folder, report, grace=GC_FILE_GRACE_SECONDS,
+                              resumable_ttl=upload_ingest.RESUMABLE_UPLOAD_TTL):
+    """Elimina i file temporanei degli upload interrotti e gli upload riprendibili scaduti."""
+    cutoff = time.time() - grace
+    tmp_dir = os.path.join(blob_store.blobs_root(upload_folder), 'tmp')
+    for path, _, size in _old_files(tmp_dir, cutoff):
+        _remove(report, 'stale_temp_files', path, size, cutoff)
+
+    for _, paths, size in upload_ingest.stale_resumables(upload_folder, resumable_ttl):
+        if not report.dry_run:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        report.add('expired_resumable_uploads', 1, size)
+
+
+def remove_empty_directories(upload_folder, report, grace=GC_FILE_GRACE_SECONDS):
+    """Rimuove le directory di shard rimaste vuote (ab/cd dei blob, dei payload)."""
+    cutoff = time.time() - grace
+    for root in (blob_store.blobs_root(upload_folder), image_payloads.cache_root(upload_folder)):
+        for directory, dirs, names in os.walk(root, topdown=False):
+            if directory == root or names or os.path.basename(directory) == 'tmp':
+                continue
+            try:
+                if os.listdir(directory) or os.stat(directory).st_mtime >= cutoff:
+                    continue
+                if not report.dry_run:
+                    # Un upload concorrente ricrea la directory con makedirs
+                    os.rmdir(directory)
+            except OSError:
+                continue
+            report.add('empty_directories')
+
+
+def collect_garbage(upload_folder, dry_run=False, older_than=ATTACHMENT_ORPHAN_TTL,
+                    batch_size=GC_BATCH_SIZE, grace=GC_FILE_GRACE_SECONDS):
+    """Passata completa del GC; restituisce il Report."""
+    # Con UPLOAD_FOLDER sbagliato ogni allegato sembrerebbe senza file
+    if not os.path.isdir(blob_store.blobs_root(upload_folder)) and Blob.query.first() is not None:
+        raise RuntimeError(f'{blob_store.blobs_root(upload_folder)} not found, is UPLOAD_FOLDER correct?')
+    db.session.rollback()
+
+    report = Report(dry_run)
+    started = time.monotonic()
+    collect_orphan_attachments(upload_folder, report, older_than, batch_size)
+    collect_missing_files(upload_folder, report, batch_size)
+    reconcile_blobs(upload_folder, report, batch_size)
+    collect_unreferenced_files(upload_folder, report, grace, batch_size)
+    collect_abandoned_uploads(upload_folder, report, grace)
+    remove_empty_directories(upload_folder, report, grace)
+    report.seconds = round(time.monotonic() - started, 3)
+    return report
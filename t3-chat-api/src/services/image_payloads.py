@@ -0,0 +1,149 @@
+import base64
+import io
+import os
+import threading
+import uuid
+
+# Risoluzione massima utile per provider: oltre questa il provider ridimensiona
+# comunque l'immagine, quindi inviarla più grande costa solo banda e memoria.
+#   openai:    entro 2048x2048, poi lato corto <= 768 (dettaglio "high")
+#   anthropic: lato lungo <= 1568
+#   google:    lato lungo <= 3072
+PROVIDER_LIMITS = {
+    'openai': {'max_side': 2048, 'max_short_side': 768},
+    'anthropic': {'max_side': 1568},
+    'google': {'max_side': 3072},
+}
+
+JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+# Spazio su disco massimo per i payload già codificati (LRU sul tempo di accesso)
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+_usage_lock = threading.Lock()
+_usage = {}  # cartella della cache -> byte occupati
+
+
+def cache_root(upload_folder):
+    return os.path.join(upload_folder, 'derived', 'images')
+
+
+def _cache_path(upload_folder, digest, provider):
+    return os.path.join(cache_root(upload_folder), provider, digest[:2], f'{digest}.b64')
+
+
+def _target_size(width, height, limits):
+    scale = min(1.0, limits['max_side'] / max(width, height))
+    if 'max_short_side' in limits:
+        scale = min(scale, limits['max_short_side'] / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode(image, provider):
+    """Ridimensiona e ricodifica un'immagine PIL per il provider: (mime_type, bytes)."""
+    from PIL import Image
+
+    image.load()
+    width, height = _target_size(image.width, image.height, PROVIDER_LIMITS[provider])
+    if (width, height) != image.size:
+        image = image.resize((width, height), Image.LANCZOS)
+
+    out = io.BytesIO()
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha:
+        image.convert('RGBA').save(out, format='PNG', optimize=True)
+        return 'image/png', out.getvalue()
+    image.convert('RGB').save(out, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return 'image/jpeg', out.getvalue()
+
+
+def _write(upload_folder, path, mime_type, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(mime_type + '\n')
+        f.write(base64.b64encode(data).decode())
+    os.replace(tmp_path, path)
+    _account(upload_folder, os.path.getsize(path))
+
+
+def _read(path):
+    with open(path) as f:
+        mime_type = f.readline().rstrip('\n')
+        data = f.read()
+    # Tempo di accesso aggiornato a mano: l'LRU non dipende da noatime/relatime
+    os.utime(path)
+    return mime_type, data
+
+
+def _account(upload_folder, added):
+    """Aggiorna lo spazio occupato ed elimina i payload meno usati oltre il limite."""
+    root = cache_root(upload_folder)
+    with _usage_lock:
+        if root not in _usage:
+            _usage[root] = sum(
+                os.path.getsize(os.path.join(directory, name))
+                for directory, _, names in os.walk(root) for name in names
+            )
+        else:
+            _usage[root] += added
+        if _usage[root] <= IMAGE_CACHE_MAX_BYTES:
+            return
+        entries = []
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        # Si libera fino al 90% del limite, per non ripetere la scansione a ogni scrittura
+        target = IMAGE_CACHE_MAX_BYTES * 0.9
+        for _, size, path in entries:
+            if _usage[root] <= target:
+                break
+            try:
+                os.remove(path)
+                _usage[root] -= size
+            except FileNotFoundError:
+                pass
+
+
+def precompute(upload_folder, digest, source_path):
+    """Decodifica l'immagine una volta sola e salva il payload di ogni provider."""
+    missing = [p for p in PROVIDER_LIMITS if not os.path.exists(_cache_path(upload_folder, digest, p))]
+    if not missing:
+        return
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        image.seek(0)  # GIF animate: basta il primo fotogramma
+        for provider in missing:
+            mime_type, data = encode(image, provider)
+            _write(upload_folder, _cache_path(upload_folder, digest, provider), mime_type, data)
+
+
+def forget(upload_folder, digest):
+    """Elimina i payload di un contenuto rimosso."""
+    for provider in PROVIDER_LIMITS:
+        path = _cache_path(upload_folder, digest, provider)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def image_payload(upload_folder, digest, source_path, provider):
+    """(mime_type, dati base64) pronti per il provider.
+
+    Normalmente il payload è stato calcolato al caricamento; se manca (allegato
+    precedente o eliminato dall'LRU) viene ricalcolato e rimesso in cache.
+    """
+    path = _cache_path(upload_folder, digest, provider)
+    try:
+        return _read(path)
+    except FileNotFoundError:
+        pass
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        image.seek(0)
+        mime_type, data = encode(image, provider)
+    _write(upload_folder, path, mime_type, data)
+    return mime_type, base64.b64encode(data).decode()
@@ -0,0 +1,311 @@
+import json
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from src.models.user import db, Job
+from src.services import redis_client
+
+# Coda di job in background. Lo stato dei job (argomenti, tentativi, errori) è
+# sempre nella tabella `jobs`, condivisa da web e worker; il broker serve solo
+# a svegliare i worker appena c'è un job nuovo:
+# - database: polling ogni JOB_POLL_SECONDS (più un Event per i job accodati
+#   dallo stesso processo)
+# - redis: BLPOP su una lista di notifica, senza attese
+# Un job viene "preso" con un UPDATE condizionale, quindi più worker (thread,
+# processi o macchine) non eseguono mai lo stesso job due volte in parallelo.
+JOB_BROKER = os.environ.get('JOB_BROKER', 'redis' if redis_client.REDIS_URL else 'database')
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '1'))
+# Un job "running" da più di così è di un worker morto e viene ripreso
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '600'))
+# Attesa prima del tentativo n+1: JOB_RETRY_BASE_SECONDS * 2**(n-1), con jitter
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', '5'))
+JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', '4'))
+# Thread worker avviati dentro il processo web al primo job accodato; 0 quando
+# i job sono eseguiti da `flask jobs worker` (vedi render.yaml)
+JOBS_EMBEDDED_WORKERS = int(os.environ.get('JOBS_EMBEDDED_WORKERS', '1'))
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+WAKEUP_KEY = 'jobs:wakeup'
+
+_tasks = {}
+_schedules = {}
+_embedded = {'pid': None}
+_embedded_lock = threading.Lock()
+
+
+class Task:
+    def __init__(self, name, func, max_attempts, concurrency):
+        self.name = name
+        self.func = func
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+
+
+def task(name, max_attempts=3, concurrency=None):
+    """Registra una funzione come job. `concurrency` limita i job di questo
+    tipo eseguiti insieme da ogni processo worker (None: nessun limite)."""
+    def decorator(func):
+        _tasks[name] = Task(name, func, max_attempts, concurrency)
+        return func
+    return decorator
+
+
+def every(seconds, name):
+    """Accoda il job `name` ogni `seconds` secondi (una volta per intervallo,
+    qualunque sia il numero di worker)."""
+    _schedules[name] = seconds
+
+
+class DatabaseBroker:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+        self._event.clear()
+
+
+class RedisBroker:
+    def __init__(self, client):
+        self.client = client
+        self._local = DatabaseBroker()
+
+    def notify(self):
+        try:
+            self.client.rpush(WAKEUP_KEY, 1)
+            self.client.ltrim(WAKEUP_KEY, -1000, -1)
+        except Exception as e:
+            print(f"Job broker notify error: {e}")
+
+    def wait(self, timeout):
+        try:
+            self.client.blpop(WAKEUP_KEY, timeout=max(1, int(timeout)))
+        except Exception as e:
+            print(f"Job broker wait error: {e}")
+            self._local.wait(timeout)
+
+
+def _make_broker():
+    if JOB_BROKER == 'redis':
+        client = redis_client.get_redis()
+        if client is not None:
+            return RedisBroker(client)
+    return DatabaseBroker()
+
+
+broker = _make_broker()
+
+
+def enqueue(name, payload=None, delay=0, key=None):
+    """Accoda un job (con commit della sessione) e restituisce il suo id.
+
+    Con `key` il job viene accodato una volta sola: se esiste già un job con
+    la stessa chiave restituisce None.
+    """
+    job = Job(
+        name=name,
+        payload=json.dumps(payload or {}),
+        status=STATUS_QUEUED,
+        key=key,
+        attempts=0,
+        max_attempts=_tasks[name].max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    try:
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        db.session.commit()
+        return None
+    db.session.commit()
+    broker.notify()
+    _start_embedded_worker()
+    return job.id
+
+
+def _claimable(now):
+    return or_(
+        and_(Job.status == STATUS_QUEUED, Job.run_at <= now),
+        and_(Job.status == STATUS_RUNNING, Job.locked_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+    )
+
+
+def claim(worker_id, exclude=()):
+    """Prende il prossimo job eseguibile: (id, nome, argomenti, tentativo, max) o None."""
+    now = datetime.utcnow()
+    query = db.session.query(Job.id).filter(_claimable(now))
+    if exclude:
+        query = query.filter(Job.name.notin_(exclude))
+    candidates = [row.id for row in query.order_by(Job.run_at, Job.id).limit(8)]
+    db.session.commit()
+    for job_id in candidates:
+        claimed = Job.query.filter(Job.id == job_id, _claimable(now)).update({
+            Job.status: STATUS_RUNNING,
+            Job.locked_by: worker_id,
+            Job.locked_at: now,
+            Job.attempts: Job.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.query(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts).filter(
+                Job.id == job_id
+            ).one()
+    return None
+
+
+def retry_delay(attempt):
+    delay = JOB_RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def run_job(job, worker_id):
+    """Esegue un job preso con claim() e ne salva l'esito; True se è riuscito."""
+    error = None
+    task_ = _tasks.get(job.name)
+    try:
+        if task_ is None:
+            raise LookupError(f'Unknown job {job.name}')
+        if job.attempts > job.max_attempts:
+            raise RuntimeError('Worker lost while running the job')
+        task_.func(**json.loads(job.payload))
+    except Exception as e:
+        db.session.rollback()
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        print(f"Job {job.id} ({job.name}) attempt {job.attempts} failed: {error}")
+
+    now = datetime.utcnow()
+    if error is None:
+        values = {Job.status: STATUS_DONE, Job.finished_at: now, Job.last_error: None}
+    elif job.attempts < job.max_attempts and task_ is not None:
+        values = {
+            Job.status: STATUS_QUEUED,
+            Job.run_at: now + timedelta(seconds=retry_delay(job.attempts)),
+            Job.last_error: error
+        }
+    else:
+        values = {Job.status: STATUS_FAILED, Job.finished_at: now, Job.last_error: error}
+    values.update({Job.locked_by: None, Job.locked_at: None})
+    # Se il lease è scaduto e il job è stato ripreso da un altro worker, l'esito è suo
+    Job.query.filter(Job.id == job.id, Job.locked_by == worker_id).update(values, synchronize_session=False)
+    db.session.commit()
+    return error is None
+
+
+class Worker:
+    """Esegue i job con `threads` thread, rispettando i limiti di concorrenza
+    dei singoli task, e accoda i job periodici."""
+
+    def __init__(self, app, threads=JOB_WORKER_THREADS):
+        self.app = app
+        self.threads = threads
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running = {}
+        self._next_schedule = {}
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def _saturated(self):
+        return [
+            name for name, task_ in _tasks.items()
+            if task_.concurrency is not None and self._running.get(name, 0) >= task_.concurrency
+        ]
+
+    def _enqueue_periodic(self):
+        now = time.time()
+        for name, seconds in _schedules.items():
+            if now < self._next_schedule.get(name, 0):
+                continue
+            slot = int(now // seconds)
+            self._next_schedule[name] = (slot + 1) * seconds
+            enqueue(name, key=f'{name}:{slot}')
+
+    def _loop(self, index):
+        worker_id = f'{self.name}:{index}'
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    if index == 0:
+                        self._enqueue_periodic()
+                    with self._lock:
+                        job = claim(worker_id, self._saturated())
+                        if job is not None:
+                            self._running[job.name] = self._running.get(job.name, 0) + 1
+                    if job is None:
+                        broker.wait(JOB_POLL_SECONDS)
+                        continue
+                    try:
+                        run_job(job, worker_id)
+                    finally:
+                        with self._lock:
+                            self._running[job.name] -= 1
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Job worker {worker_id} error: {e}")
+                    self._stop.wait(JOB_POLL_SECONDS)
+                finally:
+                    db.session.remove()
+
+    def start(self):
+        threads = [
+            threading.Thread(target=self._loop, args=(index,), name=f'job-worker-{index}', daemon=True)
+            for index in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self):
+        """Esegue i job fino a SIGTERM/SIGINT; i job in corso vengono completati."""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        for thread in self.start():
+            thread.join()
+
+
+def _start_embedded_worker():
+    """Nel processo web, senza `flask jobs worker`, i job girano in thread daemon."""
+    if JOBS_EMBEDDED_WORKERS <= 0 or _embedded['pid'] == os.getpid():
+        return
+    from flask import current_app
+
+    with _embedded_lock:
+        if _embedded['pid'] == os.getpid():
+            return
+        _embedded['pid'] = os.getpid()
+        Worker(current_app._get_current_object(), JOBS_EMBEDDED_WORKERS).start()
+
+
+def stats():
+    """Numero di job per (nome, stato)."""
+    rows = db.session.query(Job.name, Job.status, db.func.count(Job.id)).group_by(Job.name, Job.status).all()
+    return [{'name': name, 'status': status, 'count': count} for name, status, count in rows]
+
+
+def prune(older_than_seconds):
+    """Elimina i job terminati (done/failed) da più di older_than_seconds."""
+    deleted = Job.query.filter(
+        Job.status.in_([STATUS_DONE, STATUS_FAILED]),
+        Job.finished_at < datetime.utcnow() - timedelta(seconds=older_than_seconds)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,389 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Metriche in formato testo Prometheus, senza dipendenze esterne:
+# - latenza delle richieste HTTP per endpoint del blueprint (fino alla
+#   restituzione della Response: per gli stream conta l'apertura, la durata
+#   della generazione è in chat_stream_duration_seconds)
+# - query SQL per richiesta, contate con gli eventi di SQLAlchemy
+# - primo token e token al secondo dei provider AI, errori e fallback
+# - stream in corso e byte caricati
+# Ogni processo tiene i propri contatori. Con METRICS_DIR i worker scrivono
+# una fotografia ogni METRICS_FLUSH_SECONDS in quella cartella e /metrics
+# somma quelle di tutti i processi (i gauge solo dei processi ancora vivi).
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+# Se impostato /metrics richiede "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 4194304, 16777216)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        if not self.labels:
+            # Esposto a 0 anche prima del primo evento
+            self._values[()] = 0
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # Conteggi per bucket non cumulativi (l'ultimo è +Inf), poi somma e totale
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+
+class Collected(_Metric):
+    """Valori letti alla raccolta: ``func()`` restituisce {etichette: valore}.
+
+    Per i contatori che un altro modulo tiene già (ad esempio le statistiche
+    di un LRUCache), senza aggiornare due copie a ogni evento.
+    """
+
+    def __init__(self, name, documentation, labels, kind, func):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.func = func
+
+    def snapshot(self):
+        try:
+            return dict(self.func())
+        except Exception as e:
+            print(f"Metrics collect error for {self.name}: {e}")
+            return {}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def collected(self, name, documentation, labels, kind, func):
+        return self.register(Collected(name, documentation, labels, kind, func))
+
+    def snapshot(self):
+        """Valori di questo processo, serializzabili in JSON."""
+        return {
+            name: {'samples': [[list(key), value] for key, value in metric.snapshot().items()]}
+            for name, metric in self._metrics.items()
+        }
+
+    def collect(self):
+        """Valori da esporre: di questo processo, o di tutti con METRICS_DIR."""
+        if not METRICS_DIR:
+            return {name: metric.snapshot() for name, metric in self._metrics.items()}
+        flush()
+        merged = {name: {} for name in self._metrics}
+        for pid, snapshot in _read_snapshots():
+            alive = _alive(pid)
+            for name, data in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                values = merged[name]
+                for key, value in data['samples']:
+                    key = tuple(key)
+                    if key not in values:
+                        values[key] = value
+                    elif metric.kind == 'histogram':
+                        counts, total, count = values[key]
+                        values[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2]]
+                    else:
+                        values[key] += value
+        return merged
+
+    def render(self):
+        lines = []
+        for name, values in self.collect().items():
+            metric = self._metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(values.items()):
+                labels = [f'{label}="{_escape(v)}"' for label, v in zip(metric.labels, key)]
+                if metric.kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else _number(bound)
+                    bucket_labels = labels + ['le="%s"' % le]
+                    lines.append(f'{name}_bucket{_labels(bucket_labels)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_snapshots():
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                yield int(name[:-5]), json.load(f)
+        except (OSError, ValueError):
+            # File di un worker appena sostituito o illeggibile
+            continue
+
+
+def flush():
+    """Scrive la fotografia di questo processo in METRICS_DIR (scrittura atomica)."""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+_flusher = {'pid': None}
+_flusher_lock = threading.Lock()
+
+
+def _start_flusher():
+    """Thread di scrittura periodica, uno per processo (anche dopo un fork)."""
+    if not METRICS_DIR or _flusher['pid'] == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher['pid'] == os.getpid():
+            return
+        _flusher['pid'] = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(METRICS_FLUSH_SECONDS)
+                try:
+                    flush()
+                except Exception as e:
+                    print(f"Metrics flush error: {e}")
+
+        threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    'http_requests_total', 'HTTP requests by endpoint and status', ('method', 'endpoint', 'status'))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time to return the HTTP response', ('method', 'endpoint'))
+http_request_queries = registry.histogram(
+    'http_request_db_queries', 'SQL queries per HTTP request', ('endpoint',), COUNT_BUCKETS)
+http_request_db_duration = registry.histogram(
+    'http_request_db_seconds', 'Time spent in SQL queries per HTTP request', ('endpoint',))
+db_queries = registry.counter('db_queries_total', 'SQL queries, in and out of requests')
+db_query_duration = registry.counter('db_query_seconds_total', 'Time spent in SQL queries')
+provider_first_token = registry.histogram(
+    'provider_first_token_seconds', 'Time to the first token of an AI provider', ('provider', 'model'))
+provider_tokens_per_second = registry.histogram(
+    'provider_tokens_per_second', 'Estimated tokens per second after the first token', ('provider', 'model'),
+    RATE_BUCKETS)
+provider_tokens = registry.counter(
+    'provider_tokens_total', 'Estimated tokens streamed by AI providers', ('provider', 'model'))
+provider_errors = registry.counter(
+    'provider_errors_total', 'Failed AI provider attempts', ('provider', 'reason'))
+provider_fallbacks = registry.counter(
+    'provider_fallbacks_total', 'Streams answered by a fallback model', ('model', 'fallback'))
+active_streams = registry.gauge('chat_active_streams', 'AI responses being generated')
+stream_duration = registry.histogram(
+    'chat_stream_duration_seconds', 'Duration of AI response generations', ('status',))
+upload_bytes = registry.counter('upload_bytes_total', 'Bytes of stored uploads', ('kind',))
+upload_size = registry.histogram('upload_size_bytes', 'Size of stored uploads', (), SIZE_BUCKETS)
+
+# Cache in-process registrate con register_cache: nome -> LRUCache
+_caches = {}
+
+
+def register_cache(name, cache):
+    """Espone hit, miss, evizioni e dimensione di un LRUCache su /metrics."""
+    _caches[name] = cache
+
+
+def _cache_events():
+    values = {}
+    for name, cache in list(_caches.items()):
+        stats = cache.stats()
+        for event_name in ('hits', 'misses', 'evictions'):
+            values[(name, event_name)] = stats[event_name]
+    return values
+
+
+cache_events = registry.collected(
+    'cache_events_total', 'Lookups and evictions of in-process caches', ('cache', 'event'), 'counter', _cache_events)
+cache_entries = registry.collected(
+    'cache_entries', 'Entries of in-process caches', ('cache',), 'gauge',
+    lambda: {(name,): len(cache) for name, cache in list(_caches.items())})
+
+
+def model_label(model, known):
+    """Il nome del modello se è tra quelli offerti, altrimenti 'other'.
+
+    Il modello arriva dal client: senza questo limite ogni nome inventato
+    creerebbe nuove serie.
+    """
+    return model if model in known else 'other'
+
+
+class _RequestStats:
+    __slots__ = ('started', 'queries', 'db_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Statistiche della richiesta in corso: una ContextVar costa meno di flask.g
+# nell'hook eseguito a ogni query (ed è per greenlet sotto gevent)
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    db_queries.inc()
+    db_query_duration.inc(amount=elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+
+
+def request_stats():
+    """Query e tempo SQL della richiesta in corso, None fuori da una richiesta."""
+    return _request_stats.get()
+
+
+def _before_request():
+    _request_stats.set(_RequestStats())
+
+
+def _after_request(response):
+    stats = _request_stats.get()
+    if stats is not None:
+        _request_stats.set(None)
+        req = request._get_current_object()
+        endpoint = req.endpoint or 'none'
+        http_request_duration.observe(time.perf_counter() - stats.started, req.method, endpoint)
+        http_requests.inc(req.method, endpoint, str(response.status_code))
+        http_request_queries.observe(stats.queries, endpoint)
+        http_request_db_duration.observe(stats.db_seconds, endpoint)
+    return response
+
+
+def instrument_app(app):
+    """Registra gli hook di richiesta e di SQLAlchemy (una volta per processo)."""
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    if METRICS_DIR:
+        app.before_request(_start_flusher)
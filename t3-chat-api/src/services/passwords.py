@@ -0,0 +1,126 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# Hash delle password fuori dal thread della richiesta. bcrypt costa circa
+# 250ms di CPU con 12 round: eseguito nel worker gevent blocca il loop e con
+# lui tutti gli stream dello stesso processo. Qui gira in un pool di thread
+# del sistema operativo (bcrypt rilascia il GIL), mentre la richiesta aspetta
+# senza bloccare gli altri greenlet:
+# - PASSWORD_HASH_THREADS limita i thread per processo, e quindi la CPU che
+#   un'ondata di login può prendere
+# - PASSWORD_HASH_QUEUE limita i login in attesa: oltre si risponde 503
+#   invece di accumulare richieste che scadrebbero comunque
+# - PASSWORD_HASH_NICE abbassa la priorità dei thread (Linux): con la CPU
+#   piena il kernel serve prima le richieste di chat
+# BCRYPT_ROUNDS è il costo delle password nuove; al login una password con un
+# costo diverso viene ricalcolata (needs_rehash), così cambiare il valore non
+# richiede migrazioni.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_THREADS = int(os.environ.get('PASSWORD_HASH_THREADS', '2'))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', '64'))
+PASSWORD_HASH_NICE = int(os.environ.get('PASSWORD_HASH_NICE', '10'))
+# Retry-After quando la coda è piena
+PASSWORD_HASH_BUSY_RETRY_SECONDS = 1
+
+
+class PasswordHasherBusy(Exception):
+    """Troppi hash in attesa: la richiesta va rifiutata e ripetuta più tardi."""
+
+    def __init__(self):
+        super().__init__('Too many password checks in progress')
+        self.retry_after = PASSWORD_HASH_BUSY_RETRY_SECONDS
+
+
+def _lower_priority():
+    if PASSWORD_HASH_NICE <= 0:
+        return
+    try:
+        # Su Linux la priorità è per thread: tid al posto del pid
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PASSWORD_HASH_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched('threading')
+    except ImportError:
+        return False
+
+
+class PasswordHasher:
+    def __init__(self, threads=PASSWORD_HASH_THREADS, queue=PASSWORD_HASH_QUEUE):
+        self.threads = threads
+        self.queue = queue
+        self._pool = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # Un pool per processo: dopo il fork di gunicorn i thread del padre
+        # non esistono più
+        if self._pool is None or self._pid != os.getpid():
+            if _gevent_patched():
+                # Thread veri del sistema operativo; get() fa aspettare solo
+                # il greenlet della richiesta
+                from gevent.threadpool import ThreadPool
+                self._pool = ThreadPool(self.threads)
+            else:
+                self._pool = ThreadPoolExecutor(self.threads, thread_name_prefix='password-hash')
+            self._pid = os.getpid()
+        return self._pool
+
+    def run(self, func, *args):
+        """Esegue func(*args) nel pool e ne restituisce il risultato."""
+        if self.threads <= 0:
+            return func(*args)
+        with self._lock:
+            if self.queue > 0 and self._pending >= self.queue:
+                raise PasswordHasherBusy()
+            self._pending += 1
+        try:
+            pool = self._get_pool()
+            if isinstance(pool, ThreadPoolExecutor):
+                return pool.submit(_in_pool, func, args).result()
+            return pool.apply(_in_pool, (func, args))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+def _in_pool(func, args):
+    # Una chiamata di sistema ogni ~250ms di hash: non serve ricordarsela
+    _lower_priority()
+    return func(*args)
+
+
+def _hash(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+
+
+def _check(password, password_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def hash_password(password):
+    return hasher.run(_hash, password)
+
+
+def check_password(password, password_hash):
+    return hasher.run(_check, password, password_hash)
+
+
+def needs_rehash(password_hash):
+    """True se l'hash non è bcrypt con BCRYPT_ROUNDS round ("$2b$12$...")."""
+    parts = password_hash.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return True
+    return int(parts[2]) != BCRYPT_ROUNDS
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,258 @@
+import hmac
+import json
+import os
+import random
+import signal
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.services import metrics
+
+# Profilazione di singole richieste, opzionale e pensata per la produzione:
+# - una richiesta viene profilata se ha l'header "X-Profile: <PROFILE_TOKEN>"
+#   o a caso con probabilità PROFILE_SAMPLE_RATE (0 = mai)
+# - un campionatore a tempo reale (SIGALRM ogni PROFILE_INTERVAL secondi)
+#   registra lo stack della richiesta: il tempo passato ad aspettare I/O
+#   compare sotto la chiamata che aspetta (sync) o come "(waiting)" quando
+#   sotto gevent gira un altro greenlet
+# - le query SQL della richiesta vengono registrate con la loro durata
+# Il risultato va in PROFILE_DIR: <id>.folded (stack collassati, da aprire con
+# flamegraph.pl o speedscope) e <id>.json (richiesta e query). Una sola
+# richiesta per processo è profilata alla volta e PROFILE_MAX_FILES limita i
+# file tenuti, così il costo resta limitato anche con un campionamento
+# sempre attivo. Per le risposte in streaming si profila solo l'handler, non
+# la generazione.
+# Indipendentemente dal profiling, le richieste più lente di
+# SLOW_REQUEST_SECONDS finiscono nel log con numero e tempo delle query.
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 't3chat-profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '500'))
+# Query tenute nel profilo di una richiesta (le altre sono solo contate)
+PROFILE_MAX_QUERIES = 500
+# 0 disattiva il log delle richieste lente
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', '1.0'))
+
+PROFILE_HEADER = 'X-Profile'
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+# Profilo in corso in questo processo (uno alla volta: il timer è unico)
+_active = None
+_active_lock = threading.Lock()
+# Inizio e profilo della richiesta corrente
+_request_started = ContextVar('request_started', default=None)
+_request_profile = ContextVar('request_profile', default=None)
+_main_thread_ident = None
+
+
+def _os_thread_ident():
+    """Id del thread del sistema operativo, anche con threading patchato da gevent."""
+    try:
+        from gevent.monkey import get_original
+        return get_original('_thread', 'get_ident')()
+    except ImportError:
+        return threading.get_ident()
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class Profile:
+    def __init__(self, method, endpoint, path):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.endpoint = endpoint
+        self.path = path
+        self.started = time.perf_counter()
+        self.last_sample = self.started
+        self.stacks = Counter()
+        self.samples = 0
+        self.queries = []
+        self.query_count = 0
+        self.greenlet = getcurrent() if getcurrent is not None else None
+
+    def sample(self, frame):
+        # Un segnale arrivato in ritardo (il loop di gevent fermo in C) vale
+        # per tutti gli intervalli trascorsi: i campioni restano in tempo reale
+        now = time.perf_counter()
+        weight = max(1, int(round((now - self.last_sample) / PROFILE_INTERVAL)))
+        self.last_sample = now
+        self.samples += weight
+        if self.greenlet is not None and getcurrent() is not self.greenlet:
+            self.stacks['(waiting)'] += weight
+            return
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame.f_code))
+            frame = frame.f_back
+        names.reverse()
+        self.stacks[';'.join(names)] += weight
+
+    def add_query(self, statement, seconds):
+        self.query_count += 1
+        if len(self.queries) < PROFILE_MAX_QUERIES:
+            self.queries.append({'statement': statement, 'seconds': round(seconds, 6)})
+
+    def write(self, status, duration):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.id)
+        with open(f'{base}.folded', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        with open(f'{base}.json', 'w') as f:
+            json.dump({
+                'id': self.id,
+                'method': self.method,
+                'endpoint': self.endpoint,
+                'path': self.path,
+                'status': status,
+                'seconds': round(duration, 6),
+                'interval': PROFILE_INTERVAL,
+                'samples': self.samples,
+                'sql_count': self.query_count,
+                'sql_seconds': round(sum(q['seconds'] for q in self.queries), 6),
+                'sql': self.queries,
+            }, f, indent=1)
+        _prune()
+
+
+def _prune():
+    """Tiene solo gli ultimi PROFILE_MAX_FILES profili."""
+    names = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+    for name in names[:max(0, len(names) - PROFILE_MAX_FILES)]:
+        for extension in ('.json', '.folded'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name[:-5] + extension))
+            except FileNotFoundError:
+                pass
+
+
+def _on_alarm(signum, frame):
+    profile = _active
+    if profile is not None:
+        profile.sample(frame)
+
+
+def _wanted():
+    if PROFILE_TOKEN:
+        header = request.headers.get(PROFILE_HEADER)
+        if header is not None and hmac.compare_digest(header, PROFILE_TOKEN):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _start():
+    """Avvia il profilo della richiesta corrente, se possibile."""
+    global _active
+    # Il segnale arriva solo al thread principale: sotto gevent e con il
+    # worker sync le richieste girano lì, con i worker a thread no
+    if _main_thread_ident is None or _os_thread_ident() != _main_thread_ident:
+        return None
+    if not _active_lock.acquire(blocking=False):
+        return None
+    profile = Profile(request.method, request.endpoint or 'none', request.path)
+    _active = profile
+    _request_profile.set(profile)
+    signal.setitimer(signal.ITIMER_REAL, PROFILE_INTERVAL, PROFILE_INTERVAL)
+    return profile
+
+
+def _stop():
+    global _active
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    _active = None
+    _request_profile.set(None)
+    _active_lock.release()
+
+
+def _before_request():
+    _request_started.set(time.perf_counter())
+    if (PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0) and _wanted():
+        _start()
+
+
+def _after_request(response):
+    started = _request_started.get()
+    if started is None:
+        return response
+    _request_started.set(None)
+    duration = time.perf_counter() - started
+    profile = _request_profile.get()
+    if profile is not None:
+        _stop()
+        try:
+            profile.write(response.status_code, duration)
+            response.headers['X-Profile-Id'] = profile.id
+        except OSError as e:
+            print(f"Profile write error: {e}")
+    if SLOW_REQUEST_SECONDS and duration >= SLOW_REQUEST_SECONDS:
+        entry = {
+            'method': request.method,
+            'endpoint': request.endpoint or 'none',
+            'path': request.path,
+            'status': response.status_code,
+            'seconds': round(duration, 3),
+        }
+        stats = metrics.request_stats()
+        if stats is not None:
+            entry['sql_count'] = stats.queries
+            entry['sql_seconds'] = round(stats.db_seconds, 3)
+        if profile is not None:
+            entry['profile'] = profile.id
+        print(f"Slow request: {json.dumps(entry)}")
+    return response
+
+
+def _teardown_request(error):
+    # Eccezione non gestita: after_request non è stato chiamato
+    profile = _request_profile.get()
+    if profile is not None:
+        _stop()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _request_profile.get() is not None:
+        conn.info['profile_query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('profile_query_started', None)
+    profile = _request_profile.get()
+    if started is not None and profile is not None:
+        profile.add_query(statement, time.perf_counter() - started)
+
+
+def instrument_app(app):
+    """Registra gli hook; va chiamata dopo metrics.instrument_app.
+
+    Gli after_request girano in ordine inverso di registrazione: così il log
+    delle richieste lente legge le statistiche SQL prima che metrics le chiuda.
+    """
+    global _main_thread_ident
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if not (PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0):
+        return
+    if threading.current_thread() is threading.main_thread() and hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGALRM, _on_alarm)
+        _main_thread_ident = _os_thread_ident()
+    else:
+        print("Profiling disabled: the app is not loaded in the main thread")
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
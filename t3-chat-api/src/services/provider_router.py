@@ -0,0 +1,399 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+from src.models.user import db
+from src.services import metrics
+from src.services.client_pool import SDKS
+from src.services.context_builder import estimate_tokens, MESSAGE_OVERHEAD_TOKENS
+
+# Instradamento delle richieste ai provider AI:
+# - timeout per provider sul primo token e tra due chunk, molto più brevi di
+#   quelli degli SDK
+# - circuit breaker per provider: con troppi errori o primi token lenti nella
+#   finestra recente il provider viene saltato per BREAKER_COOLDOWN_SECONDS,
+#   poi una sola richiesta di prova decide se riammetterlo
+# - catena di fallback per modello (MODELS): se un provider fallisce prima del
+#   primo token si prova il modello successivo per cui l'utente ha una chiave
+# - hedging opzionale: se il primo token non arriva entro
+#   PROVIDER_HEDGE_AFTER_SECONDS parte anche il fallback, vince chi risponde
+#   per primo e l'altro viene annullato
+# Ogni tentativo gira in un thread (un greenlet sotto gevent) che passa i chunk
+# al chiamante con una coda, così ogni attesa ha un timeout. Un tentativo
+# annullato chiude la risposta del provider (vedi upstream()). Lo stato dei
+# breaker è per processo.
+
+
+def _setting(name, provider, default):
+    """Valore di NAME_<PROVIDER>, altrimenti di NAME, altrimenti il default."""
+    value = os.environ.get(f'{name}_{provider.upper()}', os.environ.get(name))
+    return float(value) if value is not None else default
+
+
+# Secondi di attesa del primo token, e tra due chunk dello stream
+FIRST_TOKEN_TIMEOUTS = {p: _setting('PROVIDER_FIRST_TOKEN_TIMEOUT', p, 30.0) for p in SDKS}
+IDLE_TIMEOUTS = {p: _setting('PROVIDER_IDLE_TIMEOUT', p, 60.0) for p in SDKS}
+# 0 disattiva l'hedging (raddoppia i token spesi per le richieste lente)
+HEDGE_AFTER_SECONDS = float(os.environ.get('PROVIDER_HEDGE_AFTER_SECONDS', '0'))
+
+BREAKER_WINDOW_SECONDS = float(os.environ.get('BREAKER_WINDOW_SECONDS', '60'))
+BREAKER_MIN_REQUESTS = int(os.environ.get('BREAKER_MIN_REQUESTS', '5'))
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', '0.5'))
+# Un primo token più lento di così conta come risposta lenta
+BREAKER_SLOW_SECONDS = float(os.environ.get('BREAKER_SLOW_SECONDS', '10'))
+BREAKER_SLOW_RATE = float(os.environ.get('BREAKER_SLOW_RATE', '0.8'))
+BREAKER_COOLDOWN_SECONDS = float(os.environ.get('BREAKER_COOLDOWN_SECONDS', '30'))
+
+# Modelli offerti da GET /models, ognuno con i modelli da provare se il suo
+# provider non risponde. MODEL_FALLBACKS (JSON) sostituisce o aggiunge catene.
+MODELS = {
+    'Gemini 2.5 Flash': ['GPT-4o', 'Claude 3.5 Sonnet'],
+    'GPT-4o': ['Claude 3.5 Sonnet', 'Gemini 2.5 Flash'],
+    'Claude 3.5 Sonnet': ['GPT-4o', 'Gemini 2.5 Flash'],
+    'DeepSeek V3': ['GPT-4o', 'Gemini 2.5 Flash'],
+}
+MODELS.update(json.loads(os.environ.get('MODEL_FALLBACKS', '{}')))
+
+PROVIDER_NAMES = {'openai': 'OpenAI', 'anthropic': 'Anthropic', 'google': 'Google', 'deepseek': 'DeepSeek'}
+
+
+class ProviderError(Exception):
+    """Errore di un provider a stream iniziato: la risposta resta parziale."""
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def error_reason(error):
+    """Etichetta breve dell'errore per provider_errors_total."""
+    if isinstance(error, CircuitOpen):
+        return 'circuit_open'
+    if isinstance(error, TimeoutError):
+        return 'timeout'
+    return type(error).__name__
+
+
+def error_message(provider, error):
+    if isinstance(error, CircuitOpen):
+        error = 'servizio temporaneamente non disponibile'
+    elif isinstance(error, TimeoutError):
+        error = 'nessuna risposta entro il tempo limite'
+    return f"Errore {PROVIDER_NAMES.get(provider, provider)}: {error}"
+
+
+class CircuitBreaker:
+    """Stato di salute di un provider: closed (in uso), open (saltato), half_open (in prova)."""
+
+    def __init__(self, name, window=BREAKER_WINDOW_SECONDS, min_requests=BREAKER_MIN_REQUESTS,
+                 error_rate=BREAKER_ERROR_RATE, slow_rate=BREAKER_SLOW_RATE, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = None
+        self.trips = 0
+        self._outcomes = deque()  # (istante, errore, lenta)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True se una richiesta può andare al provider."""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open':
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, failed, slow=False):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                # Esito di una richiesta partita prima dell'apertura
+                return
+            if self.state == 'half_open':
+                self._probing = False
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                return
+            self._outcomes.append((now, failed, slow))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+            total = len(self._outcomes)
+            if total < self.min_requests:
+                return
+            errors = sum(1 for _, f, _ in self._outcomes if f)
+            slows = sum(1 for _, f, s in self._outcomes if s and not f)
+            if errors >= total * self.error_rate or slows >= total * self.slow_rate:
+                self._open(now)
+
+    def abandon(self):
+        """Richiesta annullata dal chiamante: non dice nulla sulla salute del provider."""
+        with self._lock:
+            self._probing = False
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.trips += 1
+        self._outcomes.clear()
+        print(f"Circuit breaker {self.name}: open for {self.cooldown}s")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'trips': self.trips,
+                'requests': len(self._outcomes),
+                'errors': sum(1 for _, f, _ in self._outcomes if f),
+                'slow': sum(1 for _, f, s in self._outcomes if s and not f),
+            }
+
+
+# Tentativo eseguito dal thread corrente (un greenlet sotto gevent), per upstream()
+_local = threading.local()
+
+
+def upstream(response):
+    """Registra la risposta in streaming del provider per il tentativo in corso.
+
+    Le funzioni di streaming la passano qui appena aperta: Attempt.cancel() la
+    chiude, e con lei la connessione HTTP, senza aspettare il prossimo chunk.
+    Restituisce `response`.
+    """
+    attempt = getattr(_local, 'attempt', None)
+    if attempt is not None:
+        attempt.track(response)
+    return response
+
+
+def _close(response):
+    try:
+        response.close()
+    except Exception as e:
+        print(f"Error closing provider stream: {e!r}")
+
+
+class Attempt:
+    """Stream di un modello letto in un thread; i chunk vanno nella coda `events`."""
+
+    def __init__(self, app, route, open_stream, events, breaker):
+        self.model, self.provider, api_key = route
+        self.breaker = breaker
+        self.started = time.monotonic()
+        self.first_token_seconds = None
+        self._events = events
+        self._cancelled = threading.Event()
+        self._settled = False
+        self._response = None
+        self._lock = threading.Lock()
+        thread = threading.Thread(
+            target=self._run, args=(app, open_stream, api_key),
+            name=f'provider-{self.provider}', daemon=True
+        )
+        thread.start()
+
+    def _run(self, app, open_stream, api_key):
+        _local.attempt = self
+        with app.app_context():
+            try:
+                chunks = open_stream(self.model, self.provider, api_key)
+                try:
+                    for chunk in chunks:
+                        if self._cancelled.is_set():
+                            return
+                        self._events.put((self, 'chunk', chunk))
+                finally:
+                    chunks.close()
+                self._events.put((self, 'done', None))
+            except Exception as e:
+                # Dopo cancel() la lettura fallisce sulla connessione chiusa
+                if not self._cancelled.is_set():
+                    self._events.put((self, 'error', e))
+            finally:
+                _local.attempt = None
+                db.session.remove()
+
+    def track(self, response):
+        with self._lock:
+            self._response = response
+            cancelled = self._cancelled.is_set()
+        if cancelled:
+            _close(response)
+
+    def cancel(self):
+        """Chiude la risposta del provider, se registrata con upstream(); altrimenti
+        il thread si ferma al prossimo chunk. Quelli già in coda vengono ignorati."""
+        with self._lock:
+            self._cancelled.set()
+            response, self._response = self._response, None
+        if response is not None:
+            _close(response)
+
+    def settle(self, failed, slow=False):
+        if not self._settled:
+            self._settled = True
+            self.breaker.record(failed, slow)
+
+    def abandon(self):
+        self.cancel()
+        if not self._settled:
+            self._settled = True
+            self.breaker.abandon()
+
+
+class ProviderRouter:
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, provider):
+        with self._lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker(provider)
+            return self._breakers[provider]
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {provider: breaker.stats() for provider, breaker in breakers.items()}
+
+    def _start_next(self, app, pending, open_stream, events, errors):
+        """Avvia il prossimo modello della catena il cui provider è disponibile."""
+        while pending:
+            route = pending.popleft()
+            breaker = self.breaker(route[1])
+            if breaker.allow():
+                return Attempt(app, route, open_stream, events, breaker)
+            errors.append((route[1], CircuitOpen()))
+        return None
+
+    @staticmethod
+    def _next_event(events, winner):
+        """Prossimo evento del tentativo vincente, ignorando quelli degli annullati."""
+        deadline = time.monotonic() + IDLE_TIMEOUTS[winner.provider]
+        while True:
+            try:
+                attempt, kind, value = events.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return 'error', TimeoutError()
+            if attempt is winner:
+                return kind, value
+
+    def stream(self, routes, open_stream):
+        """Chunk della risposta del primo modello di `routes` che risponde.
+
+        `routes` sono (modello, provider, chiave API) in ordine di preferenza;
+        open_stream(modello, provider, chiave) restituisce il generatore dei
+        chunk del provider, che solleva un'eccezione se la chiamata fallisce.
+        Se nessun provider produce il primo token viene restituito il messaggio
+        di errore del primo; un errore a stream iniziato solleva ProviderError.
+        """
+        app = current_app._get_current_object()
+        events = queue.Queue()
+        pending = deque(routes)
+        attempts = []
+        errors = []
+        winner = None
+        hedged = HEDGE_AFTER_SECONDS <= 0
+        try:
+            while winner is None:
+                if not attempts:
+                    attempt = self._start_next(app, pending, open_stream, events, errors)
+                    if attempt is None:
+                        break
+                    attempts.append(attempt)
+                deadlines = [a.started + FIRST_TOKEN_TIMEOUTS[a.provider] for a in attempts]
+                hedge_at = None if hedged or not pending else attempts[0].started + HEDGE_AFTER_SECONDS
+                if hedge_at is not None:
+                    deadlines.append(hedge_at)
+                try:
+                    attempt, kind, value = events.get(timeout=max(0, min(deadlines) - time.monotonic()))
+                except queue.Empty:
+                    now = time.monotonic()
+                    for attempt in list(attempts):
+                        if now >= attempt.started + FIRST_TOKEN_TIMEOUTS[attempt.provider]:
+                            attempt.cancel()
+                            attempt.settle(failed=True)
+                            attempts.remove(attempt)
+                            errors.append((attempt.provider, TimeoutError()))
+                    if hedge_at is not None and now >= hedge_at:
+                        hedged = True
+                        attempt = self._start_next(app, pending, open_stream, events, errors)
+                        if attempt is not None:
+                            attempts.append(attempt)
+                    continue
+                if attempt not in attempts:
+                    continue
+                if kind == 'error':
+                    attempt.settle(failed=True)
+                    attempts.remove(attempt)
+                    errors.append((attempt.provider, value))
+                    continue
+                winner = attempt
+                winner.first_token_seconds = time.monotonic() - winner.started
+
+            for attempt in attempts:
+                if attempt is winner:
+                    continue
+                if winner.started > attempt.started:
+                    # Superato dall'hedge: conta come risposta lenta
+                    attempt.cancel()
+                    attempt.settle(failed=False, slow=True)
+                else:
+                    attempt.abandon()
+            for provider, error in errors:
+                print(f"Provider {provider} failed: {error!r}")
+                metrics.provider_errors.inc(provider, error_reason(error))
+
+            if winner is None:
+                provider, error = errors[0]
+                yield error_message(provider, error)
+                return
+            model = metrics.model_label(winner.model, MODELS)
+            metrics.provider_first_token.observe(winner.first_token_seconds, winner.provider, model)
+            if winner.model != routes[0][0]:
+                print(f"Provider fallback: {routes[0][0]} answered by {winner.model}")
+                metrics.provider_fallbacks.inc(metrics.model_label(routes[0][0], MODELS), model)
+
+            streamed = []
+            try:
+                while kind == 'chunk':
+                    streamed.append(value)
+                    yield value
+                    kind, value = self._next_event(events, winner)
+            finally:
+                # Anche per le risposte interrotte: i token sono stati generati
+                tokens = estimate_tokens(''.join(streamed)) - MESSAGE_OVERHEAD_TOKENS
+                metrics.provider_tokens.inc(winner.provider, model, amount=tokens)
+                seconds = time.monotonic() - winner.started - winner.first_token_seconds
+                if seconds > 0:
+                    metrics.provider_tokens_per_second.observe(tokens / seconds, winner.provider, model)
+            if kind == 'error':
+                winner.cancel()
+                winner.settle(failed=True)
+                metrics.provider_errors.inc(winner.provider, 'stream_' + error_reason(value))
+                raise ProviderError(error_message(winner.provider, value))
+            winner.settle(failed=False, slow=winner.first_token_seconds >= BREAKER_SLOW_SECONDS)
+        finally:
+            # Anche se il chiamante chiude lo stream (client disconnesso)
+            for attempt in attempts:
+                attempt.abandon()
+
+
+provider_router = ProviderRouter()
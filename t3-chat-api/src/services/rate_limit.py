@@ -0,0 +1,287 @@
+import math
+import os
+import threading
+import time
+import uuid
+
+from src.services import redis_client
+from src.services.cache import LRUCache
+
+# Limiti di uso per utente e per provider, controllati prima di qualunque
+# scrittura sul database:
+# - stream in corso (un utente non può occupare tutti i worker)
+# - richieste al minuto e token al minuto (token bucket: si può consumare di
+#   colpo un minuto di quota, poi si ricarica in modo continuo)
+# I token di una risposta si conoscono solo alla fine: all'ingresso si scala la
+# stima del prompt, all'uscita quella della risposta, e il bucket può andare in
+# negativo bloccando le richieste successive finché non si ricarica.
+# Con Redis i contatori sono condivisi tra worker e processi (uno script Lua
+# controlla e aggiorna tutti i limiti in modo atomico); senza, sono per
+# processo. Se Redis non risponde le richieste passano.
+# 0 = nessun limite.
+USER_LIMITS = {
+    'streams': int(os.environ.get('RATE_LIMIT_USER_STREAMS', '4')),
+    'rpm': int(os.environ.get('RATE_LIMIT_USER_RPM', '30')),
+    'tpm': int(os.environ.get('RATE_LIMIT_USER_TPM', '200000')),
+}
+PROVIDER_LIMITS = {
+    'streams': int(os.environ.get('RATE_LIMIT_PROVIDER_STREAMS', '0')),
+    'rpm': int(os.environ.get('RATE_LIMIT_PROVIDER_RPM', '0')),
+    'tpm': int(os.environ.get('RATE_LIMIT_PROVIDER_TPM', '0')),
+}
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'redis' if redis_client.REDIS_URL else 'memory')
+# Uno stream il cui processo è morto senza rilasciarlo smette di contare dopo così
+RATE_LIMIT_STREAM_LEASE_SECONDS = float(os.environ.get('RATE_LIMIT_STREAM_LEASE_SECONDS', '900'))
+# Retry-After quando il limite è sugli stream in corso (non si sa quando finiranno)
+RATE_LIMIT_BUSY_RETRY_SECONDS = 2
+
+REDIS_PREFIX = 'ratelimit:'
+
+
+class RateLimited(Exception):
+    """Richiesta rifiutata: `retry_after` secondi prima di riprovare."""
+
+    def __init__(self, scope, limit, retry_after):
+        super().__init__(f'Rate limit exceeded ({scope} {limit})')
+        self.scope = scope
+        self.limit = limit
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class Admission:
+    """Richiesta ammessa: va chiusa con RateLimiter.release() a fine stream."""
+
+    def __init__(self, scopes, lease):
+        self.scopes = scopes
+        self.lease = lease
+        self.released = False
+
+
+def _refill(tokens, updated, capacity, now):
+    return min(capacity, tokens + (now - updated) * capacity / 60.0)
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (scope, limite) -> [token, ultimo aggiornamento]; un bucket inattivo
+        # per più di un minuto è di nuovo pieno e può essere scartato
+        self._buckets = LRUCache(maxsize=100000, ttl=120, sliding=True)
+        self._leases = {}  # scope -> {lease: scadenza}
+
+    def _bucket(self, scope, kind, capacity, now):
+        bucket = self._buckets.get((scope, kind))
+        if bucket is None:
+            bucket = self._buckets.set((scope, kind), [float(capacity), now])
+        bucket[0] = _refill(bucket[0], bucket[1], capacity, now)
+        bucket[1] = now
+        return bucket
+
+    def acquire(self, scopes, lease, tokens):
+        now = time.monotonic()
+        with self._lock:
+            for scope, limits in scopes:
+                if limits['streams']:
+                    leases = self._leases.get(scope, {})
+                    for expired in [key for key, expiry in leases.items() if expiry < now]:
+                        del leases[expired]
+                    if len(leases) >= limits['streams']:
+                        raise RateLimited(scope, 'streams', RATE_LIMIT_BUSY_RETRY_SECONDS)
+                for kind, cost in (('rpm', 1), ('tpm', tokens)):
+                    if limits[kind]:
+                        bucket = self._bucket(scope, kind, limits[kind], now)
+                        if bucket[0] < min(cost, limits[kind]):
+                            rate = limits[kind] / 60.0
+                            raise RateLimited(scope, kind, (min(cost, limits[kind]) - bucket[0]) / rate)
+            for scope, limits in scopes:
+                if limits['streams']:
+                    self._leases.setdefault(scope, {})[lease] = now + RATE_LIMIT_STREAM_LEASE_SECONDS
+                for kind, cost in (('rpm', 1), ('tpm', tokens)):
+                    if limits[kind]:
+                        self._bucket(scope, kind, limits[kind], now)[0] -= cost
+
+    def charge(self, scopes, tokens):
+        now = time.monotonic()
+        with self._lock:
+            for scope, limits in scopes:
+                if limits['tpm']:
+                    self._bucket(scope, 'tpm', limits['tpm'], now)[0] -= tokens
+
+    def release(self, scopes, lease):
+        with self._lock:
+            for scope, _ in scopes:
+                leases = self._leases.get(scope)
+                if leases is not None:
+                    leases.pop(lease, None)
+                    if not leases:
+                        del self._leases[scope]
+
+
+# KEYS: per ogni scope, bucket rpm, bucket tpm, zset degli stream in corso
+# ARGV: adesso (s), lease, scadenza del lease, token, poi per ogni scope
+#       limite stream, rpm, tpm
+# Restituisce {0} se ammessa, altrimenti {indice dello scope, tipo, attesa in ms}
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = {1, tonumber(ARGV[4])}
+local kinds = {'rpm', 'tpm'}
+local scopes = #KEYS / 3
+local levels = {}
+for i = 1, scopes do
+    local streams = tonumber(ARGV[4 + (i - 1) * 3 + 1])
+    if streams > 0 then
+        local leases = KEYS[(i - 1) * 3 + 3]
+        redis.call('ZREMRANGEBYSCORE', leases, '-inf', now)
+        if redis.call('ZCARD', leases) >= streams then
+            return {i, 'streams', 0}
+        end
+    end
+    for k = 1, 2 do
+        local capacity = tonumber(ARGV[4 + (i - 1) * 3 + 1 + k])
+        if capacity > 0 then
+            local key = KEYS[(i - 1) * 3 + k]
+            local state = redis.call('HMGET', key, 'tokens', 'updated')
+            local tokens = tonumber(state[1]) or capacity
+            local updated = tonumber(state[2]) or now
+            tokens = math.min(capacity, tokens + (now - updated) * capacity / 60)
+            local needed = math.min(cost[k], capacity)
+            if tokens < needed then
+                return {i, kinds[k], math.ceil((needed - tokens) / (capacity / 60) * 1000)}
+            end
+            levels[(i - 1) * 2 + k] = tokens
+        end
+    end
+end
+for i = 1, scopes do
+    local streams = tonumber(ARGV[4 + (i - 1) * 3 + 1])
+    if streams > 0 then
+        local leases = KEYS[(i - 1) * 3 + 3]
+        redis.call('ZADD', leases, tonumber(ARGV[3]), ARGV[2])
+        redis.call('EXPIRE', leases, math.ceil(tonumber(ARGV[3]) - now) + 60)
+    end
+    for k = 1, 2 do
+        local level = levels[(i - 1) * 2 + k]
+        if level then
+            local key = KEYS[(i - 1) * 3 + k]
+            redis.call('HSET', key, 'tokens', tostring(level - cost[k]), 'updated', tostring(now))
+            redis.call('EXPIRE', key, 120)
+        end
+    end
+end
+return {0}
+"""
+
+# KEYS: bucket tpm degli scope; ARGV: adesso, token, poi la capacità di ogni bucket
+CHARGE_SCRIPT = """
+local now = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[2 + i])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * capacity / 60) - tonumber(ARGV[2])
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[i], 120)
+end
+return 0
+"""
+
+
+class RedisBackend:
+    def __init__(self, client):
+        self.client = client
+        self._acquire = client.register_script(ACQUIRE_SCRIPT)
+        self._charge = client.register_script(CHARGE_SCRIPT)
+
+    @staticmethod
+    def _keys(scope):
+        return [f'{REDIS_PREFIX}{scope}:rpm', f'{REDIS_PREFIX}{scope}:tpm', f'{REDIS_PREFIX}{scope}:streams']
+
+    def acquire(self, scopes, lease, tokens):
+        # Il tempo del server Redis è lo stesso per tutti i processi
+        seconds, micros = self.client.time()
+        now = seconds + micros / 1e6
+        keys = []
+        args = [now, lease, now + RATE_LIMIT_STREAM_LEASE_SECONDS, tokens]
+        for scope, limits in scopes:
+            keys += self._keys(scope)
+            args += [limits['streams'], limits['rpm'], limits['tpm']]
+        result = self._acquire(keys=keys, args=args)
+        if int(result[0]) != 0:
+            scope, _ = scopes[int(result[0]) - 1]
+            kind = result[1].decode() if isinstance(result[1], bytes) else result[1]
+            retry_after = RATE_LIMIT_BUSY_RETRY_SECONDS if kind == 'streams' else int(result[2]) / 1000.0
+            raise RateLimited(scope, kind, retry_after)
+
+    def charge(self, scopes, tokens):
+        scopes = [(scope, limits) for scope, limits in scopes if limits['tpm']]
+        if not scopes:
+            return
+        seconds, micros = self.client.time()
+        self._charge(
+            keys=[self._keys(scope)[1] for scope, _ in scopes],
+            args=[seconds + micros / 1e6, tokens] + [limits['tpm'] for _, limits in scopes]
+        )
+
+    def release(self, scopes, lease):
+        pipe = self.client.pipeline()
+        for scope, _ in scopes:
+            pipe.zrem(self._keys(scope)[2], lease)
+        pipe.execute()
+
+
+class RateLimiter:
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            client = redis_client.get_redis() if RATE_LIMIT_BACKEND == 'redis' else None
+            self._backend = RedisBackend(client) if client is not None else MemoryBackend()
+        return self._backend
+
+    @staticmethod
+    def _scopes(user_id, provider):
+        scopes = [(f'user:{int(user_id)}', USER_LIMITS)]
+        if provider:
+            scopes.append((f'provider:{provider}', PROVIDER_LIMITS))
+        return [(scope, limits) for scope, limits in scopes if any(limits.values())]
+
+    def admit(self, user_id, provider, tokens):
+        """Ammette una richiesta di `tokens` token stimati o solleva RateLimited."""
+        scopes = self._scopes(user_id, provider)
+        admission = Admission(scopes, uuid.uuid4().hex)
+        if scopes:
+            try:
+                self.backend.acquire(scopes, admission.lease, tokens)
+            except RateLimited:
+                raise
+            except Exception as e:
+                print(f"Rate limiter error, request allowed: {e}")
+        return admission
+
+    def charge(self, admission, tokens):
+        """Scala dalla quota i token della risposta, noti solo alla fine."""
+        if admission.scopes and tokens:
+            try:
+                self.backend.charge(admission.scopes, tokens)
+            except Exception as e:
+                print(f"Rate limiter error: {e}")
+
+    def charge_user(self, user_id, provider, tokens):
+        """Scala dalla quota i token di una richiesta fatta fuori da uno stream (es. i titoli)."""
+        self.charge(Admission(self._scopes(user_id, provider), None), tokens)
+
+    def release(self, admission):
+        """Fine dello stream: libera il posto tra gli stream in corso (una volta sola)."""
+        if admission.released or not admission.scopes:
+            return
+        admission.released = True
+        try:
+            self.backend.release(admission.scopes, admission.lease)
+        except Exception as e:
+            print(f"Rate limiter error: {e}")
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+
+# Redis è opzionale: se REDIS_URL non è configurato (o il pacchetto redis non è
+# installato) ogni funzione degrada a no-op e le cache restano per-processo.
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# Attesa prima di riconnettere un subscriber, raddoppiata a ogni tentativo fallito
+SUBSCRIBE_BACKOFF_SECONDS = 1
+SUBSCRIBE_MAX_BACKOFF_SECONDS = 30
+
+_client = None
+_client_lock = threading.Lock()
+_subscribers = {}
+
+
+def get_redis():
+    """Client Redis condiviso, oppure None se Redis non è disponibile."""
+    global _client
+    if not REDIS_URL:
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                try:
+                    import redis
+                except ImportError:
+                    return None
+                _client = redis.Redis.from_url(REDIS_URL)
+    return _client
+
+
+def publish(channel, message):
+    """Pubblica un messaggio JSON su un canale; False se Redis non è disponibile."""
+    client = get_redis()
+    if client is None:
+        return False
+    try:
+        client.publish(channel, json.dumps(message))
+        return True
+    except Exception as e:
+        print(f"Redis publish error on {channel}: {e}")
+        return False
+
+
+def subscribe(channel, callback, on_reconnect=None):
+    """Chiama ``callback(message)`` per ogni messaggio JSON ricevuto sul canale.
+
+    L'ascolto avviene in un thread daemon, uno per canale e per processo. Se
+    la connessione cade il thread si riconnette con un'attesa crescente (fino
+    a SUBSCRIBE_MAX_BACKOFF_SECONDS) e chiama ``on_reconnect()``: i messaggi
+    pubblicati nel frattempo sono persi.
+    """
+    client = get_redis()
+    if client is None:
+        return False
+    with _client_lock:
+        if channel in _subscribers:
+            return True
+
+        def listen():
+            delay = SUBSCRIBE_BACKOFF_SECONDS
+            connected_before = False
+            while True:
+                pubsub = None
+                try:
+                    pubsub = client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(channel)
+                    if connected_before and on_reconnect is not None:
+                        on_reconnect()
+                    connected_before = True
+                    delay = SUBSCRIBE_BACKOFF_SECONDS
+                    for item in pubsub.listen():
+                        try:
+                            callback(json.loads(item['data']))
+                        except Exception as e:
+                            print(f"Redis subscriber error on {channel}: {e}")
+                except Exception as e:
+                    print(f"Redis subscription to {channel} lost: {e}; retrying in {delay:.0f}s")
+                finally:
+                    if pubsub is not None:
+                        try:
+                            pubsub.close()
+                        except Exception:
+                            pass
+                time.sleep(delay)
+                delay = min(delay * 2, SUBSCRIBE_MAX_BACKOFF_SECONDS)
+
+        thread = threading.Thread(target=listen, name=f'redis-sub-{channel}', daemon=True)
+        _subscribers[channel] = thread
+        thread.start()
+    return True
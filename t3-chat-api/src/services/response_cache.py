@@ -0,0 +1,251 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from src.models.user import db, Blob
+from src.services.cache import LRUCache
+
+# Cache delle risposte AI: disattivata di default, si abilita con RESPONSE_CACHE_ENABLED=1
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '5000'))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '86400'))
+# Soglia di similarità coseno per il livello semantico (0 = solo corrispondenza esatta)
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', '0'))
+# Candidati confrontati per ogni (modello, allegati, contesto)
+RESPONSE_CACHE_SIMILAR_CANDIDATES = int(os.environ.get('RESPONSE_CACHE_SIMILAR_CANDIDATES', '500'))
+
+# Le risposte di errore dei provider non vanno mai in cache
+ERROR_PREFIXES = ('⚠️', 'Errore')
+
+# Dimensione dei chunk quando una risposta in cache viene riprodotta in streaming
+REPLAY_CHUNK_CHARS = 64
+
+_WORD_RE = re.compile(r'\w+')
+# Parole che non cambiano il significato del prompt; negazioni, congiunzioni
+# e numeri restano nella firma
+_FUNCTION_WORDS = frozenset('''
+    a an the of to in on at by for with from
+    il lo la i gli le un uno una di da con su per tra fra
+    del dello della dei degli delle al allo alla ai agli alle
+    dal dallo dalla dai dagli dalle nel nello nella nei negli nelle
+    sul sullo sulla sui sugli sulle
+'''.split())
+_VECTOR_DIM = 1 << 18
+
+_attachment_digests = LRUCache(maxsize=4096)
+
+
+def normalize_prompt(text):
+    """Forma canonica del prompt: maiuscole, spazi e punteggiatura finale non contano."""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return ' '.join(text.split()).rstrip(' .!?')
+
+
+def attachment_digest(attachment):
+    """SHA-256 del contenuto di un allegato, ricalcolato solo se il file cambia.
+
+    None se il file non si può leggere: la risposta non va in cache.
+    """
+    if getattr(attachment, 'blob_hash', None):
+        return attachment.blob_hash
+    try:
+        stat = os.stat(attachment.file_path)
+        key = (attachment.file_path, stat.st_size, stat.st_mtime_ns)
+        digest = _attachment_digests.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(attachment.file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(block)
+            digest = _attachment_digests.set(key, sha.hexdigest())
+    except OSError:
+        return None
+    return digest
+
+
+def attachment_digests(attachments):
+    """Digest ordinati degli allegati, o None se uno non è leggibile.
+
+    Per i documenti conta anche lo stato dell'estrazione del testo: una
+    risposta data mentre il testo era 'pending' non vale più quando è 'ready'.
+    """
+    if not attachments:
+        return []
+    hashes = [a.blob_hash for a in attachments if getattr(a, 'blob_hash', None)]
+    statuses = {}
+    if hashes:
+        statuses = dict(db.session.query(Blob.sha256, Blob.text_status).filter(Blob.sha256.in_(hashes)).all())
+    digests = []
+    for attachment in attachments:
+        digest = attachment_digest(attachment)
+        if digest is None:
+            return None
+        status = statuses.get(digest)
+        digests.append(f'{digest}:{status}' if status else digest)
+    return sorted(digests)
+
+
+def context_digest(history):
+    return hashlib.sha256(json.dumps(history or [], sort_keys=True).encode()).hexdigest()
+
+
+def embed(text):
+    """Vettore sparso e normalizzato di parole e bigrammi (hashing trick).
+
+    Non serve un modello di embedding: basta a ordinare prompt quasi
+    identici ("come installo X su linux" / "su linux come installo X"). Si
+    può sostituire con ResponseCache(embedder=...).
+    """
+    words = _WORD_RE.findall(text)
+    features = words + [a + ' ' + b for a, b in zip(words, words[1:])]
+    vector = {}
+    for feature in features:
+        index = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big') % _VECTOR_DIM
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {index: value / norm for index, value in vector.items()}
+
+
+def signature(text):
+    """Insieme delle parole di contenuto del prompt, negazioni e numeri compresi.
+
+    Il livello semantico serve una risposta solo se la firma coincide: la
+    similarità coseno da sola non distingue "X è sicuro" da "X non è sicuro".
+    """
+    return frozenset(word for word in _WORD_RE.findall(text) if word not in _FUNCTION_WORDS)
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+
+class ResponseCache:
+    """Cache delle risposte AI per (utente, modello, prompt normalizzato, allegati, contesto).
+
+    Livello esatto: LRU con TTL sulla chiave completa. Livello semantico
+    (opzionale): tra le risposte con lo stesso ambito (utente, modello,
+    allegati e contesto) si cerca il prompt più simile sopra la soglia, tra
+    quelli con le stesse parole di contenuto (vedi signature()).
+    Le risposte non sono mai condivise tra utenti: dipendono dalla chiave API
+    di ciascuno e possono contenere dati personali.
+
+    L'ambito si calcola una volta con scope() prima di generare la risposta e
+    si passa a lookup() e store(): così la risposta è salvata con lo stato dei
+    documenti con cui è stata generata.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 similarity=RESPONSE_CACHE_SIMILARITY, embedder=embed, enabled=RESPONSE_CACHE_ENABLED):
+        self.enabled = enabled
+        self.similarity = similarity
+        self.embedder = embedder
+        self._entries = LRUCache(maxsize=maxsize, ttl=ttl, on_evict=self._on_evict)
+        self._index = {}  # scope -> OrderedDict(chiave -> (firma, vettore))
+        self._index_lock = threading.Lock()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def scope(self, user_id, model, attachments=None, history=None):
+        """Ambito della cache per una richiesta, o None se la risposta non va in cache."""
+        if not self.enabled:
+            return None
+        digests = attachment_digests(attachments)
+        if digests is None:
+            return None
+        parts = [str(user_id), model, digests, context_digest(history)]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    @staticmethod
+    def _key(scope, prompt):
+        return hashlib.sha256(f'{scope}\n{prompt}'.encode()).hexdigest()
+
+    def _on_evict(self, key, value):
+        scope = value[1]
+        with self._index_lock:
+            candidates = self._index.get(scope)
+            if candidates is not None:
+                candidates.pop(key, None)
+                if not candidates:
+                    del self._index[scope]
+
+    def lookup(self, scope, message):
+        """Testo della risposta in cache, oppure None."""
+        if scope is None:
+            return None
+        prompt = normalize_prompt(message)
+        entry = self._entries.get(self._key(scope, prompt))
+        if entry is not None:
+            self.exact_hits += 1
+            return entry[0]
+
+        if self.similarity > 0:
+            words = signature(prompt)
+            with self._index_lock:
+                candidates = [(key, candidate) for key, (candidate_words, candidate)
+                              in self._index.get(scope, {}).items() if candidate_words == words]
+            vector = self.embedder(prompt) if candidates else None
+            best_key, best_score = None, self.similarity
+            for key, candidate in candidates:
+                score = cosine(vector, candidate)
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is not None:
+                entry = self._entries.get(best_key)
+                if entry is not None:
+                    self.similar_hits += 1
+                    return entry[0]
+
+        self.misses += 1
+        return None
+
+    def store(self, scope, message, response):
+        if scope is None or not response or response.startswith(ERROR_PREFIXES):
+            return
+        prompt = normalize_prompt(message)
+        key = self._key(scope, prompt)
+        self._entries.set(key, (response, scope))
+        self.stores += 1
+        if self.similarity > 0:
+            entry = (signature(prompt), self.embedder(prompt))
+            with self._index_lock:
+                candidates = self._index.setdefault(scope, OrderedDict())
+                candidates[key] = entry
+                candidates.move_to_end(key)
+                while len(candidates) > RESPONSE_CACHE_SIMILAR_CANDIDATES:
+                    candidates.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        with self._index_lock:
+            self._index.clear()
+
+    def stats(self):
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        stats = self._entries.stats()
+        stats.update({
+            'enabled': self.enabled,
+            'exact_hits': self.exact_hits,
+            'similar_hits': self.similar_hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+        })
+        return stats
+
+
+def replay(text, chunk_chars=REPLAY_CHUNK_CHARS):
+    """Riproduce una risposta in cache come stream di chunk."""
+    for start in range(0, len(text), chunk_chars):
+        yield text[start:start + chunk_chars]
+
+
+response_cache = ResponseCache()
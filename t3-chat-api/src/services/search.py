@@ -0,0 +1,231 @@
+import base64
+import html
+import json
+import os
+import re
+
+from sqlalchemy import DDL, event, text
+
+from src.models.user import db, ChatMessage
+
+# Indice full-text dei messaggi, aggiornato dal database a ogni insert/update/delete:
+# - SQLite: tabella FTS5 tenuta allineata da trigger. Il proprietario della
+#   sessione è indicizzato come token ("u<id>"), così la ricerca legge solo le
+#   posting list dei messaggi dell'utente. chat_messages_fts_ids dà un rowid
+#   stabile a ogni messaggio (VACUUM può rinumerare i rowid di chat_messages).
+# - PostgreSQL: colonna tsvector generata con indice GIN.
+# Qui servono per create_all; la migrazione 0006 ne ha una copia propria.
+SQLITE_DDL = [
+    """CREATE TABLE chat_messages_fts_ids (
+        id INTEGER PRIMARY KEY,
+        message_id VARCHAR(36) NOT NULL UNIQUE
+    )""",
+    """CREATE VIRTUAL TABLE chat_messages_fts USING fts5(
+        text, owner, tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts_ids (message_id) VALUES (new.id);
+        INSERT INTO chat_messages_fts (rowid, text, owner) VALUES (
+            (SELECT id FROM chat_messages_fts_ids WHERE message_id = new.id),
+            new.text,
+            (SELECT 'u' || user_id FROM chat_session WHERE id = new.session_id)
+        );
+    END""",
+    """CREATE TRIGGER chat_messages_fts_update AFTER UPDATE OF text ON chat_messages BEGIN
+        UPDATE chat_messages_fts SET text = new.text
+        WHERE rowid = (SELECT id FROM chat_messages_fts_ids WHERE message_id = new.id);
+    END""",
+    """CREATE TRIGGER chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+        DELETE FROM chat_messages_fts
+        WHERE rowid = (SELECT id FROM chat_messages_fts_ids WHERE message_id = old.id);
+        DELETE FROM chat_messages_fts_ids WHERE message_id = old.id;
+    END""",
+]
+
+POSTGRES_DDL = [
+    """ALTER TABLE chat_messages ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED""",
+    "CREATE INDEX ix_chat_messages_search_vector ON chat_messages USING gin (search_vector)",
+]
+
+for _statement in SQLITE_DDL:
+    event.listen(ChatMessage.__table__, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+for _statement in POSTGRES_DDL:
+    event.listen(ChatMessage.__table__, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+
+_TOKEN_RE = re.compile(r'\w+')
+# Delimitatori delle parole trovate negli snippet: caratteri di uso privato,
+# sostituiti con <mark> solo dopo aver fatto l'escape HTML del testo
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_STOP = '\ue001'
+# Una parola presente in più di questa frazione dei messaggi dell'utente è
+# trattata come stopword (vedi plan_query)
+STOPWORD_RATIO = float(os.environ.get('SEARCH_STOPWORD_RATIO', '0.5'))
+
+# FTS5 restituisce le righe già in ordine di rank: la pagina (con snippet())
+# va calcolata sulla sola tabella FTS, prima dei join, altrimenti SQLite
+# ordina tutte le corrispondenze e calcola lo snippet di ognuna.
+SQLITE_SEARCH = """
+    WITH page AS MATERIALIZED (
+        SELECT rowid AS position, {rank} AS rank,
+               snippet(chat_messages_fts, 0, :start_sel, :stop_sel, '…', 16) AS snippet
+        FROM chat_messages_fts
+        WHERE chat_messages_fts MATCH :match {after}
+        ORDER BY {order}
+        LIMIT :limit
+    )
+    SELECT m.id, m.session_id, m.sender, m.created_at, s.title, page.snippet, page.rank, page.position
+    FROM page
+    JOIN chat_messages_fts_ids ids ON ids.id = page.position
+    JOIN chat_messages m ON m.id = ids.message_id
+    JOIN chat_session s ON s.id = m.session_id
+    WHERE s.user_id = :user_id
+    ORDER BY {outer_order}
+"""
+SQLITE_RANKED = {
+    'rank': 'rank',
+    'order': 'rank, rowid',
+    'after': "AND (rank > :rank OR (rank = :rank AND rowid > :position))",
+    'outer_order': 'page.rank, page.position',
+}
+# Senza bm25: dal messaggio più recente
+SQLITE_RECENT = {
+    'rank': 'NULL',
+    'order': 'rowid DESC',
+    'after': 'AND rowid < :position',
+    'outer_order': 'page.position DESC',
+}
+SQLITE_COUNT = "SELECT count(*) FROM chat_messages_fts WHERE chat_messages_fts MATCH :match"
+
+POSTGRES_SEARCH = """
+    SELECT page.id, page.session_id, page.sender, page.created_at, page.title,
+           ts_headline('simple', page.text, page.query, :headline_options) AS snippet,
+           page.rank, page.id AS position
+    FROM (
+        SELECT m.id, m.session_id, m.sender, m.created_at, m.text, s.title, q.query,
+               ts_rank_cd(m.search_vector, q.query) AS rank
+        FROM chat_messages m
+        JOIN chat_session s ON s.id = m.session_id
+        CROSS JOIN (SELECT websearch_to_tsquery('simple', :query) AS query) q
+        WHERE s.user_id = :user_id AND m.search_vector @@ q.query {after}
+        ORDER BY rank DESC, m.id
+        LIMIT :limit
+    ) page
+    ORDER BY page.rank DESC, page.id
+"""
+POSTGRES_AFTER = ("AND (ts_rank_cd(m.search_vector, q.query) < CAST(:rank AS real) OR "
+                  "(ts_rank_cd(m.search_vector, q.query) = CAST(:rank AS real) AND m.id > :position))")
+
+
+def highlight(snippet):
+    """Snippet come HTML sicuro: testo con escape, parole trovate tra <mark>."""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+
+def encode_search_cursor(rank, position):
+    raw = json.dumps([rank, position])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    """Inverso di encode_search_cursor; ValueError se il cursore non è valido."""
+    try:
+        rank, position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return (None if rank is None else float(rank)), position
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def fts5_phrases(query):
+    """Frasi FTS5 sicure: ogni parola tra virgolette.
+
+    Niente ricerca per prefisso ("parola"*): FTS5 unisce per intero le posting
+    list di tutti i termini con quel prefisso prima di filtrare per utente.
+    """
+    return [f'"{token}"' for token in _TOKEN_RE.findall(query)]
+
+
+def _count(match):
+    return db.session.execute(text(SQLITE_COUNT), {'match': match}).scalar()
+
+
+def plan_query(user_id, query):
+    """(espressione MATCH, ordinare per pertinenza?) per la ricerca su SQLite.
+
+    Per l'IDF bm25 legge l'intera posting list di ogni termine, di tutti gli
+    utenti: per parole come "the" (in quasi ogni messaggio) costa centinaia di
+    ms su un milione di messaggi, e il loro peso nel punteggio è ~0. Contare le
+    corrispondenze dell'utente invece è economico, quindi le parole presenti in
+    oltre STOPWORD_RATIO dei suoi messaggi vengono tolte dalla ricerca; se lo
+    sono tutte, si cercano tutte e si ordina per data.
+    """
+    phrases = fts5_phrases(query)
+    if not phrases:
+        return None, True
+    owner = f'owner : "u{int(user_id)}"'
+    total = _count(owner)
+    common = [p for p in phrases if _count(f'{owner} AND text : {p}') > total * STOPWORD_RATIO]
+    ranked = len(common) < len(phrases)
+    if ranked:
+        phrases = [p for p in phrases if p not in common]
+    return f'{owner} AND text : ({" AND ".join(phrases)})', ranked
+
+
+def search_messages(user_id, query, limit, cursor=None):
+    """Messaggi dell'utente che corrispondono alla ricerca, dal più pertinente.
+
+    Restituisce (risultati, cursore della pagina successiva o None).
+    """
+    params = {'user_id': int(user_id), 'limit': limit + 1}
+    params['start_sel'], params['stop_sel'] = HIGHLIGHT_START, HIGHLIGHT_STOP
+    after = ''
+    if cursor:
+        params['rank'], params['position'] = decode_search_cursor(cursor)
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        params['match'], ranked = plan_query(user_id, query)
+        if params['match'] is None:
+            return [], None
+        if cursor:
+            ranked = params['rank'] is not None
+        parts = dict(SQLITE_RANKED if ranked else SQLITE_RECENT)
+        if not cursor:
+            parts['after'] = ''
+        sql = SQLITE_SEARCH.format(**parts)
+    elif dialect == 'postgresql':
+        params['query'] = query
+        params['headline_options'] = (
+            f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords=24, MinWords=8'
+        )
+        if cursor:
+            after = POSTGRES_AFTER
+        sql = POSTGRES_SEARCH.format(after=after)
+    else:
+        raise RuntimeError(f'Full-text search is not available on {dialect}')
+
+    rows = db.session.execute(text(sql), params).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1].rank, rows[-1].position)
+
+    results = []
+    for row in rows:
+        created_at = row.created_at
+        if isinstance(created_at, str):
+            # SQLite restituisce il testo salvato ("YYYY-MM-DD HH:MM:SS")
+            created_at = created_at.replace(' ', 'T', 1)
+        elif created_at is not None:
+            created_at = created_at.isoformat()
+        results.append({
+            'message_id': row.id,
+            'session_id': row.session_id,
+            'session_title': row.title,
+            'sender': row.sender,
+            'snippet': highlight(row.snippet),
+            'timestamp': created_at,
+        })
+    return results, next_cursor
@@ -0,0 +1,281 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from src.services.cache import LRUCache
+from src.services import redis_client
+
+# Eventi recenti tenuti per ogni risposta in streaming (ring buffer)
+STREAM_BUFFER_EVENTS = int(os.environ.get('STREAM_BUFFER_EVENTS', '1000'))
+# Per quanto uno stream concluso (o inattivo) resta riprendibile
+STREAM_RETENTION_SECONDS = float(os.environ.get('STREAM_RETENTION_SECONDS', '300'))
+# Senza client collegati per questo tempo la generazione viene interrotta
+STREAM_RESUME_GRACE_SECONDS = float(os.environ.get('STREAM_RESUME_GRACE_SECONDS', '15'))
+# Con Redis i follower sono svegliati da un messaggio pub/sub a ogni evento;
+# se la sottoscrizione non è disponibile rileggono a questo intervallo
+STREAM_POLL_SECONDS = float(os.environ.get('STREAM_POLL_SECONDS', '0.1'))
+
+# Canale pub/sub (uno per tutti gli stream) su cui si pubblica l'id dello
+# stream che ha un evento nuovo
+NOTIFY_CHANNEL = 't3chat:stream:notify'
+
+# KEYS: lista degli eventi, hash dei metadati; ARGV: after_id
+# Restituisce nil se lo stream non esiste, altrimenti {last_id, done,
+# snapshot_id, primo id nel buffer, eventi dopo after_id}. Gli eventi hanno id
+# consecutivi: l'indice del primo da leggere si ricava dal primo del buffer, e
+# nello script nessuna scrittura può spostarlo.
+READ_SCRIPT = """
+local meta = redis.call('HMGET', KEYS[2], 'last_id', 'done', 'snapshot_id')
+if not meta[1] then
+    return false
+end
+local first_id = tonumber(meta[1]) + 1
+local events = {}
+local first = redis.call('LINDEX', KEYS[1], 0)
+if first then
+    first_id = cjson.decode(first)[1]
+    local start = math.max(0, tonumber(ARGV[1]) + 1 - first_id)
+    events = redis.call('LRANGE', KEYS[1], start, -1)
+end
+return {meta[1], meta[2], meta[3], first_id, events}
+"""
+
+
+class _MemoryStream:
+    def __init__(self):
+        self.events = deque(maxlen=STREAM_BUFFER_EVENTS)  # (event_id, payload)
+        self.last_id = 0
+        self.snapshot = (0, '')
+        self.done = False
+        self.last_seen = time.time()
+        self.condition = threading.Condition()
+
+
+class MemoryStreamBackend:
+    """Ring buffer per processo: la ripresa funziona se torna sullo stesso worker."""
+
+    def __init__(self):
+        self._streams = LRUCache(maxsize=100000, ttl=STREAM_RETENTION_SECONDS, sliding=True)
+
+    def open(self, stream_id):
+        self._streams.set(stream_id, _MemoryStream())
+
+    def publish(self, stream_id, payload, done=False):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return None
+        with stream.condition:
+            stream.last_id += 1
+            stream.events.append((stream.last_id, payload))
+            stream.done = stream.done or done
+            stream.condition.notify_all()
+            return stream.last_id
+
+    def save_snapshot(self, stream_id, event_id, text):
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            stream.snapshot = (event_id, text)
+
+    def touch(self, stream_id):
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            stream.last_seen = time.time()
+
+    def last_seen(self, stream_id):
+        stream = self._streams.get(stream_id)
+        return stream.last_seen if stream is not None else 0
+
+    def read(self, stream_id, after_id):
+        """(eventi dopo after_id, primo id nel buffer, id dello snapshot, done) o None se sconosciuto."""
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return None
+        with stream.condition:
+            events = [event for event in stream.events if event[0] > after_id]
+            first_id = stream.events[0][0] if stream.events else stream.last_id + 1
+            return events, first_id, stream.snapshot[0], stream.done
+
+    def snapshot(self, stream_id):
+        """(id dell'ultimo evento incluso, testo) dell'ultimo checkpoint."""
+        stream = self._streams.get(stream_id)
+        return stream.snapshot if stream is not None else (0, '')
+
+    def wait(self, stream_id, after_id, timeout):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return
+        with stream.condition:
+            if stream.last_id <= after_id and not stream.done:
+                stream.condition.wait(timeout)
+
+
+class RedisStreamBackend:
+    """Ring buffer su Redis: un client può riprendere lo stream da qualunque worker.
+
+    Un follower legge solo gli eventi dopo il suo ultimo id, e tra una lettura
+    e l'altra aspetta la notifica pub/sub di un evento nuovo.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._read = client.register_script(READ_SCRIPT)
+        self._waiters = {}  # stream_id -> {threading.Event}
+        self._lock = threading.Lock()
+        self._listening = None
+
+    @staticmethod
+    def _keys(stream_id):
+        prefix = f't3chat:stream:{stream_id}'
+        return f'{prefix}:events', f'{prefix}:meta'
+
+    def open(self, stream_id):
+        events_key, meta_key = self._keys(stream_id)
+        pipe = self.client.pipeline()
+        pipe.delete(events_key, meta_key)
+        pipe.hset(meta_key, mapping={'last_id': 0, 'done': 0, 'snapshot_id': 0, 'snapshot': '', 'last_seen': time.time()})
+        pipe.expire(meta_key, int(STREAM_RETENTION_SECONDS))
+        pipe.execute()
+
+    def publish(self, stream_id, payload, done=False):
+        events_key, meta_key = self._keys(stream_id)
+        event_id = self.client.hincrby(meta_key, 'last_id', 1)
+        pipe = self.client.pipeline()
+        pipe.rpush(events_key, json.dumps([event_id, payload]))
+        pipe.ltrim(events_key, -STREAM_BUFFER_EVENTS, -1)
+        if done:
+            pipe.hset(meta_key, 'done', 1)
+        pipe.expire(events_key, int(STREAM_RETENTION_SECONDS))
+        pipe.expire(meta_key, int(STREAM_RETENTION_SECONDS))
+        pipe.publish(NOTIFY_CHANNEL, json.dumps(stream_id))
+        pipe.execute()
+        return event_id
+
+    def save_snapshot(self, stream_id, event_id, text):
+        _, meta_key = self._keys(stream_id)
+        self.client.hset(meta_key, mapping={'snapshot_id': event_id, 'snapshot': text})
+
+    def touch(self, stream_id):
+        _, meta_key = self._keys(stream_id)
+        self.client.hset(meta_key, 'last_seen', time.time())
+
+    def last_seen(self, stream_id):
+        _, meta_key = self._keys(stream_id)
+        return float(self.client.hget(meta_key, 'last_seen') or 0)
+
+    def read(self, stream_id, after_id):
+        events_key, meta_key = self._keys(stream_id)
+        result = self._read(keys=[events_key, meta_key], args=[after_id])
+        if result is None:
+            return None
+        _, done, snapshot_id, first_id, raw_events = result
+        events = [event for event in (tuple(json.loads(item)) for item in raw_events) if event[0] > after_id]
+        return events, int(first_id), int(snapshot_id), int(done) == 1
+
+    def snapshot(self, stream_id):
+        _, meta_key = self._keys(stream_id)
+        snapshot_id, text = self.client.hmget(meta_key, 'snapshot_id', 'snapshot')
+        return int(snapshot_id or 0), (text or b'').decode()
+
+    def _notify(self, stream_id):
+        with self._lock:
+            waiters = list(self._waiters.get(stream_id, ()))
+        for waiter in waiters:
+            waiter.set()
+
+    def _notify_all(self):
+        # Dopo una riconnessione le notifiche perse non si possono sapere
+        with self._lock:
+            waiters = [waiter for group in self._waiters.values() for waiter in group]
+        for waiter in waiters:
+            waiter.set()
+
+    def wait(self, stream_id, after_id, timeout):
+        if self._listening is None:
+            self._listening = redis_client.subscribe(NOTIFY_CHANNEL, self._notify, on_reconnect=self._notify_all)
+        if not self._listening:
+            time.sleep(min(timeout, STREAM_POLL_SECONDS))
+            return
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(stream_id, set()).add(waiter)
+        try:
+            # Un evento pubblicato dopo read() ma prima di registrarsi non
+            # verrebbe notificato
+            _, meta_key = self._keys(stream_id)
+            if int(self.client.hget(meta_key, 'last_id') or 0) > after_id:
+                return
+            waiter.wait(timeout)
+        finally:
+            with self._lock:
+                group = self._waiters.get(stream_id)
+                if group is not None:
+                    group.discard(waiter)
+                    if not group:
+                        del self._waiters[stream_id]
+
+
+class StreamRegistry:
+    """Eventi SSE numerati delle risposte in streaming, riprendibili con Last-Event-ID.
+
+    Il produttore pubblica ogni chunk con un id crescente; i client (anche dopo
+    una riconnessione) rileggono dal ring buffer gli eventi persi e poi seguono
+    quelli nuovi. Se gli eventi persi sono già usciti dal buffer si riparte
+    dall'ultimo snapshot del testo salvato al checkpoint.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            client = redis_client.get_redis()
+            self._backend = RedisStreamBackend(client) if client is not None else MemoryStreamBackend()
+        return self._backend
+
+    def open(self, stream_id):
+        self.backend.open(stream_id)
+
+    def publish(self, stream_id, payload):
+        return self.backend.publish(stream_id, payload)
+
+    def finish(self, stream_id, payload):
+        return self.backend.publish(stream_id, payload, done=True)
+
+    def snapshot(self, stream_id, event_id, text):
+        self.backend.save_snapshot(stream_id, event_id, text)
+
+    def idle_seconds(self, stream_id):
+        """Secondi da quando un client ha letto lo stream l'ultima volta."""
+        return time.time() - self.backend.last_seen(stream_id)
+
+    def exists(self, stream_id):
+        return self.backend.read(stream_id, 0) is not None
+
+    def subscribe(self, stream_id, last_event_id=0, heartbeat=1.0):
+        """Genera (event_id, payload) dopo last_event_id fino alla fine dello stream."""
+        backend = self.backend
+        after_id = last_event_id
+        while True:
+            backend.touch(stream_id)
+            state = backend.read(stream_id, after_id)
+            if state is None:
+                return
+            events, first_id, snapshot_id, done = state
+            if after_id < first_id - 1 and snapshot_id > after_id:
+                # Eventi persi non più nel buffer: riparte dal testo salvato
+                snapshot_id, snapshot_text = backend.snapshot(stream_id)
+                yield snapshot_id, {'snapshot': snapshot_text}
+                after_id = snapshot_id
+                events = [event for event in events if event[0] > after_id]
+            for event_id, payload in events:
+                yield event_id, payload
+                after_id = event_id
+            if done:
+                return
+            backend.wait(stream_id, after_id, heartbeat)
+
+
+stream_registry = StreamRegistry()
@@ -0,0 +1,91 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from src.models.user import db, ChatMessage
+
+# Una risposta in streaming viene salvata ogni CHECKPOINT_CHARS caratteri nuovi
+# o ogni CHECKPOINT_SECONDS secondi, il primo dei due che scatta.
+CHECKPOINT_CHARS = int(os.environ.get('STREAM_CHECKPOINT_CHARS', '2000'))
+CHECKPOINT_SECONDS = float(os.environ.get('STREAM_CHECKPOINT_SECONDS', '2'))
+# Una risposta 'streaming' senza checkpoint da così tanto tempo è di un worker
+# morto (o riavviato) a metà generazione: nessuno la completerà più
+STREAM_STALE_SECONDS = float(os.environ.get('STREAM_STALE_SECONDS', '600'))
+
+STATUS_STREAMING = 'streaming'
+STATUS_COMPLETE = 'complete'
+STATUS_ABORTED = 'aborted'
+
+
+class StreamCheckpointer:
+    """Accumula i chunk di una risposta AI e li salva a intervalli sul ChatMessage.
+
+    I chunk restano in una lista (niente concatenazioni quadratiche) e vengono
+    uniti solo ai checkpoint; così, se il client si disconnette o il worker muore,
+    nel database resta il testo generato fino all'ultimo salvataggio.
+    on_flush(event_id, text) viene chiamata dopo ogni salvataggio con l'id
+    dell'ultimo evento SSE incluso nel testo.
+    """
+
+    def __init__(self, message_id, min_chars=CHECKPOINT_CHARS, interval=CHECKPOINT_SECONDS, on_flush=None):
+        self.message_id = message_id
+        self.min_chars = min_chars
+        self.interval = interval
+        self.on_flush = on_flush
+        self.event_id = None
+        self._parts = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def text(self):
+        if len(self._parts) > 1:
+            self._parts = [''.join(self._parts)]
+        return self._parts[0] if self._parts else ''
+
+    def append(self, chunk, event_id=None):
+        self._parts.append(chunk)
+        self.event_id = event_id
+        self._pending_chars += len(chunk)
+        if self._pending_chars >= self.min_chars or time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self, status=None):
+        values = {ChatMessage.text: self.text, ChatMessage.updated_at: datetime.utcnow()}
+        if status is not None:
+            values[ChatMessage.status] = status
+        ChatMessage.query.filter_by(id=self.message_id).update(values, synchronize_session=False)
+        db.session.commit()
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+        if self.on_flush is not None and self.event_id is not None:
+            self.on_flush(self.event_id, values[ChatMessage.text])
+
+    def finish(self, status=STATUS_COMPLETE):
+        """Salva il testo finale con lo stato conclusivo (complete / aborted)."""
+        self.flush(status)
+
+
+def stale_cutoff():
+    return datetime.utcnow() - timedelta(seconds=STREAM_STALE_SECONDS)
+
+
+def is_stale(status, updated_at, created_at):
+    """True per una risposta rimasta 'streaming' oltre STREAM_STALE_SECONDS."""
+    return status == STATUS_STREAMING and (updated_at or created_at) < stale_cutoff()
+
+
+def abort_stale_streams(session_id=None):
+    """Segna come 'aborted' le risposte 'streaming' abbandonate (con commit).
+
+    Con session_id solo quelle della sessione; restituisce quante ne ha chiuse.
+    """
+    query = ChatMessage.query.filter(
+        ChatMessage.status == STATUS_STREAMING,
+        ChatMessage.updated_at < stale_cutoff()
+    )
+    if session_id is not None:
+        query = query.filter(ChatMessage.session_id == session_id)
+    aborted = query.update({ChatMessage.status: STATUS_ABORTED}, synchronize_session=False)
+    db.session.commit()
+    return aborted
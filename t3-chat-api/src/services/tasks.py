@@ -0,0 +1,120 @@
+import os
+import re
+
+from flask import current_app
+
+from src.models.user import db, User, ChatSession
+from src.services import documents, garbage, image_payloads, jobs, stream_checkpoint
+from src.services.ai_service import AIService
+from src.services.context_builder import estimate_tokens
+from src.services.response_cache import ERROR_PREFIXES
+
+# Job eseguiti in background (vedi jobs.py). Questo modulo va importato da
+# ogni processo che accoda o esegue job, per registrarli.
+
+# Ogni quanto eseguire il garbage collector dello storage (vedi garbage.py)
+GC_INTERVAL = float(os.environ.get('GC_INTERVAL', '3600'))
+# Per quanto tenere i job terminati, per diagnostica
+JOB_RETENTION_SECONDS = float(os.environ.get('JOB_RETENTION_SECONDS', str(7 * 24 * 3600)))
+
+TITLE_MAX_LENGTH = 80
+TITLE_PROMPT = (
+    "Scrivi un titolo breve (al massimo 6 parole) per una conversazione che inizia "
+    "con il messaggio seguente. Rispondi solo con il titolo, nella lingua del messaggio.\n\n{message}"
+)
+
+_TITLE_NOISE_RE = re.compile(r'^(titolo|title)\s*:\s*', re.IGNORECASE)
+# Chiave mancante ("⚠️ ..."), rifiutata o senza permessi: ripetere il job non serve
+_TITLE_CONFIG_ERROR_RE = re.compile(r'^⚠️|\b(401|403)\b|api key not valid', re.IGNORECASE)
+# Stima dei token della risposta: al più TITLE_MAX_LENGTH caratteri
+TITLE_RESPONSE_TOKENS = 30
+
+
+def placeholder_title(message):
+    """Titolo provvisorio di una sessione, finché il job non genera quello vero."""
+    return message[:50] + '...' if len(message) > 50 else message
+
+
+def title_prompt(message):
+    return TITLE_PROMPT.format(message=message[:2000])
+
+
+def title_tokens(message):
+    """Token stimati per generare il titolo, da scalare dalla quota dell'utente."""
+    return estimate_tokens(title_prompt(message)) + TITLE_RESPONSE_TOKENS
+
+
+def clean_title(text):
+    for line in text.splitlines():
+        line = _TITLE_NOISE_RE.sub('', line.strip().lstrip('#*').strip())
+        line = line.strip('*"\'`“”«» .')
+        if line:
+            return line[:TITLE_MAX_LENGTH]
+    return None
+
+
+@jobs.task('generate_title', max_attempts=3, concurrency=4)
+def generate_title(session_id, user_id, model, message, placeholder):
+    """Titolo della sessione generato dal modello scelto dall'utente."""
+    if AIService.provider_for(model) is None:
+        return
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+    response = ''.join(AIService.get_streaming_response(title_prompt(message), model, user))
+    if response.startswith(ERROR_PREFIXES):
+        if _TITLE_CONFIG_ERROR_RE.search(response):
+            # Resta il titolo provvisorio
+            print(f"Title of session {session_id} not generated: {response}")
+            return
+        raise RuntimeError(response)
+    title = clean_title(response)
+    if not title:
+        return
+    # Solo se il titolo è ancora quello provvisorio
+    ChatSession.query.filter_by(id=session_id, title=placeholder).update(
+        {ChatSession.title: title}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+@jobs.task('index_document', max_attempts=3, concurrency=2)
+def index_document(sha256, path, mime_type):
+    documents.index_blob(sha256, path, mime_type)
+
+
+@jobs.task('precompute_image_payloads', max_attempts=2, concurrency=2)
+def precompute_image_payloads(sha256, path):
+    image_payloads.precompute(current_app.config['UPLOAD_FOLDER'], sha256, path)
+
+
+@jobs.task('collect_garbage', max_attempts=1, concurrency=1)
+def collect_garbage():
+    report = garbage.collect_garbage(current_app.config['UPLOAD_FOLDER'])
+    if report.counts:
+        print(f"Storage GC: {report.to_dict()}")
+
+
+@jobs.task('abort_stale_streams', max_attempts=1, concurrency=1)
+def abort_stale_streams():
+    aborted = stream_checkpoint.abort_stale_streams()
+    if aborted:
+        print(f"Aborted {aborted} stale streaming messages")
+
+
+@jobs.task('requeue_stale_indexing', max_attempts=1, concurrency=1)
+def requeue_stale_indexing():
+    requeued = documents.requeue_stale_indexing(current_app.config['UPLOAD_FOLDER'])
+    if requeued:
+        print(f"Requeued {requeued} documents left indexing")
+
+
+@jobs.task('prune_jobs', max_attempts=1, concurrency=1)
+def prune_jobs():
+    jobs.prune(JOB_RETENTION_SECONDS)
+
+
+jobs.every(GC_INTERVAL, 'collect_garbage')
+jobs.every(3600, 'prune_jobs')
+jobs.every(stream_checkpoint.STREAM_STALE_SECONDS, 'abort_stale_streams')
+jobs.every(documents.INDEX_CLAIM_SECONDS, 'requeue_stale_indexing')
@@ -0,0 +1,204 @@
+import codecs
+import json
+import os
+import time
+import uuid
+
+from sqlalchemy import func
+
+from src.models.user import db, Attachment
+from src.services import blob_store
+
+# Spazio totale per utente (somma delle dimensioni dei suoi allegati)
+USER_STORAGE_QUOTA_BYTES = int(os.environ.get('USER_STORAGE_QUOTA_BYTES', str(500 * 1024 * 1024)))
+# Dimensione massima di un file caricato a pezzi (upload riprendibile)
+RESUMABLE_UPLOAD_MAX_BYTES = int(os.environ.get('RESUMABLE_UPLOAD_MAX_BYTES', str(100 * 1024 * 1024)))
+# Dopo quanto un upload riprendibile non completato può essere eliminato
+RESUMABLE_UPLOAD_TTL = float(os.environ.get('RESUMABLE_UPLOAD_TTL', str(24 * 3600)))
+
+# Firme (magic bytes) ammesse per ogni estensione: (offset, byte attesi)
+SIGNATURES = {
+    'png': ('image/png', [[(0, b'\x89PNG\r\n\x1a\n')]]),
+    'jpg': ('image/jpeg', [[(0, b'\xff\xd8\xff')]]),
+    'jpeg': ('image/jpeg', [[(0, b'\xff\xd8\xff')]]),
+    'gif': ('image/gif', [[(0, b'GIF87a')], [(0, b'GIF89a')]]),
+    'webp': ('image/webp', [[(0, b'RIFF'), (8, b'WEBP')]]),
+    'pdf': ('application/pdf', [[(0, b'%PDF-')]]),
+    'docx': ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', [[(0, b'PK\x03\x04')]]),
+    'doc': ('application/msword', [[(0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1')]]),
+}
+TEXT_TYPES = {'txt': 'text/plain', 'md': 'text/markdown'}
+
+
+class UploadError(Exception):
+    """Upload rifiutato; `status` è il codice HTTP da restituire."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_mime(head, extension):
+    """Tipo MIME dai primi byte del file, che devono corrispondere all'estensione.
+
+    Il content type dichiarato dal client non viene usato: solleva
+    UploadError (415) se il contenuto non è del tipo atteso.
+    """
+    if extension in TEXT_TYPES:
+        try:
+            # Decoder incrementale: un carattere spezzato a fine blocco non è un errore
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        except UnicodeDecodeError:
+            raise UploadError('File content is not UTF-8 text', 415)
+        if b'\x00' in head:
+            raise UploadError('File content is not UTF-8 text', 415)
+        return TEXT_TYPES[extension]
+
+    mime_type, alternatives = SIGNATURES[extension]
+    for signature in alternatives:
+        if all(head[offset:offset + len(magic)] == magic for offset, magic in signature):
+            return mime_type
+    raise UploadError(f'File content does not match .{extension}', 415)
+
+
+def storage_used(user_id):
+    return db.session.query(func.coalesce(func.sum(Attachment.file_size), 0)).filter(
+        Attachment.user_id == user_id
+    ).scalar()
+
+
+class UploadGuard:
+    """Callback per blob_store.copy_stream: controlla il tipo sul primo blocco e
+    interrompe la lettura appena si supera il limite, senza leggere il resto."""
+
+    def __init__(self, extension, limit, mime_type=None):
+        self.extension = extension
+        self.limit = limit
+        self.mime_type = mime_type
+
+    def __call__(self, block, written):
+        if self.mime_type is None:
+            self.mime_type = sniff_mime(block, self.extension)
+        if written > self.limit:
+            raise UploadError('File too large or storage quota exceeded', 413)
+
+
+def guard_for(user_id, extension, max_file_size):
+    remaining = USER_STORAGE_QUOTA_BYTES - storage_used(user_id)
+    if remaining <= 0:
+        raise UploadError('Storage quota exceeded', 413)
+    return UploadGuard(extension, min(max_file_size, remaining))
+
+
+# Upload riprendibili: il file parziale e i suoi metadati (JSON) stanno in
+# UPLOAD_FOLDER/partial, condivisi da tutti i worker; l'offset corrente è la
+# dimensione del file parziale.
+
+def _partial_dir(upload_folder):
+    return os.path.join(upload_folder, 'partial')
+
+
+def _partial_paths(upload_folder, upload_id):
+    base = os.path.join(_partial_dir(upload_folder), upload_id)
+    return base, base + '.json'
+
+
+def _save_meta(meta_path, meta):
+    tmp_path = f'{meta_path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def create_resumable(upload_folder, user_id, filename, extension, size):
+    if size <= 0 or size > RESUMABLE_UPLOAD_MAX_BYTES:
+        raise UploadError('Invalid upload size', 413 if size > 0 else 400)
+    if storage_used(user_id) + size > USER_STORAGE_QUOTA_BYTES:
+        raise UploadError('Storage quota exceeded', 413)
+    os.makedirs(_partial_dir(upload_folder), exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    data_path, meta_path = _partial_paths(upload_folder, upload_id)
+    open(data_path, 'wb').close()
+    meta = {
+        'id': upload_id,
+        'user_id': user_id,
+        'filename': filename,
+        'extension': extension,
+        'size': size,
+        'mime_type': None,
+        'created_at': time.time(),
+    }
+    _save_meta(meta_path, meta)
+    return meta
+
+
+def load_resumable(upload_folder, upload_id, user_id):
+    """Metadati dell'upload con l'offset corrente, oppure None."""
+    if not upload_id.isalnum():
+        return None
+    data_path, meta_path = _partial_paths(upload_folder, upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta['user_id'] != user_id or not os.path.exists(data_path):
+        return None
+    meta['offset'] = os.path.getsize(data_path)
+    return meta
+
+
+def append_resumable(upload_folder, meta, offset, stream):
+    """Aggiunge un pezzo all'offset indicato; restituisce il nuovo offset."""
+    if offset != meta['offset']:
+        raise UploadError(f"Offset mismatch, expected {meta['offset']}", 409)
+    data_path, meta_path = _partial_paths(upload_folder, meta['id'])
+    guard = UploadGuard(meta['extension'], meta['size'], meta['mime_type'])
+    with open(data_path, 'ab') as out:
+        try:
+            written = blob_store.copy_stream(stream, out, on_chunk=guard, written=offset)
+        except UploadError:
+            # Scarta il pezzo: il client riprende dall'ultimo offset valido
+            out.truncate(offset)
+            raise
+    if meta['mime_type'] is None:
+        meta['mime_type'] = guard.mime_type
+        _save_meta(meta_path, {key: value for key, value in meta.items() if key != 'offset'})
+    meta['offset'] = written
+    return written
+
+
+def finish_resumable(upload_folder, meta):
+    """Upload completo: (sha256, dimensione, percorso) del file da archiviare."""
+    data_path, meta_path = _partial_paths(upload_folder, meta['id'])
+    sha256 = blob_store.hash_file(data_path)
+    os.remove(meta_path)
+    return sha256, meta['size'], data_path
+
+
+def stale_resumables(upload_folder, older_than):
+    """Upload riprendibili senza scritture da più di `older_than` secondi:
+    (id, file, byte ricevuti), inclusi i file rimasti senza metadati."""
+    directory = _partial_dir(upload_folder)
+    if not os.path.isdir(directory):
+        return
+    uploads = {}
+    for entry in os.scandir(directory):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        # <id>, <id>.json e <id>.json.<uuid>.tmp
+        upload_id = entry.name.split('.', 1)[0]
+        paths, last_write, size = uploads.get(upload_id, ((), 0, 0))
+        uploads[upload_id] = (paths + (entry.path,), max(last_write, stat.st_mtime), size + stat.st_size)
+    cutoff = time.time() - older_than
+    for upload_id, (paths, last_write, size) in uploads.items():
+        if last_write < cutoff:
+            yield upload_id, paths, size
+
+
+def discard_resumable(upload_folder, upload_id):
+    for path in _partial_paths(upload_folder, upload_id):
+        if os.path.exists(path):
+            os.remove(path)